@@ -0,0 +1,254 @@
+"""Client acknowledgements for pushed notifications.
+
+Websocket clients that connect with `?ack=1` get every notification with a
+`msg_id` and answer with `{"type": "ACK", "ids": [...]}`, batching as many
+ids as they like. Until then the message is outstanding:
+
+* acks are buffered and applied every ACK_FLUSH_INTERVAL seconds: pending
+  rows that were replayed are deleted and the matching notification_logs
+  rows are marked acknowledged, one set-based write per message
+* after ACK_TIMEOUT seconds an unacked message is re-sent, up to
+  ACK_MAX_RETRIES times, then put back in pending_notifications
+* messages outstanding when the client disconnects go back to
+  pending_notifications too, so they are replayed on the next connect
+  (see `requeue_pending`, which the SSE stream shares)
+
+Clients without `ack=1` keep the old fire-and-forget behaviour.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from funnels import funnels
+from metrics import registry
+from repositories import chunked, repos
+
+ACK_TIMEOUT = float(os.getenv("ACK_TIMEOUT", "30"))
+ACK_MAX_RETRIES = int(os.getenv("ACK_MAX_RETRIES", "2"))
+ACK_FLUSH_INTERVAL = float(os.getenv("ACK_FLUSH_INTERVAL", "1.0"))
+ACK_BATCH_SIZE = int(os.getenv("ACK_BATCH_SIZE", "500"))
+
+ack_events = registry.counter(
+    "notification_ack_events_total", "Acknowledgement tracking events", ("event",)
+)
+
+
+def _canonical(message: dict) -> str:
+    return json.dumps(message, sort_keys=True, default=str)
+
+
+def _shared_bodies(messages: Dict[str, dict]) -> Dict[str, str]:
+    """message_id of a stored copy per canonical message; bodies that can't be stored are left out.
+
+    A message still matching the body its send stored under `msg_id` reuses
+    it; anything else (personalized variants, test pushes) is stored once
+    under an id derived from its content.
+    """
+    ids: Dict[str, str] = {}
+    stored: Dict[str, dict] = {}
+    msg_ids = [m["msg_id"] for m in messages.values() if m.get("msg_id")]
+    if msg_ids:
+        try:
+            stored = repos.messages.get_many(msg_ids)
+        except Exception:
+            print(f"Warning: failed to read {len(msg_ids)} shared messages for re-queueing")
+    new_rows = []
+    for key, message in messages.items():
+        body = stored.get(message.get("msg_id"))
+        if body is not None and _canonical(body) == key:
+            ids[key] = message["msg_id"]
+            continue
+        message_id = str(uuid.uuid5(uuid.NAMESPACE_OID, key))
+        new_rows.append({"message_id": message_id, "payload": message})
+        ids[key] = message_id
+    if new_rows:
+        try:
+            repos.messages.upsert(new_rows)
+        except Exception:
+            print(f"Warning: failed to store {len(new_rows)} shared messages, re-queuing inline payloads")
+            for row in new_rows:
+                ids.pop(_canonical(row["payload"]), None)
+    return ids
+
+
+def requeue_pending(items: List[Tuple[str, dict]], batch_size: int = ACK_BATCH_SIZE) -> int:
+    """Put pushed-but-undelivered (user_id, message) pairs back in pending_notifications.
+
+    Rows are built like the delivery pipeline's: their own id and
+    created_at, and a `message_id` reference instead of an inline payload
+    where the body could be shared. Blocking; returns the rows written.
+    """
+    if not items:
+        return 0
+    now = datetime.utcnow().isoformat()
+    messages = {}
+    for _, message in items:
+        messages.setdefault(_canonical(message), message)
+    body_ids = _shared_bodies(messages)
+    rows = []
+    for user_id, message in items:
+        message_id = body_ids.get(_canonical(message))
+        body = {"message_id": message_id} if message_id else {"payload": message}
+        rows.append({"id": str(uuid.uuid4()), "user_id": user_id, **body, "created_at": now})
+    written = 0
+    for batch in chunked(rows, batch_size):
+        try:
+            repos.pending.insert(batch)
+            written += len(batch)
+        except Exception:
+            print(f"Warning: failed to re-queue {len(batch)} undelivered notifications")
+    return written
+
+
+class Outstanding:
+    __slots__ = ("user_id", "msg_id", "message", "pending_id", "sent_at", "attempts")
+
+    def __init__(self, user_id: str, msg_id: str, message: dict, pending_id: Optional[str]):
+        self.user_id = user_id
+        self.msg_id = msg_id
+        self.message = message
+        # set when the message was replayed from pending_notifications
+        self.pending_id = pending_id
+        self.sent_at = time.monotonic()
+        self.attempts = 1
+
+
+class AckTracker:
+    def __init__(
+        self,
+        timeout: float = ACK_TIMEOUT,
+        max_retries: int = ACK_MAX_RETRIES,
+        flush_interval: float = ACK_FLUSH_INTERVAL,
+        batch_size: int = ACK_BATCH_SIZE,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # user_id -> msg_id -> Outstanding; only touched from the event loop
+        self.outstanding: Dict[str, Dict[str, Outstanding]] = {}
+        self.acked: List[Outstanding] = []
+        self.requeue: List[Outstanding] = []
+        self.resend: Optional[Callable[[str, dict], Awaitable[bool]]] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def track(self, user_id: str, message: dict, pending_id: Optional[str] = None):
+        msg_id = message.get("msg_id")
+        if not msg_id:
+            return
+        entries = self.outstanding.setdefault(user_id, {})
+        entry = entries.get(msg_id)
+        if entry is not None:
+            entry.sent_at = time.monotonic()
+            return
+        entries[msg_id] = Outstanding(user_id, msg_id, message, pending_id)
+        ack_events.inc(event="sent")
+
+    def ack(self, user_id: str, msg_ids: List[str]):
+        entries = self.outstanding.get(user_id)
+        if not entries:
+            return
+        for msg_id in msg_ids:
+            entry = entries.pop(str(msg_id), None)
+            if entry is not None:
+                self.acked.append(entry)
+                ack_events.inc(event="acked")
+        if not entries:
+            self.outstanding.pop(user_id, None)
+
+    def disconnected(self, user_id: str):
+        """Anything the client never acked goes back to pending_notifications."""
+        entries = self.outstanding.pop(user_id, None)
+        if entries:
+            self.requeue.extend(entries.values())
+            ack_events.inc(len(entries), event="requeued")
+
+    def start(self, resend: Callable[[str, dict], Awaitable[bool]]):
+        if self.task:
+            return
+        self.resend = resend
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        for user_id in list(self.outstanding):
+            self.disconnected(user_id)
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._retry_expired()
+                await self.flush()
+            except Exception:
+                print("Warning: ack processing failed")
+
+    async def _retry_expired(self):
+        deadline = time.monotonic() - self.timeout
+        for user_id, entries in list(self.outstanding.items()):
+            for entry in [e for e in entries.values() if e.sent_at < deadline]:
+                if entry.attempts > self.max_retries:
+                    entries.pop(entry.msg_id, None)
+                    self.requeue.append(entry)
+                    ack_events.inc(event="requeued")
+                    continue
+                entry.attempts += 1
+                entry.sent_at = time.monotonic()
+                ack_events.inc(event="retried")
+                if not await self.resend(user_id, entry.message):
+                    # the failed send disconnected the user, which re-queued all of its entries
+                    break
+            if not entries and self.outstanding.get(user_id) is entries:
+                del self.outstanding[user_id]
+
+    async def flush(self):
+        acked, self.acked = self.acked, []
+        requeue, self.requeue = self.requeue, []
+        if acked:
+            await asyncio.to_thread(self._apply_acks, acked)
+        if requeue:
+            await asyncio.to_thread(self._requeue, requeue)
+
+    def _apply_acks(self, acked: List[Outstanding]):
+        now = datetime.utcnow().isoformat()
+        for e in acked:
+            funnels.add_message(e.message, acked=1)
+        pending_ids = [e.pending_id for e in acked if e.pending_id]
+        for batch in chunked(pending_ids, self.batch_size):
+            try:
+                repos.pending.delete_many(batch)
+            except Exception:
+                print(f"Warning: failed to delete {len(batch)} acknowledged pending notifications")
+
+        # pipeline sends stamp their shared message id, which their log rows carry too
+        by_message: Dict[str, List[str]] = {}
+        for e in acked:
+            if e.msg_id != e.pending_id:
+                by_message.setdefault(e.msg_id, []).append(e.user_id)
+        for msg_id, user_ids in by_message.items():
+            for batch in chunked(user_ids, self.batch_size):
+                try:
+                    repos.logs.mark_acked(msg_id, batch, now)
+                except Exception:
+                    print(f"Warning: failed to mark {len(batch)} notification_logs rows acknowledged")
+
+    def _requeue(self, entries: List[Outstanding]):
+        # replayed rows are still in pending_notifications; only live pushes need a row
+        requeue_pending([(e.user_id, e.message) for e in entries if not e.pending_id], self.batch_size)
+
+
+acks = AckTracker()
+
+registry.callback_gauge(
+    "notification_acks_outstanding",
+    "Pushed notifications waiting for a client ack",
+    lambda: sum(len(e) for e in list(acks.outstanding.values())),
+)
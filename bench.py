@@ -0,0 +1,210 @@
+"""Microbenchmarks for the CPU-bound hot paths, with regression gating.
+
+Runs each benchmark against synthetic data (built from users.csv like
+datagen.py) at several sizes and reports items per second, best of
+--repeat runs:
+
+  eligibility     filter_eligible_users over customers with preferences
+  delivery_build  channel routing and log row construction for one page
+  validate_email  validate_email over a bulk import's addresses
+  csv_parse       parse_users_csv (bcrypt swapped out; it costs the same per row)
+  session_lookup  get_current_user token lookups
+
+Results are compared with the stored baseline; the exit status is 1 when
+any benchmark is more than --tolerance slower or has no baseline, and 2
+when there is no baseline file at all. Baselines are per machine, so none
+is committed: record one with --save before changing code and compare on
+the same host.
+
+Usage:
+  python bench.py --save                 # record bench_baseline.json
+  python bench.py                        # compare against it
+  python bench.py --only eligibility csv_parse --sizes 1000 100000 --tolerance 0.1
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+# main.py connects at import time; benchmarks never touch the database
+os.environ.setdefault("DATA_BACKEND", "local")
+
+import main
+from datagen import Generator
+from delivery import DeliveryRequest
+from fastapi import HTTPException
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(HERE, "bench_baseline.json")
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+def customers(size: int) -> List[dict]:
+    gen = Generator(None, seed=size)
+    rows = []
+    for i in range(size):
+        user = gen.user(i)
+        user["user_preferences"] = {
+            "offers": gen.random.random() < 0.9,
+            "order_updates": True,
+            "newsletter": gen.random.random() < 0.9,
+        }
+        rows.append(user)
+    return rows
+
+
+# each setup returns the function to time; it processes `size` items per call
+def bench_eligibility(size: int) -> Callable[[], object]:
+    users = customers(size)
+    return lambda: main.filter_eligible_users(users, "offers", "Mumbai")
+
+
+def bench_delivery_build(size: int) -> Callable[[], object]:
+    recipients = customers(size)
+    user_ids = [u["user_id"] for u in recipients]
+    flags = {uid: {"push": True, "email": i % 2 == 0, "campaign_sms": False} for i, uid in enumerate(user_ids)}
+    request = DeliveryRequest(
+        "CAMPAIGN", {"type": "CAMPAIGN", "title": "Bench"}, lambda after, limit: ([], None),
+        key="00000000-0000-0000-0000-000000000000", ref="bench",
+    )
+    failed = set(user_ids[::50])
+
+    def run():
+        request.route(recipients, flags)
+        return request.log_rows(user_ids, failed, "2026-01-01T00:00:00")
+    return run
+
+
+def bench_validate_email(size: int) -> Callable[[], object]:
+    emails = [u["email"].upper() if i % 3 else f" {u['email']} " for i, u in enumerate(customers(size))]
+    emails[::20] = ["not-an-email"] * len(emails[::20])
+
+    def run():
+        valid = 0
+        for email in emails:
+            try:
+                main.validate_email(email)
+                valid += 1
+            except HTTPException:
+                pass
+        return valid
+    return run
+
+
+def bench_csv_parse(size: int) -> Callable[[], object]:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=["name", "email", "phone", "city", "gender"], extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(customers(size))
+    text = out.getvalue()
+    return lambda: main.parse_users_csv(text, hash_fn=lambda password: password)
+
+
+def bench_session_lookup(size: int) -> Callable[[], object]:
+    main.active_sessions.clear()
+    headers = [f"Bearer {main.create_session(f'user-{i}', 4, f'user{i}@example.com')}" for i in range(size)]
+
+    def run():
+        for header in headers:
+            main.get_current_user(header)
+    return run
+
+
+BENCHMARKS: Dict[str, Callable[[int], Callable[[], object]]] = {
+    "eligibility": bench_eligibility,
+    "delivery_build": bench_delivery_build,
+    "validate_email": bench_validate_email,
+    "csv_parse": bench_csv_parse,
+    "session_lookup": bench_session_lookup,
+}
+
+
+def measure(fn: Callable[[], object], size: int, repeat: int) -> float:
+    """Items per second of the fastest run."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return size / best if best > 0 else float("inf")
+
+
+def run(names: List[str], sizes: List[int], repeat: int) -> Dict[str, float]:
+    results = {}
+    for name in names:
+        for size in sizes:
+            fn = BENCHMARKS[name](size)
+            results[f"{name}[{size}]"] = measure(fn, size, repeat)
+    return results
+
+
+def compare(
+    results: Dict[str, float], baseline: Dict[str, float], tolerance: float
+) -> Tuple[List[str], List[str], List[str]]:
+    lines, regressions, missing = [], [], []
+    for key, value in results.items():
+        base = baseline.get(key)
+        if base is None:
+            lines.append(f"{key:32} {value:14,.0f}/s  NO BASELINE")
+            missing.append(key)
+            continue
+        change = value / base - 1
+        flag = ""
+        if change < -tolerance:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        lines.append(f"{key:32} {value:14,.0f}/s  baseline {base:14,.0f}/s  {change:+7.1%}{flag}")
+    return lines, regressions, missing
+
+
+def main_cli():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="benchmarks to run (default: all)")
+    p.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES))
+    p.add_argument("--repeat", type=int, default=5, help="runs per benchmark; the fastest counts")
+    p.add_argument("--tolerance", type=float, default=0.15, help="allowed throughput drop, as a fraction")
+    p.add_argument("--baseline", default=BASELINE_PATH)
+    p.add_argument("--save", action="store_true", help="store these results as the baseline")
+    args = p.parse_args()
+
+    if not args.save and not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; record one on this machine with --save", file=sys.stderr)
+        return 2
+
+    results = run(args.only or list(BENCHMARKS), args.sizes, args.repeat)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f).get("results", {})
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.platform(),
+                "results": baseline,
+            }, f, indent=2, sort_keys=True)
+        for key, value in results.items():
+            print(f"{key:32} {value:14,.0f}/s")
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f).get("results", {})
+    lines, regressions, missing = compare(results, baseline, args.tolerance)
+    print("\n".join(lines))
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+    if missing:
+        print(f"{len(missing)} benchmark(s) without a baseline, record them with --save: {', '.join(missing)}")
+    return 1 if regressions or missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,334 @@
+"""Multi-channel dispatcher.
+
+Each channel (push, email, sms) has its own transport with a dedicated worker
+pool, batch size and rate limit, so a slow SMTP server never holds up
+websocket pushes. Within a transport the queue is ordered by priority lane
+(see websocket_manager.LANES), so order updates overtake a campaign
+backlog instead of queueing behind it. Channels are chosen per user from the `notification_type`
+flags: the global `email`/`sms`/`push` switch and the per-category ones
+(`campaign_email`, `newsletter_push`, `update_sms`, ...).
+"""
+import asyncio
+import itertools
+import logging
+import os
+import smtplib
+import time
+from collections import deque
+from email.message import EmailMessage
+from typing import Dict, Iterable, List, Optional
+
+from metrics import channel_messages, channel_queue_seconds
+from websocket_manager import LANES, lane_of, manager
+
+CHANNELS = ("push", "email", "sms")
+
+logger = logging.getLogger(__name__)
+
+# notification type -> prefix of the per-category channel flags
+CATEGORY_BY_TYPE = {
+    "CAMPAIGN": "campaign",
+    "NEWSLETTER": "newsletter",
+    "ORDER_UPDATE": "update",
+}
+
+
+def enabled_channels(notification_type: str, flags: Optional[dict]) -> set:
+    """Channels a user accepts for this notification type.
+
+    Only an explicit False disables a channel, so users without a
+    `notification_type` row keep getting pushes as before.
+    """
+    flags = flags or {}
+    category = CATEGORY_BY_TYPE.get(notification_type)
+    out = set()
+    for channel in CHANNELS:
+        if flags.get(channel) is False:
+            continue
+        if category and flags.get(f"{category}_{channel}") is False:
+            continue
+        out.add(channel)
+    return out
+
+
+def _env(name: str, key: str, default):
+    return type(default)(os.getenv(f"CHANNEL_{name.upper()}_{key}", default))
+
+
+class RateLimiter:
+    """Token bucket; a rate of 0 disables limiting."""
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = max(capacity, rate_per_second)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, n: int = 1):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                await asyncio.sleep((n - self.tokens) / self.rate)
+
+
+class Transport:
+    """Base transport: a queue drained by `workers` tasks in batches.
+
+    Subclasses implement `send_batch`, and may override `open`/`close` to
+    hold a per-worker resource such as an SMTP connection.
+    """
+
+    name = "base"
+
+    def __init__(self, workers: int = 4, batch_size: int = 50, rate_per_second: float = 0):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate_per_second, batch_size)
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.tasks: List[asyncio.Task] = []
+        # tie-breaker keeping FIFO order within a lane
+        self.sequence = itertools.count()
+
+    @classmethod
+    def from_env(cls, workers: int, batch_size: int, rate_per_second: float):
+        return cls(
+            workers=_env(cls.name, "WORKERS", workers),
+            batch_size=_env(cls.name, "BATCH_SIZE", batch_size),
+            rate_per_second=_env(cls.name, "RATE", float(rate_per_second)),
+        )
+
+    def start(self):
+        if self.tasks:
+            return
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        if not self.tasks:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Warning: {self.name} transport stopped with {self.queue.qsize()} messages unsent")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, recipient: dict, message: dict) -> asyncio.Future:
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        lane = lane_of(message)
+        self.queue.put_nowait((lane, next(self.sequence), time.perf_counter(), (recipient, message, future)))
+        return future
+
+    def _take(self, entry) -> tuple:
+        lane, _, queued, item = entry
+        channel_queue_seconds.observe(time.perf_counter() - queued, channel=self.name, lane=LANES[lane])
+        return item
+
+    async def open(self):
+        return None
+
+    async def close(self, state):
+        pass
+
+    async def send_batch(self, state, batch: List[tuple]) -> List[bool]:
+        raise NotImplementedError
+
+    async def _worker(self):
+        state = await self.open()
+        try:
+            while True:
+                batch = [self._take(await self.queue.get())]
+                while len(batch) < self.batch_size and not self.queue.empty():
+                    batch.append(self._take(self.queue.get_nowait()))
+
+                await self.limiter.acquire(len(batch))
+                try:
+                    results = await self.send_batch(state, batch)
+                except Exception as e:
+                    print(f"Warning: {self.name} transport failed a batch of {len(batch)}: {e}")
+                    results = [False] * len(batch)
+
+                sent = sum(1 for ok in results if ok)
+                channel_messages.inc(sent, channel=self.name, result="sent")
+                channel_messages.inc(len(batch) - sent, channel=self.name, result="failed")
+                for (_, _, future), ok in zip(batch, results):
+                    if not future.done():
+                        future.set_result(bool(ok))
+                for _ in batch:
+                    self.queue.task_done()
+        finally:
+            await self.close(state)
+
+
+class PushTransport(Transport):
+    name = "push"
+
+    async def send_batch(self, state, batch):
+        async def push(recipient, message):
+            try:
+                return await manager.send_to_user(str(recipient["user_id"]), message)
+            except Exception:
+                return False
+
+        return await asyncio.gather(*(push(r, m) for r, m, _ in batch))
+
+
+class EmailTransport(Transport):
+    """SMTP transport; every worker keeps one connection open and reuses it.
+
+    Point SMTP_HOST/SMTP_PORT at a local debug server (for example
+    `python -m aiosmtpd -n -l localhost:1025`) during development.
+    """
+
+    name = "email"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.host = os.getenv("SMTP_HOST", "localhost")
+        self.port = int(os.getenv("SMTP_PORT", "1025"))
+        self.username = os.getenv("SMTP_USER")
+        self.password = os.getenv("SMTP_PASSWORD")
+        self.starttls = os.getenv("SMTP_STARTTLS", "false").lower() == "true"
+        self.sender = os.getenv("SMTP_FROM", "notifications@localhost")
+        self.timeout = float(os.getenv("SMTP_TIMEOUT", "10"))
+
+    async def open(self):
+        # connections are opened lazily so a missing SMTP server doesn't stop startup
+        return {"conn": None}
+
+    async def close(self, state):
+        conn = state["conn"]
+        if conn is not None:
+            try:
+                await asyncio.to_thread(conn.quit)
+            except Exception:
+                pass
+
+    def _connect(self) -> smtplib.SMTP:
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            conn.starttls()
+        if self.username:
+            conn.login(self.username, self.password or "")
+        return conn
+
+    def _build(self, recipient: dict, message: dict) -> EmailMessage:
+        msg = EmailMessage()
+        msg["From"] = self.sender
+        msg["To"] = recipient["email"]
+        msg["Subject"] = message.get("title") or message.get("type", "Notification")
+        msg.set_content(message.get("content") or message.get("message") or "")
+        return msg
+
+    def _send_all(self, state, batch) -> List[bool]:
+        results = []
+        for recipient, message, _ in batch:
+            if not recipient.get("email"):
+                results.append(False)
+                continue
+            for attempt in range(2):
+                try:
+                    if state["conn"] is None:
+                        state["conn"] = self._connect()
+                    state["conn"].send_message(self._build(recipient, message))
+                    results.append(True)
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    # stale pooled connection: reconnect once
+                    state["conn"] = None
+                    if attempt:
+                        results.append(False)
+                except Exception:
+                    state["conn"] = None
+                    results.append(False)
+                    break
+        return results
+
+    async def send_batch(self, state, batch):
+        return await asyncio.to_thread(self._send_all, state, batch)
+
+
+class SmsTransport(Transport):
+    """Stub SMS transport: records sends instead of calling a provider.
+
+    The last SMS_STUB_OUTBOX messages are kept in `outbox` for inspection;
+    nothing about them is logged. SMS_STUB_LATENCY_MS simulates a slow
+    provider per batch.
+    """
+
+    name = "sms"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = float(os.getenv("SMS_STUB_LATENCY_MS", "0")) / 1000
+        self.outbox = deque(maxlen=int(os.getenv("SMS_STUB_OUTBOX", "1000")))
+
+    async def send_batch(self, state, batch):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        results = []
+        for recipient, message, _ in batch:
+            phone = recipient.get("phone")
+            if not phone:
+                results.append(False)
+                continue
+            text = message.get("title") or message.get("message") or message.get("type")
+            self.outbox.append((phone, text))
+            results.append(True)
+        logger.debug("SMS stub accepted %d of %d messages", sum(results), len(batch))
+        return results
+
+
+class ChannelDispatcher:
+    def __init__(self, transports: Iterable[Transport] = ()):
+        self.transports: Dict[str, Transport] = {}
+        # in-flight send_background tasks; the loop only keeps weak references
+        self.background: set = set()
+        for transport in transports:
+            self.register(transport)
+
+    def register(self, transport: Transport):
+        self.transports[transport.name] = transport
+
+    def start(self):
+        for transport in self.transports.values():
+            transport.start()
+
+    async def stop(self):
+        await asyncio.gather(*(t.stop() for t in self.transports.values()))
+        # anything still waiting was left unsent by a transport that timed out
+        for task in list(self.background):
+            task.cancel()
+
+    async def send(self, channel: str, recipients: List[dict], message: dict) -> List[bool]:
+        """Send through one channel and wait for every result."""
+        transport = self.transports.get(channel)
+        if transport is None:
+            return [False] * len(recipients)
+        futures = [transport.submit(r, message) for r in recipients]
+        return list(await asyncio.gather(*futures))
+
+    def send_background(self, channel: str, recipients: List[dict], message: dict) -> asyncio.Task:
+        """Hand recipients to a channel without waiting; the task's result is `send`'s."""
+        task = asyncio.create_task(self.send(channel, recipients, message))
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        return task
+
+
+dispatcher = ChannelDispatcher([
+    PushTransport.from_env(workers=8, batch_size=200, rate_per_second=0),
+    EmailTransport.from_env(workers=4, batch_size=20, rate_per_second=50),
+    SmsTransport.from_env(workers=2, batch_size=50, rate_per_second=20),
+])
@@ -0,0 +1,231 @@
+"""Synthetic data generator for the local SQLite backend.
+
+Scales the `users.csv` shape (name, email, phone, city, gender) to millions of
+customers by recombining its first names, surnames and cities, and fills in
+preferences, channel flags, orders, notification logs, queued notifications,
+campaigns and newsletters around them. Output is deterministic for a given
+--seed, and rows are written in executemany batches, so a few million users
+take minutes on one machine.
+
+Usage:
+  python datagen.py --db perf.db --users 2000000
+  python datagen.py --db perf.db --users 100000 --orders 2 --logs 10 --pending 0.2
+Then run the API against it with DATA_BACKEND=local LOCAL_DB_PATH=perf.db.
+"""
+import argparse
+import csv
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
+
+from local_backend import LocalClient
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXTRA_CITIES = ["Mumbai", "Delhi", "Bengaluru", "Hyderabad", "Ahmedabad", "Jaipur", "Lucknow", "Indore"]
+LOG_TYPES = ["CAMPAIGN", "NEWSLETTER", "ORDER_UPDATE"]
+LOG_STATUSES = ["SUCCESS"] * 8 + ["PENDING", "FAILED"]
+ORDER_STATUSES = ["PLACED", "UPDATE_REQUESTED", "SENT"]
+
+
+def load_templates(path: str = os.path.join(HERE, "users.csv")) -> dict:
+    """Name parts, cities and genders to recombine, taken from a users.csv-style file."""
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    first, last = set(), set()
+    for row in rows:
+        parts = row["name"].split()
+        first.add(parts[0])
+        last.add(parts[-1])
+    return {
+        "first": sorted(first),
+        "last": sorted(last),
+        "cities": sorted({r["city"] for r in rows if r.get("city")} | set(EXTRA_CITIES)),
+        "genders": sorted({r["gender"] for r in rows if r.get("gender")}),
+    }
+
+
+def user_id_for(i: int, prefix: str = "datagen") -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{prefix}-user-{i}"))
+
+
+class Generator:
+    def __init__(
+        self,
+        client,
+        seed: int = 0,
+        batch_size: int = 5000,
+        opt_in: float = 0.9,
+        active: float = 0.97,
+        channels: Optional[dict] = None,
+        prefix: str = "datagen",
+    ):
+        self.client = client
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        # share of users opted into each preference
+        self.opt_in = opt_in
+        self.active = active
+        # fixed channel flags for every user; random when None
+        self.channels = channels
+        self.prefix = prefix
+        self.templates = load_templates()
+        self.now = datetime.utcnow()
+
+    def _timestamp(self, days: int = 365) -> str:
+        return (self.now - timedelta(seconds=self.random.randrange(days * 86400))).isoformat()
+
+    def _batches(self, total: int) -> Iterator[range]:
+        for start in range(0, total, self.batch_size):
+            yield range(start, min(start + self.batch_size, total))
+
+    def _insert(self, table: str, rows: List[dict]):
+        if rows:
+            self.client.table(table).insert(rows).execute()
+
+    def user(self, i: int) -> dict:
+        t, r = self.templates, self.random
+        first = t["first"][i % len(t["first"])]
+        last = t["last"][(i // len(t["first"])) % len(t["last"])]
+        return {
+            "user_id": user_id_for(i, self.prefix),
+            "name": f"{first} {last}",
+            "email": f"{first.lower()}.{last.lower()}.{i}@example.com",
+            "phone": f"9{r.randrange(10 ** 9):09d}",
+            "city": r.choice(t["cities"]),
+            "gender": r.choice(t["genders"]),
+            # not a bcrypt hash: generated customers are never logged in as
+            "password": "x",
+            "is_active": r.random() < self.active,
+            "role_id": 4,
+            "created_at": self._timestamp(),
+        }
+
+    def users(self, total: int) -> List[str]:
+        """Insert `total` customers with preferences and channel flags; returns their ids."""
+        ids = []
+        for batch in self._batches(total):
+            users, prefs, types = [], [], []
+            for i in batch:
+                row = self.user(i)
+                users.append(row)
+                ids.append(row["user_id"])
+                prefs.append({
+                    "user_id": row["user_id"],
+                    "offers": self.random.random() < self.opt_in,
+                    "order_updates": self.random.random() < self.opt_in,
+                    "newsletter": self.random.random() < self.opt_in,
+                })
+                flags = self.channels or {
+                    "push": True,
+                    "email": self.random.random() < 0.5,
+                    "sms": self.random.random() < 0.2,
+                }
+                types.append({"user_id": row["user_id"], **flags})
+            self._insert("users", users)
+            self._insert("user_preferences", prefs)
+            self._insert("notification_type", types)
+        return ids
+
+    def per_user(self, table: str, user_ids: List[str], count: float, make):
+        """`count` rows per user on average (fractions pick a random share of users)."""
+        rows = []
+        for user_id in user_ids:
+            n = int(count) + (self.random.random() < count % 1)
+            for _ in range(n):
+                rows.append(make(user_id))
+            if len(rows) >= self.batch_size:
+                self._insert(table, rows)
+                rows = []
+        self._insert(table, rows)
+
+    def orders(self, user_ids: List[str], per_user: float):
+        self.per_user("orders", user_ids, per_user, lambda user_id: {
+            "user_id": user_id,
+            "order_name": f"Order {self.random.randrange(10 ** 6)}",
+            "status": self.random.choice(ORDER_STATUSES),
+            "created_at": self._timestamp(),
+        })
+
+    def logs(self, user_ids: List[str], per_user: float):
+        self.per_user("notification_logs", user_ids, per_user, lambda user_id: {
+            "user_id": user_id,
+            "notification_type": self.random.choice(LOG_TYPES),
+            "status": self.random.choice(LOG_STATUSES),
+            "sent_at": self._timestamp(),
+        })
+
+    def pending(self, user_ids: List[str], per_user: float):
+        def make(user_id):
+            kind = self.random.choice(LOG_TYPES)
+            return {
+                "user_id": user_id,
+                "payload": {"type": kind, "title": f"Queued {kind.lower()}", "content": "Queued while offline"},
+                "created_at": self._timestamp(days=7),
+            }
+        self.per_user("pending_notifications", user_ids, per_user, make)
+
+    def admin(self, email: str, password_hash: str, name: str = "Admin") -> str:
+        user_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{self.prefix}-admin-{email}"))
+        self._insert("users", [{
+            "user_id": user_id,
+            "name": name,
+            "email": email,
+            "password": password_hash,
+            "is_active": True,
+            "role_id": 1,
+        }])
+        return user_id
+
+    def campaigns(self, count: int, created_by: Optional[str] = None, content_words: int = 20) -> List[str]:
+        rows = [{
+            "campaign_name": f"Campaign {i}",
+            "city_filter": None,
+            "content": "Campaign body " * content_words,
+            "created_by": created_by,
+            "status": "DRAFT",
+        } for i in range(count)]
+        return [r["campaign_id"] for r in self.client.table("campaigns").insert(rows).execute().data] if rows else []
+
+    def newsletters(self, count: int, created_by: Optional[str] = None, content_words: int = 200) -> List[str]:
+        rows = [{
+            "news_name": f"Newsletter {i}",
+            "city_filter": None,
+            "content": "Newsletter body " * content_words,
+            "created_by": created_by,
+            "status": "DRAFT",
+        } for i in range(count)]
+        return [r["newsletter_id"] for r in self.client.table("newsletters").insert(rows).execute().data] if rows else []
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--db", required=True, help="SQLite file to create or extend")
+    p.add_argument("--users", type=int, default=100000)
+    p.add_argument("--orders", type=float, default=1.0, help="orders per user")
+    p.add_argument("--logs", type=float, default=5.0, help="notification_logs rows per user")
+    p.add_argument("--pending", type=float, default=0.1, help="queued notifications per user")
+    p.add_argument("--campaigns", type=int, default=5)
+    p.add_argument("--newsletters", type=int, default=5)
+    p.add_argument("--opt-in", type=float, default=0.9, help="share of users opted into each preference")
+    p.add_argument("--batch-size", type=int, default=5000)
+    p.add_argument("--seed", type=int, default=0)
+    args = p.parse_args()
+
+    gen = Generator(LocalClient(args.db), seed=args.seed, batch_size=args.batch_size, opt_in=args.opt_in)
+    started = time.perf_counter()
+    user_ids = gen.users(args.users)
+    print(f"users: {len(user_ids)} ({time.perf_counter() - started:.1f}s)")
+    for name, per_user in (("orders", args.orders), ("logs", args.logs), ("pending", args.pending)):
+        step = time.perf_counter()
+        getattr(gen, name)(user_ids, per_user)
+        print(f"{name}: {per_user}/user ({time.perf_counter() - step:.1f}s)")
+    gen.campaigns(args.campaigns)
+    gen.newsletters(args.newsletters)
+    print(f"done in {time.perf_counter() - started:.1f}s -> {args.db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Instrumentation for Supabase queries.
+
+`InstrumentedClient` wraps the client so every `.execute()` records its
+table, operation, row count and duration. Records are attributed to the
+current HTTP request through a context variable; `QueryBudgetMiddleware`
+reports them in a `Server-Timing` header and writes a structured
+slow-request log entry when a request exceeds the query-count or DB-time
+budget or repeats the same query shape (a likely N+1).
+
+Each request also carries an identity map: repository reads decorated with
+`memoized` are served from it when the same row is read again within the
+request, and every hit is counted as a saved round trip. Callers get their
+own copy of a memoized result, so mutating it never changes later reads.
+"""
+import copy
+import json
+import logging
+import os
+import functools
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from metrics import registry
+
+DB_QUERY_BUDGET = int(os.getenv("DB_QUERY_BUDGET", "50"))
+DB_TIME_BUDGET_MS = float(os.getenv("DB_TIME_BUDGET_MS", "500"))
+# the same table+operation this many times in one request is reported as N+1
+DB_REPEAT_THRESHOLD = int(os.getenv("DB_REPEAT_THRESHOLD", "10"))
+DB_REQUEST_MEMO = os.getenv("DB_REQUEST_MEMO", "true").lower() in ("1", "true", "yes")
+
+OPERATIONS = ("select", "insert", "update", "upsert", "delete", "rpc")
+
+slow_request_log = logging.getLogger("slow_requests")
+
+db_query_duration = registry.histogram(
+    "db_query_duration_seconds", "Supabase query latency", ("table", "operation")
+)
+db_query_rows = registry.counter(
+    "db_query_rows_total", "Rows returned or written by Supabase queries", ("table", "operation")
+)
+db_budget_exceeded = registry.counter(
+    "db_budget_exceeded_total", "Requests over the query-count or DB-time budget", ("reason",)
+)
+db_round_trips_saved = registry.counter(
+    "db_round_trips_saved_total", "Reads served from the per-request identity map", ("table",)
+)
+
+
+class RequestQueries:
+    """Queries issued on behalf of one request."""
+
+    def __init__(self):
+        self.records: List[tuple] = []
+        # (table, method, args) -> result of a memoized read
+        self.memo: Dict[tuple, object] = {}
+        self.saved = 0
+
+    def add(self, table: str, operation: str, rows: int, seconds: float, error: bool):
+        self.records.append((table, operation, rows, seconds, error))
+
+    def forget(self, table: str):
+        """Drop memoized reads of `table` after a write to it."""
+        for key in [k for k in self.memo if k[0] == table]:
+            del self.memo[key]
+
+    @property
+    def count(self) -> int:
+        return len(self.records)
+
+    @property
+    def seconds(self) -> float:
+        return sum(r[3] for r in self.records)
+
+    def summary(self) -> dict:
+        by_shape = {}
+        for table, operation, rows, seconds, error in self.records:
+            entry = by_shape.setdefault(f"{table}.{operation}", {"count": 0, "rows": 0, "ms": 0.0, "errors": 0})
+            entry["count"] += 1
+            entry["rows"] += rows
+            entry["ms"] += seconds * 1000
+            entry["errors"] += int(error)
+        for entry in by_shape.values():
+            entry["ms"] = round(entry["ms"], 2)
+        return by_shape
+
+
+_current: ContextVar[Optional[RequestQueries]] = ContextVar("request_queries", default=None)
+
+
+def current_queries() -> Optional[RequestQueries]:
+    return _current.get()
+
+
+def detach_request():
+    """Stop attributing queries to the request that spawned this task.
+
+    Background tasks inherit the request's context; call this at the top of
+    work that outlives the request.
+    """
+    _current.set(None)
+
+
+def memoized(method):
+    """Serve repeated calls with the same arguments within one request from memory.
+
+    For repository reads; `self.table` scopes the entries so writes can drop them.
+    Outside a request (background jobs) every call goes to the database.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        queries = _current.get()
+        if queries is None or not DB_REQUEST_MEMO:
+            return method(self, *args, **kwargs)
+        key = (self.table, method.__name__, args, tuple(sorted(kwargs.items())))
+        if key in queries.memo:
+            queries.saved += 1
+            db_round_trips_saved.inc(table=self.table)
+            return copy.deepcopy(queries.memo[key])
+        result = method(self, *args, **kwargs)
+        queries.memo[key] = copy.deepcopy(result)
+        return result
+
+    return wrapper
+
+
+def forget(table: str):
+    queries = _current.get()
+    if queries is not None:
+        queries.forget(table)
+
+
+def _row_count(data) -> int:
+    if isinstance(data, list):
+        return len(data)
+    return 1 if data else 0
+
+
+class _QueryProxy:
+    __slots__ = ("_builder", "_table", "_operation")
+
+    def __init__(self, builder, table: str, operation: Optional[str]):
+        self._builder = builder
+        self._table = table
+        self._operation = operation
+
+    def __getattr__(self, name):
+        if name == "execute":
+            return self._execute
+        attr = getattr(self._builder, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            operation = self._operation or (name if name in OPERATIONS else None)
+            return _QueryProxy(attr(*args, **kwargs), self._table, operation)
+
+        return call
+
+    def _execute(self, *args, **kwargs):
+        operation = self._operation or "select"
+        started = time.perf_counter()
+        res = None
+        try:
+            res = self._builder.execute(*args, **kwargs)
+            return res
+        finally:
+            seconds = time.perf_counter() - started
+            rows = _row_count(getattr(res, "data", None))
+            db_query_duration.observe(seconds, table=self._table, operation=operation)
+            db_query_rows.inc(rows, table=self._table, operation=operation)
+            queries = _current.get()
+            if queries is not None:
+                queries.add(self._table, operation, rows, seconds, res is None)
+
+
+class InstrumentedClient:
+    """Drop-in wrapper around a supabase `Client`."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name: str):
+        return _QueryProxy(self._client.table(name), name, None)
+
+    def from_(self, name: str):
+        return self.table(name)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class QueryBudgetMiddleware:
+    """Pure ASGI middleware attributing queries to requests and enforcing budgets."""
+
+    def __init__(self, app, query_budget: int = DB_QUERY_BUDGET, time_budget_ms: float = DB_TIME_BUDGET_MS):
+        self.app = app
+        self.query_budget = query_budget
+        self.time_budget_ms = time_budget_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        queries = RequestQueries()
+        token = _current.set(queries)
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and queries.count:
+                timing = f'db;dur={queries.seconds * 1000:.1f};desc="{queries.count} queries"'
+                if queries.saved:
+                    timing += f', memo;desc="{queries.saved} round trips saved"'
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            self._report(scope, queries, time.perf_counter() - started)
+
+    def _report(self, scope, queries: RequestQueries, seconds: float):
+        db_ms = queries.seconds * 1000
+        summary = queries.summary()
+        reasons = []
+        if queries.count > self.query_budget:
+            reasons.append("query_count")
+        if db_ms > self.time_budget_ms:
+            reasons.append("db_time")
+        repeated = sorted(shape for shape, s in summary.items() if s["count"] >= DB_REPEAT_THRESHOLD)
+        if repeated:
+            reasons.append("repeated_queries")
+        if not reasons:
+            return
+
+        for reason in reasons:
+            db_budget_exceeded.inc(reason=reason)
+        slow_request_log.warning(json.dumps({
+            "event": "slow_request",
+            "method": scope["method"],
+            "path": scope["path"],
+            "reasons": reasons,
+            "query_count": queries.count,
+            "query_budget": self.query_budget,
+            "db_ms": round(db_ms, 2),
+            "db_time_budget_ms": self.time_budget_ms,
+            "total_ms": round(seconds * 1000, 2),
+            "round_trips_saved": queries.saved,
+            "repeated": repeated,
+            "queries": summary,
+        }))
@@ -0,0 +1,508 @@
+"""Staged delivery pipeline shared by campaign, newsletter and test sends.
+
+Every send goes through the same stages:
+
+    resolve -> build -> deliver -> queue -> log
+
+Each stage batches its I/O, runs with its own concurrency limit and records
+timing/throughput so the endpoints only describe *what* to send.
+
+Push is awaited per page because undelivered pushes are queued. Email and
+SMS drain on their own transports; a page's log rows, counts and checkpoint
+are written once its email/SMS results are in ("settling"), while up to
+DELIVERY_SETTLE_DEPTH later pages keep pushing.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from channels import CHANNELS, dispatcher, enabled_channels
+from funnels import funnels
+from http_pool import SUPABASE_BULK_TIMEOUT, call_timeout
+from log_sink import log_sink
+from metrics import delivery_recipients, delivery_stage_items, delivery_stage_seconds
+from repositories import chunked, repos
+from templates import Personalization
+
+WRITE_CONCURRENCY = int(os.getenv("DELIVERY_WRITE_CONCURRENCY", "4"))
+QUEUE_BATCH_SIZE = int(os.getenv("DELIVERY_QUEUE_BATCH_SIZE", "500"))
+LOG_BATCH_SIZE = int(os.getenv("DELIVERY_LOG_BATCH_SIZE", "1000"))
+LOOKUP_BATCH_SIZE = int(os.getenv("DELIVERY_LOOKUP_BATCH_SIZE", "500"))
+PAGE_SIZE = int(os.getenv("DELIVERY_PAGE_SIZE", "2000"))
+# pages whose email/SMS results may be outstanding while later pages push
+SETTLE_DEPTH = int(os.getenv("DELIVERY_SETTLE_DEPTH", "4"))
+
+logger = logging.getLogger(__name__)
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.seconds = 0.0
+
+    def add(self, items: int, seconds: float):
+        self.items += items
+        self.seconds += seconds
+        delivery_stage_items.inc(items, stage=self.name)
+        delivery_stage_seconds.inc(seconds, stage=self.name)
+
+    def as_dict(self) -> dict:
+        per_second = self.items / self.seconds if self.seconds > 0 else None
+        return {
+            "items": self.items,
+            "seconds": round(self.seconds, 4),
+            "per_second": round(per_second, 1) if per_second is not None else None,
+        }
+
+
+class DeliveryRequest:
+    """Describes one send: what to deliver and to whom.
+
+    `resolve(after, limit)` is a blocking callable returning one page of
+    recipient dicts (at least `user_id`) and the cursor of the next page, or
+    None on the last page; it runs in a worker thread. `send_at` is the time
+    a scheduled send was due and queued payloads carry it; holding a send
+    until then is the job's business (see jobs.py), the pipeline always
+    sends right away. `channels` limits the send to a subset of channels;
+    by default each user's `notification_type` flags decide. With a `key` (the job id) row ids are
+    derived from it and writes become upserts, so replaying a page after a
+    crash does not duplicate pending rows or logs.
+
+    `ref` is the campaign or newsletter id: log rows carry it and the
+    send's counts go to its delivery funnel (see funnels.py). A keyed send
+    also takes `funnel_base`, the ref's funnel counts from before the job
+    started; the funnel is reset to those plus the checkpointed totals, so
+    pages replayed after a restart don't count twice and earlier sends of
+    the same ref keep theirs.
+
+    Queued recipients do not get their own copy of the payload: the first
+    page that queues anyone stores it once in notification_messages and the
+    pending rows reference it by `message_id`.
+
+    The payload's title and content may hold placeholders (see
+    templates.py). Recipients are then split into groups that render the
+    same text, and each group is sent, queued and stored as one message.
+    """
+
+    def __init__(
+        self,
+        notification_type: str,
+        payload: dict,
+        resolve: Callable[[Optional[str], int], Tuple[List[dict], Optional[str]]],
+        send_at: Optional[datetime] = None,
+        channels: Optional[tuple] = None,
+        key: Optional[str] = None,
+        ref: Optional[str] = None,
+        funnel_base: Optional[dict] = None,
+    ):
+        self.notification_type = notification_type
+        self.payload = payload
+        self.resolve = resolve
+        self.send_at = send_at
+        self.channels = channels
+        self.key = key
+        self.ref = ref
+        self.funnel_base = funnel_base
+        self.message_id = self.row_id("message", "")
+        # shared bodies already in notification_messages
+        self.stored_messages: set = set()
+        self.personalization = Personalization(payload)
+
+    def body_id(self, variant: Optional[str]) -> str:
+        """notification_messages id of the static payload or of one rendered variant."""
+        if variant is None:
+            return self.message_id
+        return str(uuid.uuid5(uuid.UUID(self.message_id), variant))
+
+    def row_id(self, kind: str, user_id: str) -> str:
+        if self.key is None:
+            return str(uuid.uuid4())
+        return str(uuid.uuid5(uuid.UUID(self.key), f"{kind}:{user_id}"))
+
+    def route(self, recipients: List[dict], flags: Dict[str, dict]) -> Dict[str, List[dict]]:
+        """Recipients per channel, from `channels` or each user's flags."""
+        by_channel: Dict[str, List[dict]] = {channel: [] for channel in CHANNELS}
+        for recipient in recipients:
+            if self.channels is not None:
+                channels = self.channels
+            else:
+                channels = enabled_channels(self.notification_type, flags.get(str(recipient["user_id"])))
+            for channel in channels:
+                if channel == "email" and not recipient.get("email"):
+                    continue
+                if channel == "sms" and not recipient.get("phone"):
+                    continue
+                by_channel[channel].append(recipient)
+        return by_channel
+
+    def log_rows(
+        self,
+        user_ids: List[str],
+        failed_ids: set,
+        sent_at: str,
+        reached: Optional[Dict[str, List[str]]] = None,
+        skipped_ids: Optional[set] = None,
+    ) -> List[dict]:
+        """One row per recipient; `reached` maps user_id -> channels that delivered to them.
+
+        Recipients with no enabled channel (`skipped_ids`) are logged SKIPPED.
+        """
+        reached = reached or {}
+        skipped_ids = skipped_ids or set()
+        rows = []
+        for uid in user_ids:
+            channels = reached.get(uid)
+            if uid in failed_ids:
+                status = "FAILED"
+            elif uid in skipped_ids:
+                status = "SKIPPED"
+            else:
+                status = "SUCCESS"
+            rows.append({
+                "log_id": self.row_id("log", uid),
+                "user_id": uid,
+                "notification_type": self.notification_type,
+                "status": status,
+                "sent_at": sent_at,
+                "message_id": self.message_id,
+                "ref": self.ref,
+                "channels": ",".join(channels) if channels else None,
+            })
+        return rows
+
+
+class PageOutcome:
+    """What a page's push and queue stages leave for it to settle."""
+
+    def __init__(self, user_ids: List[str], sent_at: str):
+        self.user_ids = user_ids
+        self.sent_at = sent_at
+        self.reached: Dict[str, List[str]] = {}
+        self.queued_ids: set = set()
+        self.failed_ids: set = set()
+        # routed to no channel at all
+        self.skipped_ids: set = set()
+        # (channel, recipients, message) for email/SMS, and their send tasks once started
+        self.sends: List[Tuple[str, List[dict], dict]] = []
+        self.tasks: List[asyncio.Task] = []
+
+
+class DeliveryResult:
+    def __init__(self):
+        self.recipients = 0
+        self.processed = 0
+        self.delivered = 0
+        self.queued = 0
+        self.failed = 0
+        self.skipped = 0
+        self.channels: Dict[str, dict] = {channel: {"sent": 0, "failed": 0} for channel in CHANNELS}
+        self.stages: Dict[str, StageStats] = {
+            name: StageStats(name) for name in ("resolve", "build", "deliver", "queue", "log")
+        }
+
+    @classmethod
+    def from_progress(cls, progress: Optional[dict]) -> "DeliveryResult":
+        """Rebuild counters from a checkpoint so a resumed send keeps its totals."""
+        result = cls()
+        for key, value in (progress or {}).items():
+            if hasattr(result, key):
+                setattr(result, key, value)
+        return result
+
+    def progress(self) -> dict:
+        return {
+            "recipients": self.recipients,
+            "processed": self.processed,
+            "delivered": self.delivered,
+            "queued": self.queued,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "channels": self.channels,
+        }
+
+    def as_dict(self) -> dict:
+        return {
+            "sent_to": self.recipients,
+            "success_count": self.delivered,
+            "queued_count": self.queued,
+            "failed_count": self.failed,
+            "skipped_count": self.skipped,
+            "channels": self.channels,
+            "stages": {name: s.as_dict() for name, s in self.stages.items()},
+        }
+
+
+class DeliveryPipeline:
+    def __init__(
+        self,
+        write_concurrency: int = WRITE_CONCURRENCY,
+        queue_batch_size: int = QUEUE_BATCH_SIZE,
+        log_batch_size: int = LOG_BATCH_SIZE,
+        page_size: int = PAGE_SIZE,
+        settle_depth: int = SETTLE_DEPTH,
+    ):
+        self.page_size = page_size
+        self.settle_depth = max(settle_depth, 1)
+        self.write_concurrency = write_concurrency
+        self.queue_batch_size = queue_batch_size
+        self.log_batch_size = log_batch_size
+
+    async def run(
+        self,
+        request: DeliveryRequest,
+        on_progress: Optional[Callable[[dict, Optional[str]], Awaitable[None]]] = None,
+        cursor: Optional[str] = None,
+        result: Optional[DeliveryResult] = None,
+    ) -> DeliveryResult:
+        """Run a send page by page, starting after `cursor`.
+
+        `on_progress(progress, cursor)` is awaited once a page is fully
+        settled, in page order, so the cursor it receives is safe to resume from.
+        """
+        result = result or DeliveryResult()
+        settling: List[asyncio.Task] = []
+        if request.key is not None and request.funnel_base is not None:
+            # pages replayed after a restart must not count twice
+            base = request.funnel_base
+            funnels.reset(
+                request.ref,
+                request.notification_type.lower(),
+                targeted=base.get("targeted", 0) + result.processed,
+                delivered=base.get("delivered", 0) + result.delivered,
+                queued=base.get("queued", 0) + result.queued,
+                failed=base.get("failed", 0) + result.failed,
+            )
+
+        try:
+            while True:
+                started = time.perf_counter()
+                page, next_cursor = await asyncio.to_thread(request.resolve, cursor, self.page_size)
+                flags = {}
+                if page and request.channels is None:
+                    flags = await self._load_channel_flags([str(r["user_id"]) for r in page])
+                result.stages["resolve"].add(len(page), time.perf_counter() - started)
+                result.recipients += len(page)
+
+                outcome = await self._process(request, page, flags, result) if page else None
+                cursor = next_cursor
+                previous = settling[-1] if settling else None
+                settling.append(asyncio.create_task(
+                    self._settle(request, outcome, result, previous, on_progress, cursor)
+                ))
+                if len(settling) > self.settle_depth:
+                    await settling.pop(0)
+                if cursor is None:
+                    break
+            # each settle waits for the one before it
+            await settling[-1]
+        finally:
+            for task in settling:
+                task.cancel()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            summary = ", ".join(f"{name}={s.items}/{s.seconds:.3f}s" for name, s in result.stages.items())
+            logger.debug("Delivery %s: %s", request.notification_type, summary)
+        return result
+
+    async def _process(
+        self, request: DeliveryRequest, recipients: List[dict], flags: Dict[str, dict], result: DeliveryResult
+    ) -> PageOutcome:
+        """Push and queue one page; email/SMS start here and are collected by `_settle`."""
+        now = datetime.utcnow().isoformat()
+        send_at = (request.send_at or datetime.utcnow()).isoformat()
+        user_ids = [str(r["user_id"]) for r in recipients]
+        outcome = PageOutcome(user_ids, send_at)
+
+        # build: one message per distinct rendering (just one unless personalized),
+        # shared by all its recipients so the frame cache encodes it once
+        started = time.perf_counter()
+        groups = []
+        for payload, members, variant in request.personalization.groups(recipients):
+            # msg_id lets ack-enabled clients confirm receipt (see acks.py); log rows carry it too
+            message = {**payload, "msg_id": request.message_id}
+            queued_payload = {**message, "send_at": send_at} if request.send_at else message
+            groups.append((message, queued_payload, variant, request.route(members, flags)))
+        routed = set()
+        for *_, by_channel in groups:
+            for targets in by_channel.values():
+                routed.update(str(r["user_id"]) for r in targets)
+        outcome.skipped_ids = set(user_ids) - routed
+        result.stages["build"].add(len(user_ids), time.perf_counter() - started)
+
+        # deliver: push is awaited because undelivered pushes are queued;
+        # other channels drain on their own workers and are collected by _settle
+        for message, _, _, by_channel in groups:
+            for channel, targets in by_channel.items():
+                if channel != "push" and targets:
+                    outcome.sends.append((channel, targets, message))
+        outcome.tasks = [dispatcher.send_background(*send) for send in outcome.sends]
+        started = time.perf_counter()
+        pushed = await asyncio.gather(*(
+            dispatcher.send("push", by_channel["push"], message) for message, _, _, by_channel in groups
+        ))
+        ok_ids = set()
+        for (message, _, _, by_channel), results in zip(groups, pushed):
+            ok_ids.update(str(r["user_id"]) for r, ok in zip(by_channel["push"], results) if ok)
+        result.stages["deliver"].add(sum(len(g[3]["push"]) for g in groups), time.perf_counter() - started)
+        for uid in ok_ids:
+            outcome.reached[uid] = ["push"]
+        push_targets = sum(len(by_channel["push"]) for _, _, _, by_channel in groups)
+        result.channels["push"]["sent"] += len(ok_ids)
+        result.channels["push"]["failed"] += push_targets - len(ok_ids)
+
+        # queue
+        started = time.perf_counter()
+        pending_rows = []
+        for _, queued_payload, variant, by_channel in groups:
+            to_queue = [str(r["user_id"]) for r in by_channel["push"] if str(r["user_id"]) not in ok_ids]
+            if not to_queue:
+                continue
+            body = await self._queued_body(request, queued_payload, variant)
+            pending_rows.extend(
+                {
+                    "id": request.row_id("pending", uid),
+                    "user_id": uid,
+                    **body,
+                    "created_at": now,
+                }
+                for uid in to_queue
+            )
+        outcome.failed_ids = await self._write(
+            repos.pending, pending_rows, self.queue_batch_size, upsert=request.key is not None
+        )
+        outcome.queued_ids = {row["user_id"] for row in pending_rows} - outcome.failed_ids
+        result.stages["queue"].add(len(pending_rows), time.perf_counter() - started)
+        return outcome
+
+    async def _settle(
+        self,
+        request: DeliveryRequest,
+        outcome: Optional[PageOutcome],
+        result: DeliveryResult,
+        previous: Optional[asyncio.Task],
+        on_progress: Optional[Callable[[dict, Optional[str]], Awaitable[None]]],
+        cursor: Optional[str],
+    ):
+        """Collect a page's email/SMS results, then count, log and checkpoint it after the page before."""
+        if outcome is not None:
+            started = time.perf_counter()
+            sent = await asyncio.gather(*outcome.tasks)
+            if outcome.sends:
+                result.stages["deliver"].add(sum(len(s[1]) for s in outcome.sends), time.perf_counter() - started)
+            attempted = set()
+            for (channel, targets, _), results in zip(outcome.sends, sent):
+                for recipient, ok in zip(targets, results):
+                    uid = str(recipient["user_id"])
+                    attempted.add(uid)
+                    if ok:
+                        outcome.reached.setdefault(uid, []).append(channel)
+                ok_count = sum(1 for ok in results if ok)
+                result.channels[channel]["sent"] += ok_count
+                result.channels[channel]["failed"] += len(targets) - ok_count
+            # reached on no channel and nothing queued for later
+            outcome.failed_ids |= attempted - set(outcome.reached) - outcome.queued_ids
+        if previous is not None:
+            await previous
+        if outcome is not None:
+            self._count(request, outcome, result)
+            # log
+            started = time.perf_counter()
+            log_rows = request.log_rows(
+                outcome.user_ids, outcome.failed_ids, outcome.sent_at, outcome.reached, outcome.skipped_ids
+            )
+            if request.key is not None:
+                # job sends checkpoint after this page, so its logs must be durable first
+                await self._write(repos.logs, log_rows, self.log_batch_size, upsert=True)
+            else:
+                log_sink.write_many(log_rows)
+            result.stages["log"].add(len(log_rows), time.perf_counter() - started)
+            result.processed += len(outcome.user_ids)
+        if on_progress:
+            await on_progress(result.progress(), cursor)
+
+    def _count(self, request: DeliveryRequest, outcome: PageOutcome, result: DeliveryResult):
+        delivered = len(outcome.reached)
+        queued = len(outcome.queued_ids)
+        failed = len(outcome.failed_ids)
+        skipped = len(outcome.skipped_ids)
+        result.delivered += delivered
+        result.queued += queued
+        result.failed += failed
+        result.skipped += skipped
+        kind = request.notification_type
+        delivery_recipients.inc(delivered, type=kind, outcome="delivered")
+        delivery_recipients.inc(queued, type=kind, outcome="queued")
+        delivery_recipients.inc(failed, type=kind, outcome="failed")
+        delivery_recipients.inc(skipped, type=kind, outcome="skipped")
+        funnels.add(
+            request.ref,
+            kind.lower(),
+            targeted=len(outcome.user_ids),
+            delivered=delivered,
+            queued=queued,
+            failed=failed,
+        )
+
+    async def _queued_body(self, request: DeliveryRequest, payload: dict, variant: Optional[str]) -> dict:
+        """Pending row body: a reference to the shared message, or the payload inline if storing it failed."""
+        message_id = request.body_id(variant)
+        if message_id not in request.stored_messages:
+            if not await self._store_message(request, message_id, payload):
+                return {"payload": payload}
+            request.stored_messages.add(message_id)
+        return {"message_id": message_id}
+
+    async def _store_message(self, request: DeliveryRequest, message_id: str, payload: dict) -> bool:
+        """Write a shared body once per send; on failure rows carry the payload inline."""
+        try:
+            await asyncio.to_thread(repos.messages.upsert, {"message_id": message_id, "payload": payload})
+            return True
+        except Exception:
+            print(f"Warning: failed to store shared message for {request.notification_type}, queuing inline payloads")
+            return False
+
+    async def _load_channel_flags(self, user_ids: List[str]) -> Dict[str, dict]:
+        sem = asyncio.Semaphore(self.write_concurrency)
+        flags: Dict[str, dict] = {}
+
+        async def load(batch: List[str]):
+            async with sem:
+                try:
+                    rows = await asyncio.to_thread(repos.channels.get_many, batch)
+                except Exception:
+                    print(f"Warning: failed to read notification_type for {len(batch)} users")
+                    return
+                for row in rows:
+                    flags[str(row["user_id"])] = row
+
+        await asyncio.gather(*(load(batch) for batch in chunked(user_ids, LOOKUP_BATCH_SIZE)))
+        return flags
+
+    async def _write(self, repo, rows: List[dict], batch_size: int, upsert: bool = False) -> set:
+        """Insert rows in batches; returns the user_ids of rows that failed."""
+        sem = asyncio.Semaphore(self.write_concurrency)
+        failed = set()
+        write_rows = repo.upsert if upsert else repo.insert
+
+        def insert(batch: List[dict]):
+            with call_timeout(SUPABASE_BULK_TIMEOUT):
+                return write_rows(batch)
+
+        async def write(batch: List[dict]):
+            async with sem:
+                try:
+                    await asyncio.to_thread(insert, batch)
+                except Exception:
+                    print(f"Warning: failed to insert {len(batch)} rows into {repo.table}")
+                    failed.update(row["user_id"] for row in batch)
+
+        await asyncio.gather(*(write(batch) for batch in chunked(rows, batch_size)))
+        return failed
+
+
+pipeline = DeliveryPipeline()
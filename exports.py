@@ -0,0 +1,59 @@
+"""Streaming CSV/NDJSON exports.
+
+Rows are read in keyset pages ordered by the table's primary key and
+written out as they arrive, so an export of millions of rows holds one page
+in memory and the client gets the first bytes right away.
+"""
+import asyncio
+import csv
+import io
+import json
+import os
+from typing import AsyncIterator, List, Optional
+
+from db_instrumentation import detach_request
+
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "5000"))
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+USER_EXPORT_COLUMNS = ("user_id", "name", "email", "phone", "city", "gender", "is_active", "role_id", "created_at")
+LOG_EXPORT_COLUMNS = ("log_id", "user_id", "notification_type", "status", "sent_at", "message_id", "acked_at", "ref")
+
+
+def _csv_lines(rows: List[dict], columns: tuple, header: bool) -> str:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=columns, extrasaction="ignore")
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def _ndjson_lines(rows: List[dict]) -> str:
+    return "".join(json.dumps(row, default=str) + "\n" for row in rows)
+
+
+async def export_rows(
+    repo,
+    columns: tuple,
+    fmt: str,
+    page_size: int = EXPORT_PAGE_SIZE,
+    **filters,
+) -> AsyncIterator[str]:
+    """Yield `repo`'s rows as CSV or NDJSON text, one chunk per keyset page."""
+    # an export is paged by design; don't count it against the request's query budget
+    detach_request()
+    select = ", ".join(columns)
+    after: Optional[str] = None
+    first = True
+    while True:
+        rows = await asyncio.to_thread(repo.scan, select, after, page_size, **filters)
+        if fmt == "csv":
+            if rows or first:
+                yield _csv_lines(rows, columns, header=first)
+        elif rows:
+            yield _ndjson_lines(rows)
+        first = False
+        if len(rows) < page_size:
+            return
+        after = rows[-1][repo.key]
@@ -0,0 +1,158 @@
+"""Per-campaign/newsletter delivery funnels.
+
+Every send of a campaign or newsletter keeps one `delivery_funnels` row per
+campaign/newsletter id with running counts for each stage:
+
+    targeted -> delivered (pushed live) | queued -> flushed (replayed later)
+    acked (confirmed by an ack-enabled client), failed (queue write failed)
+
+Counts are buffered in memory and added to the row every
+FUNNEL_FLUSH_INTERVAL seconds, so recording an event never waits on the
+database and reading a funnel is one primary-key lookup. The rows assume a
+single API process owns them, like the log sink.
+
+A resumed send job replays the page it was on when it stopped, whose counts
+may already have been added. The job's checkpoint is the authority for the
+send stages, so a send job `reset`s them to the counts from before the job
+plus its checkpointed totals first.
+"""
+import asyncio
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+from repositories import repos
+
+FUNNEL_FLUSH_INTERVAL = float(os.getenv("FUNNEL_FLUSH_INTERVAL", "2.0"))
+FUNNEL_STAGES = ("targeted", "delivered", "queued", "flushed", "acked", "failed")
+
+# payload key holding the funnel ref -> funnel kind
+REF_KEYS = {"campaign_id": "campaign", "newsletter_id": "newsletter"}
+
+
+def funnel_ref(message) -> Optional[str]:
+    """The campaign or newsletter id a pushed message belongs to, if any."""
+    if not isinstance(message, dict):
+        return None
+    for key in REF_KEYS:
+        if message.get(key):
+            return str(message[key])
+    return None
+
+
+def funnel_kind(message) -> Optional[str]:
+    if isinstance(message, dict):
+        for key, kind in REF_KEYS.items():
+            if message.get(key):
+                return kind
+    return None
+
+
+class FunnelCounters:
+    def __init__(self, flush_interval: float = FUNNEL_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        # ref -> stage -> count not yet written; touched from threads and the loop
+        self.deltas: Dict[str, Dict[str, int]] = {}
+        # ref -> stage -> absolute value replacing the stored one at the next flush
+        self.resets: Dict[str, Dict[str, int]] = {}
+        self.kinds: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.task: Optional[asyncio.Task] = None
+
+    def add(self, ref: Optional[str], kind: Optional[str] = None, **counts: int):
+        if not ref:
+            return
+        with self.lock:
+            entry = self.deltas.setdefault(ref, {})
+            for stage, n in counts.items():
+                if n:
+                    entry[stage] = entry.get(stage, 0) + n
+            if kind:
+                self.kinds[ref] = kind
+
+    def reset(self, ref: Optional[str], kind: Optional[str] = None, **counts: int):
+        """Set stages to absolute values, dropping any unflushed deltas for them."""
+        if not ref:
+            return
+        with self.lock:
+            entry = self.deltas.get(ref, {})
+            for stage in counts:
+                entry.pop(stage, None)
+            self.resets.setdefault(ref, {}).update(counts)
+            if kind:
+                self.kinds[ref] = kind
+
+    def add_message(self, message, **counts: int):
+        self.add(funnel_ref(message), funnel_kind(message), **counts)
+
+    def start(self):
+        if self.task:
+            return
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        with self.lock:
+            deltas, self.deltas = self.deltas, {}
+            resets, self.resets = self.resets, {}
+            kinds, self.kinds = self.kinds, {}
+        refs = set(deltas) | set(resets)
+        if not refs:
+            return
+        try:
+            await asyncio.to_thread(self._write, refs, deltas, resets, kinds)
+        except Exception:
+            print(f"Warning: failed to update {len(refs)} delivery funnels, retrying next flush")
+            with self.lock:
+                for ref, entry in resets.items():
+                    # a reset made since keeps precedence
+                    self.resets[ref] = {**entry, **self.resets.get(ref, {})}
+            for ref in refs:
+                self.add(ref, kinds.get(ref), **deltas.get(ref, {}))
+
+    def _write(
+        self,
+        refs: set,
+        deltas: Dict[str, Dict[str, int]],
+        resets: Dict[str, Dict[str, int]],
+        kinds: Dict[str, str],
+    ):
+        existing = {r["ref"]: r for r in repos.funnels.get_many(list(refs))}
+        now = datetime.utcnow().isoformat()
+        rows = []
+        for ref in refs:
+            old = existing.get(ref) or {}
+            base = {**old, **resets.get(ref, {})}
+            entry = deltas.get(ref, {})
+            row = {"ref": ref, "kind": kinds.get(ref) or old.get("kind"), "updated_at": now}
+            for stage in FUNNEL_STAGES:
+                row[stage] = (base.get(stage) or 0) + entry.get(stage, 0)
+            rows.append(row)
+        repos.funnels.upsert(rows)
+
+    def get(self, ref: str) -> dict:
+        """Stored counts plus anything not flushed yet."""
+        row = repos.funnels.get(ref) or {}
+        with self.lock:
+            pending = dict(self.deltas.get(ref, {}))
+            base = {**row, **self.resets.get(ref, {})}
+            kind = self.kinds.get(ref)
+        out = {"ref": ref, "kind": row.get("kind") or kind, "updated_at": row.get("updated_at")}
+        for stage in FUNNEL_STAGES:
+            out[stage] = (base.get(stage) or 0) + pending.get(stage, 0)
+        return out
+
+
+funnels = FunnelCounters()
@@ -0,0 +1,133 @@
+"""Shared, pooled HTTP transport for the Supabase client.
+
+All PostgREST calls go through one `httpx.Client` with keep-alive
+connections, pool-size limits and (when `h2` is installed) HTTP/2
+multiplexing, instead of the transport supabase-py builds for itself.
+Every request is traced, so /metrics shows how often a call reused a pooled
+connection versus opening a new one. `call_timeout()` overrides the
+timeout for the calls made inside it, e.g. long bulk writes.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from metrics import registry
+
+SUPABASE_POOL_MAX_CONNECTIONS = int(os.getenv("SUPABASE_POOL_MAX_CONNECTIONS", "100"))
+SUPABASE_POOL_MAX_KEEPALIVE = int(os.getenv("SUPABASE_POOL_MAX_KEEPALIVE", "20"))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "30"))
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "true").lower() in ("1", "true", "yes")
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "5"))
+SUPABASE_READ_TIMEOUT = float(os.getenv("SUPABASE_READ_TIMEOUT", "10"))
+SUPABASE_WRITE_TIMEOUT = float(os.getenv("SUPABASE_WRITE_TIMEOUT", "10"))
+# how long a call may wait for a free connection when the pool is exhausted
+SUPABASE_POOL_TIMEOUT = float(os.getenv("SUPABASE_POOL_TIMEOUT", "5"))
+# connections opened at startup so the first requests don't pay the handshake
+SUPABASE_POOL_WARM = int(os.getenv("SUPABASE_POOL_WARM", "4"))
+# read/write timeout for bulk inserts from the delivery pipeline and log sink
+SUPABASE_BULK_TIMEOUT = float(os.getenv("SUPABASE_BULK_TIMEOUT", "30"))
+
+http_requests = registry.counter(
+    "supabase_http_requests_total",
+    "Supabase HTTP requests by whether they opened a new connection",
+    ("connection", "http_version"),
+)
+http_connect_seconds = registry.histogram(
+    "supabase_http_connect_seconds", "Time to open a new Supabase connection (TCP + TLS)"
+)
+http_errors = registry.counter(
+    "supabase_http_errors_total", "Supabase HTTP requests that failed before a response", ("error",)
+)
+
+_timeout_override: ContextVar[Optional[float]] = ContextVar("supabase_call_timeout", default=None)
+
+
+@contextmanager
+def call_timeout(seconds: float):
+    """Use `seconds` as the read/write timeout for Supabase calls made inside the block."""
+    token = _timeout_override.set(seconds)
+    try:
+        yield
+    finally:
+        _timeout_override.reset(token)
+
+
+class _Trace:
+    """httpcore trace callback recording whether a request opened a connection."""
+
+    __slots__ = ("new_connection", "connect_started", "connect_seconds")
+
+    def __init__(self):
+        self.new_connection = False
+        self.connect_started = None
+        self.connect_seconds = 0.0
+
+    def __call__(self, event: str, info: dict):
+        if event == "connection.connect_tcp.started":
+            self.new_connection = True
+            self.connect_started = time.perf_counter()
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            if self.connect_started is not None:
+                self.connect_seconds = time.perf_counter() - self.connect_started
+
+
+def _on_request(request):
+    trace = _Trace()
+    request.extensions["trace"] = trace
+    seconds = _timeout_override.get()
+    if seconds is not None:
+        timeout = dict(request.extensions.get("timeout") or {})
+        timeout.update(read=seconds, write=seconds)
+        request.extensions["timeout"] = timeout
+
+
+def _on_response(response):
+    trace = response.request.extensions.get("trace")
+    if not isinstance(trace, _Trace):
+        return
+    http_requests.inc(
+        connection="new" if trace.new_connection else "reused",
+        http_version=response.http_version,
+    )
+    if trace.new_connection:
+        http_connect_seconds.observe(trace.connect_seconds)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("Warning: SUPABASE_HTTP2 is set but the h2 package is missing, using HTTP/1.1")
+        return False
+    return True
+
+
+def build_http_client():
+    """The pooled httpx client handed to supabase-py."""
+    import httpx
+
+    class PooledClient(httpx.Client):
+        def send(self, request, *args, **kwargs):
+            try:
+                return super().send(request, *args, **kwargs)
+            except httpx.HTTPError as e:
+                http_errors.inc(error=type(e).__name__)
+                raise
+
+    return PooledClient(
+        http2=SUPABASE_HTTP2 and _http2_available(),
+        limits=httpx.Limits(
+            max_connections=SUPABASE_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=SUPABASE_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=SUPABASE_CONNECT_TIMEOUT,
+            read=SUPABASE_READ_TIMEOUT,
+            write=SUPABASE_WRITE_TIMEOUT,
+            pool=SUPABASE_POOL_TIMEOUT,
+        ),
+        event_hooks={"request": [_on_request], "response": [_on_response]},
+    )
@@ -0,0 +1,287 @@
+"""Background send jobs.
+
+A send endpoint enqueues a job and returns its id right away; the job runs
+on the event loop and publishes progress that status endpoints can poll or
+stream as newline-delimited JSON.
+
+Jobs are checkpointed to the `send_jobs` table after every recipient page.
+If the process dies mid-send, `resume_interrupted` picks RUNNING jobs back up
+from their last cursor.
+
+A job whose params carry a future `send_at` is saved as SCHEDULED and holds
+nothing while it waits: the scheduler loop starts it once `send_at` has
+passed, and SCHEDULED jobs are reloaded from `send_jobs` on startup.
+Re-triggering a scheduled send replaces its schedule. Re-triggering a send
+that is running returns the existing job instead of sending twice,
+re-triggering a failed one resumes it from its checkpoint, and once a send
+has finished a new trigger starts a new job.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from db_instrumentation import detach_request
+from repositories import repos
+
+# finished jobs are kept in memory this long so callers can read the outcome
+JOB_RETENTION_SECONDS = 3600
+# how often the scheduler looks for SCHEDULED jobs that are due
+JOB_SCHEDULER_INTERVAL = float(os.getenv("JOB_SCHEDULER_INTERVAL", "5"))
+
+
+class Job:
+    def __init__(self, kind: str, target_id: str, params: Optional[dict] = None, job_id: Optional[str] = None):
+        self.job_id = job_id or str(uuid.uuid4())
+        self.kind = kind
+        self.target_id = target_id
+        self.params = params or {}
+        self.status = "QUEUED"
+        self.cursor: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.progress: dict = {}
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self._changed = asyncio.Event()
+        self._store: Optional["JobStore"] = None
+
+    @classmethod
+    def from_record(cls, record: dict) -> "Job":
+        job = cls(record["kind"], record["target_id"], record.get("params"), job_id=record["job_id"])
+        job.status = record["status"]
+        job.cursor = record.get("cursor")
+        job.progress = record.get("progress") or {}
+        job.result = record.get("result")
+        job.error = record.get("error")
+        if job.done:
+            job.finished_at = job.created_at
+        return job
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("DONE", "FAILED")
+
+    @property
+    def run_at(self) -> Optional[str]:
+        return self.params.get("send_at")
+
+    @property
+    def due(self) -> bool:
+        return not self.run_at or datetime.fromisoformat(self.run_at) <= datetime.utcnow()
+
+    def update(self, **fields):
+        for key, value in fields.items():
+            setattr(self, key, value)
+        self._changed.set()
+
+    async def checkpoint(self, progress: dict, cursor: Optional[str]):
+        """Record that every recipient up to `cursor` has been fully handled."""
+        self.update(progress=progress, cursor=cursor)
+        if self._store:
+            await asyncio.to_thread(self._store.save, self)
+
+    async def wait_for_change(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+    def record(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "target_id": self.target_id,
+            "status": self.status,
+            "cursor": self.cursor,
+            "params": self.params,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "run_at": self.run_at,
+            "updated_at": datetime.utcnow().isoformat(),
+        }
+
+    def snapshot(self) -> dict:
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "target_id": self.target_id,
+            "status": self.status,
+            "run_at": self.run_at,
+            **self.progress,
+            "elapsed_seconds": round(elapsed, 3),
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobStore:
+    """Persists job checkpoints; failures only cost resumability, never the send."""
+
+    table = "send_jobs"
+
+    def latest(self, kind: str, target_id: str) -> Optional[dict]:
+        """The target's most recent job, finished or not."""
+        try:
+            return repos.send_jobs.find(kind, target_id, ["SCHEDULED", "RUNNING", "DONE", "FAILED"])
+        except Exception:
+            print(f"Warning: failed to read {self.table} for {kind} {target_id}")
+            return None
+
+    def with_status(self, status: str) -> list:
+        try:
+            return repos.send_jobs.with_status(status)
+        except Exception:
+            print(f"Warning: failed to read {status} jobs from {self.table}")
+            return []
+
+    def save(self, job: Job):
+        try:
+            repos.send_jobs.upsert(job.record())
+        except Exception:
+            print(f"Warning: failed to checkpoint job {job.job_id}")
+
+
+class JobManager:
+    def __init__(self, store: Optional[JobStore] = None):
+        self.store = store or JobStore()
+        self.jobs: Dict[str, Job] = {}
+        self.runners: Dict[str, Callable[[Job], Awaitable[dict]]] = {}
+        self.tasks = set()
+        self.task: Optional[asyncio.Task] = None
+        # serializes submits per target so concurrent triggers can't both start a send
+        self.locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+
+    def register(self, kind: str, runner: Callable[[Job], Awaitable[dict]]):
+        """`runner(job)` performs the send, resuming from `job.cursor`/`job.progress`."""
+        self.runners[kind] = runner
+
+    async def submit(self, kind: str, target_id: str, params: Optional[dict] = None) -> Job:
+        """Start a send, or return the target's scheduled, running or (resumed) failed job."""
+        self._prune()
+        key = (kind, target_id)
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                return await self._submit(kind, target_id, params or {})
+        finally:
+            if not lock.locked() and self.locks.get(key) is lock:
+                del self.locks[key]
+
+    async def _submit(self, kind: str, target_id: str, params: dict) -> Job:
+        for job in self.jobs.values():
+            if job.kind == kind and job.target_id == target_id and job.status != "DONE":
+                if job.status == "SCHEDULED":
+                    job.params = params
+                    self._start(job)
+                elif job.status == "FAILED":
+                    self._start(job)
+                return job
+
+        # only the latest job counts: an older failed one was superseded by a finished send
+        record = await asyncio.to_thread(self.store.latest, kind, target_id)
+        if record and record["status"] != "DONE" and record["job_id"] not in self.jobs:
+            job = Job.from_record(record)
+            self.jobs[job.job_id] = job
+            if job.status == "SCHEDULED":
+                job.params = params
+            self._start(job)
+            return job
+
+        job = Job(kind, target_id, params)
+        self.jobs[job.job_id] = job
+        self._start(job)
+        return job
+
+    async def resume_interrupted(self):
+        """Restart RUNNING jobs and reload SCHEDULED ones; call once on startup."""
+        for status in ("RUNNING", "SCHEDULED"):
+            records = await asyncio.to_thread(self.store.with_status, status)
+            for record in records:
+                if record["job_id"] in self.jobs or record["kind"] not in self.runners:
+                    continue
+                job = Job.from_record(record)
+                job._store = self.store
+                self.jobs[job.job_id] = job
+                if status == "RUNNING":
+                    print(f"Resuming {job.kind} job {job.job_id} after cursor {job.cursor}")
+                    self._start(job)
+
+    def start(self):
+        """Start the scheduler that launches SCHEDULED jobs once they are due."""
+        if self.task:
+            return
+        self.task = asyncio.create_task(self._schedule())
+
+    async def _schedule(self):
+        while True:
+            await asyncio.sleep(JOB_SCHEDULER_INTERVAL)
+            for job in list(self.jobs.values()):
+                if job.status == "SCHEDULED" and job.due:
+                    self._start(job)
+
+    def get(self, job_id: str, kind: str, target_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if not job or job.kind != kind or job.target_id != target_id:
+            return None
+        return job
+
+    async def stream(self, job: Job, interval: float = 1.0):
+        """Yield NDJSON snapshots whenever the job changes, until it finishes or waits for `run_at`."""
+        while True:
+            yield json.dumps(job.snapshot()) + "\n"
+            if job.done or job.status == "SCHEDULED":
+                return
+            await job.wait_for_change(interval)
+
+    async def stop(self, timeout: float = 30.0):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=timeout)
+
+    def _start(self, job: Job):
+        job._store = self.store
+        if job.due:
+            job.update(status="QUEUED")
+            self._spawn(self._run(job))
+        else:
+            job.update(status="SCHEDULED")
+            self._spawn(asyncio.to_thread(self.store.save, job))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, job: Job):
+        # the job outlives the request that submitted it
+        detach_request()
+        job.update(status="RUNNING", started_at=time.time(), finished_at=None, error=None)
+        await asyncio.to_thread(self.store.save, job)
+        try:
+            result = await self.runners[job.kind](job)
+            job.update(status="DONE", result=result, finished_at=time.time())
+        except Exception as e:
+            print(f"Warning: {job.kind} job {job.job_id} failed: {e}")
+            job.update(status="FAILED", error=str(e), finished_at=time.time())
+        await asyncio.to_thread(self.store.save, job)
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id, job in list(self.jobs.items()):
+            if job.done and job.finished_at < cutoff:
+                del self.jobs[job_id]
+
+
+jobs = JobManager()
@@ -0,0 +1,300 @@
+"""End-to-end load test for campaign/newsletter fan-out and websocket delivery.
+
+Seeds a local SQLite database, starts the API against it (DATA_BACKEND=local),
+connects N simulated websocket clients built on test_client.listen, triggers
+sends the way send_trigger.py does and reports delivery latency percentiles,
+throughput and server memory.
+
+Requires: pip install websockets requests bcrypt uvicorn
+Usage:
+  python loadtest.py --users 20000 --clients 5000 --rounds 3
+  python loadtest.py --clients 10000 --idle-only --hold 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import bcrypt
+import requests
+
+from datagen import Generator
+from local_backend import LocalClient
+from test_client import ByteStats, listen, with_params
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ADMIN_EMAIL = "loadtest-admin@example.com"
+ADMIN_PASSWORD = "loadtest"
+
+
+# ---------------- DATA ----------------
+def seed(db_path: str, users: int, rounds: int) -> dict:
+    """Fill a fresh database with `users` customers plus one campaign and newsletter per round."""
+    gen = Generator(
+        LocalClient(db_path),
+        opt_in=1.0,
+        active=1.0,
+        # push only, so the run measures websocket delivery rather than SMTP
+        channels={"push": True, "email": False, "sms": False},
+        prefix="loadtest",
+    )
+    admin_id = gen.admin(
+        ADMIN_EMAIL,
+        bcrypt.hashpw(ADMIN_PASSWORD.encode("utf-8"), bcrypt.gensalt()).decode("utf-8"),
+        name="Load Test Admin",
+    )
+    customer_ids = gen.users(users)
+    return {
+        "customer_ids": sorted(customer_ids),
+        "campaigns": gen.campaigns(rounds, created_by=admin_id),
+        "newsletters": gen.newsletters(rounds, created_by=admin_id),
+    }
+
+
+# ---------------- SERVER ----------------
+def start_server(db_path: str, port: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "DATA_BACKEND": "local",
+        "LOCAL_DB_PATH": db_path,
+        "LOG_SINK_SPILL_PATH": db_path + ".spill.jsonl",
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=HERE,
+        env=env,
+    )
+
+
+def wait_ready(base: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(base + "/", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server at {base} did not become ready")
+
+
+def scrape(base: str) -> dict:
+    """Unlabelled gauges from /metrics."""
+    out = {}
+    for line in requests.get(base + "/metrics", timeout=5).text.splitlines():
+        if line.startswith("#") or "{" in line or not line.strip():
+            continue
+        name, value = line.split()
+        out[name] = float(value)
+    return out
+
+
+def login(base: str) -> str:
+    r = requests.post(base + "/auth/user/login", json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD})
+    r.raise_for_status()
+    return r.json()["session_token"]
+
+
+def trigger(base: str, token: str, kind: str, target_id: str) -> dict:
+    """POST a send and follow its job stream to the end; returns the last snapshot."""
+    headers = {"Authorization": f"Bearer {token}"}
+    body = {} if kind == "campaigns" else None
+    r = requests.post(f"{base}/{kind}/{target_id}/send", json=body, headers=headers)
+    r.raise_for_status()
+    snap = None
+    with requests.get(base + r.json()["status_url"], headers=headers, stream=True) as s:
+        for line in s.iter_lines():
+            if line:
+                snap = json.loads(line)
+    return snap
+
+
+# ---------------- CLIENTS ----------------
+class Fleet:
+    def __init__(self, ws_base: str, user_ids: list, fmt: str = None, compress: str = None):
+        self.ws_base = ws_base.rstrip("/") + "/"
+        self.user_ids = user_ids
+        self.fmt = fmt
+        self.compress = compress
+        self.stats = ByteStats()
+        self.tasks = []
+        self.connected_ids = set()
+        self.arrivals = {}  # reference id -> [perf_counter timestamps]
+
+    def _on_message(self, msg):
+        if not isinstance(msg, dict):
+            return
+        ref = msg.get("campaign_id") or msg.get("newsletter_id")
+        if ref:
+            self.arrivals.setdefault(ref, []).append(time.perf_counter())
+
+    @property
+    def connected(self) -> int:
+        return len(self.connected_ids)
+
+    async def connect(self, concurrency: int, timeout: float) -> float:
+        started = time.perf_counter()
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(user_id):
+            async with sem:
+                ready = asyncio.Event()
+
+                def on_connect(ws):
+                    self.connected_ids.add(user_id)
+                    ready.set()
+
+                self.tasks.append(asyncio.create_task(listen(
+                    with_params(self.ws_base + user_id, self.fmt, self.compress),
+                    self._on_message,
+                    on_connect=on_connect,
+                    quiet=True,
+                    stats=self.stats,
+                )))
+                # hold the slot until this socket is up so handshakes stay bounded
+                try:
+                    await asyncio.wait_for(ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+        await asyncio.gather(*(one(u) for u in self.user_ids))
+        return time.perf_counter() - started
+
+    async def wait_for(self, ref: str, expected: int, timeout: float):
+        deadline = time.perf_counter() + timeout
+        while len(self.arrivals.get(ref, [])) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# ---------------- RUN ----------------
+async def run(args) -> dict:
+    base = f"http://127.0.0.1:{args.port}"
+    report = {"users": args.users, "clients": args.clients, "rounds": []}
+
+    db_dir = tempfile.mkdtemp(prefix="loadtest-")
+    db_path = os.path.join(db_dir, "loadtest.db")
+    started = time.perf_counter()
+    data = seed(db_path, args.users, args.rounds)
+    report["seed_seconds"] = round(time.perf_counter() - started, 2)
+    print(f"Seeded {args.users} users in {report['seed_seconds']}s ({db_path})")
+
+    raise_fd_limit()
+    server = start_server(db_path, args.port)
+    fleet = None
+    try:
+        await asyncio.to_thread(wait_ready, base)
+        token = await asyncio.to_thread(login, base)
+        report["rss_idle_bytes"] = (await asyncio.to_thread(scrape, base)).get("process_resident_memory_bytes")
+
+        fleet = Fleet(
+            f"ws://127.0.0.1:{args.port}/ws/notifications/",
+            data["customer_ids"][:args.clients],
+            fmt=args.format,
+            compress=args.compress,
+        )
+        connect_seconds = await fleet.connect(args.connect_concurrency, args.timeout)
+        gauges = await asyncio.to_thread(scrape, base)
+        rss = gauges.get("process_resident_memory_bytes")
+        report["connect_seconds"] = round(connect_seconds, 2)
+        report["connected"] = fleet.connected
+        report["server_sockets"] = gauges.get("websocket_active_connections")
+        report["rss_connected_bytes"] = rss
+        if rss and report["rss_idle_bytes"] and fleet.connected:
+            report["rss_per_socket_bytes"] = round((rss - report["rss_idle_bytes"]) / fleet.connected)
+        print(f"Connected {fleet.connected}/{args.clients} sockets in {connect_seconds:.2f}s, server RSS {rss / 1e6:.1f} MB")
+
+        if args.idle_only:
+            await asyncio.sleep(args.hold)
+            report["rss_after_hold_bytes"] = (await asyncio.to_thread(scrape, base)).get("process_resident_memory_bytes")
+            return report
+
+        sends = [("campaigns", c) for c in data["campaigns"]] + [("newsletters", n) for n in data["newsletters"]]
+        for kind, target_id in sends:
+            t0 = time.perf_counter()
+            snap = await asyncio.to_thread(trigger, base, token, kind, target_id)
+            await fleet.wait_for(target_id, fleet.connected, args.timeout)
+            latencies = [t - t0 for t in fleet.arrivals.get(target_id, [])]
+            job_seconds = snap["elapsed_seconds"] if snap else None
+            round_report = {
+                "kind": kind,
+                "target_id": target_id,
+                "job_status": snap and snap["status"],
+                "recipients": snap and snap.get("recipients"),
+                "job_seconds": job_seconds,
+                "recipients_per_second": round(snap["recipients"] / job_seconds, 1) if job_seconds else None,
+                "delivered_to_clients": len(latencies),
+                "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+                "latency_p90_ms": round(percentile(latencies, 90) * 1000, 1),
+                "latency_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+                "latency_max_ms": round(max(latencies) * 1000, 1) if latencies else 0.0,
+                "stages": snap and (snap.get("result") or {}).get("stages"),
+                "rss_bytes": (await asyncio.to_thread(scrape, base)).get("process_resident_memory_bytes"),
+            }
+            report["rounds"].append(round_report)
+            print(
+                f"{kind[:-1]} {target_id[:8]}: {round_report['recipients']} recipients in {job_seconds}s "
+                f"({round_report['recipients_per_second']}/s), delivered {len(latencies)}/{fleet.connected}, "
+                f"p50={round_report['latency_p50_ms']}ms p90={round_report['latency_p90_ms']}ms "
+                f"p99={round_report['latency_p99_ms']}ms max={round_report['latency_max_ms']}ms"
+            )
+        report["wire"] = {
+            "format": args.format or "json",
+            "compress": args.compress,
+            "messages": fleet.stats.messages,
+            "wire_bytes": fleet.stats.wire_bytes,
+            "json_bytes": fleet.stats.json_bytes,
+        }
+        print(f"Wire: {fleet.stats.summary()}")
+        return report
+    finally:
+        if fleet:
+            await fleet.close()
+        server.terminate()
+        server.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--users", type=int, default=10000, help="Customers to seed")
+    p.add_argument("--clients", type=int, default=2000, help="Websocket clients to connect")
+    p.add_argument("--rounds", type=int, default=1, help="Campaign + newsletter sends to run")
+    p.add_argument("--port", type=int, default=9200, help="Port for the spawned server")
+    p.add_argument("--connect-concurrency", type=int, default=200, help="Parallel websocket handshakes")
+    p.add_argument("--timeout", type=float, default=120, help="Seconds to wait for connects/deliveries")
+    p.add_argument("--idle-only", action="store_true", help="Only hold idle sockets and report memory")
+    p.add_argument("--hold", type=float, default=10, help="Seconds to hold idle sockets with --idle-only")
+    p.add_argument("--json", help="Write the report to this file")
+    p.add_argument("--format", choices=["json", "msgpack"], help="Wire format clients negotiate")
+    p.add_argument("--compress", choices=["deflate"], help="Compression clients negotiate")
+    args = p.parse_args()
+    args.clients = min(args.clients, args.users)
+
+    result = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+        print("Report written to", args.json)
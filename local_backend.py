@@ -0,0 +1,454 @@
+"""Local SQLite stand-in for the Supabase client.
+
+Implements the part of the supabase-py query builder this app uses
+(`table().select/insert/upsert/update/delete`, the usual filters, ordering,
+limits, `single()` and one-level embedded relations such as
+`user_preferences(*)`) on top of sqlite3, so the API can run and be
+load-tested without a Supabase project. Select it with DATA_BACKEND=local;
+LOCAL_DB_PATH picks the database file (default: in-memory).
+"""
+import json
+import re
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# table -> (primary key, {column: type}); types: text, int, real, bool, json
+# Supabase gets the tables and columns added since the original schema from migrations/
+SCHEMA: Dict[str, tuple] = {
+    "users": ("user_id", {
+        "user_id": "text", "name": "text", "email": "text", "password": "text",
+        "phone": "text", "city": "text", "gender": "text", "is_active": "bool",
+        "role_id": "int", "created_at": "text",
+    }),
+    "user_preferences": ("user_id", {
+        "user_id": "text", "offers": "bool", "order_updates": "bool", "newsletter": "bool",
+    }),
+    "notification_type": ("user_id", {
+        "user_id": "text", "email": "bool", "sms": "bool", "push": "bool",
+        "campaign_email": "bool", "campaign_sms": "bool", "campaign_push": "bool",
+        "newsletter_email": "bool", "newsletter_sms": "bool", "newsletter_push": "bool",
+        "update_email": "bool", "update_sms": "bool", "update_push": "bool",
+    }),
+    "campaigns": ("campaign_id", {
+        "campaign_id": "text", "campaign_name": "text", "city_filter": "text", "content": "text",
+        "created_by": "text", "status": "text", "created_at": "text",
+    }),
+    "newsletters": ("newsletter_id", {
+        "newsletter_id": "text", "news_name": "text", "city_filter": "text", "content": "text",
+        "created_by": "text", "status": "text", "created_at": "text",
+    }),
+    "orders": ("order_id", {
+        "order_id": "text", "user_id": "text", "order_name": "text", "status": "text",
+        "created_at": "text",
+    }),
+    "pending_notifications": ("id", {
+        "id": "text", "user_id": "text", "payload": "json", "message_id": "text",
+        "created_at": "text", "read_at": "text",
+    }),
+    "notification_messages": ("message_id", {
+        "message_id": "text", "payload": "json", "created_at": "text",
+    }),
+    "notification_logs": ("log_id", {
+        "log_id": "text", "user_id": "text", "notification_type": "text", "status": "text",
+        "sent_at": "text", "message_id": "text", "acked_at": "text", "ref": "text",
+        "channels": "text",
+    }),
+    "notification_log_rollups": ("rollup_id", {
+        "rollup_id": "text", "day": "text", "notification_type": "text", "status": "text",
+        "ref": "text", "total": "int", "acked": "int",
+    }),
+    "delivery_funnels": ("ref", {
+        "ref": "text", "kind": "text", "targeted": "int", "delivered": "int", "queued": "int",
+        "flushed": "int", "acked": "int", "failed": "int", "updated_at": "text",
+    }),
+    "send_jobs": ("job_id", {
+        "job_id": "text", "kind": "text", "target_id": "text", "status": "text",
+        "cursor": "text", "params": "json", "progress": "json", "result": "json",
+        "error": "text", "run_at": "text", "updated_at": "text",
+    }),
+}
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS users_customers ON users (role_id, is_active, user_id)",
+    "CREATE INDEX IF NOT EXISTS users_email ON users (email)",
+    "CREATE INDEX IF NOT EXISTS pending_user ON pending_notifications (user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS logs_user ON notification_logs (user_id, sent_at)",
+    "CREATE INDEX IF NOT EXISTS logs_sent_at ON notification_logs (sent_at)",
+    "CREATE INDEX IF NOT EXISTS logs_message ON notification_logs (message_id, user_id)",
+    "CREATE INDEX IF NOT EXISTS logs_ref ON notification_logs (ref, sent_at)",
+    "CREATE INDEX IF NOT EXISTS orders_user ON orders (user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS send_jobs_target ON send_jobs (kind, target_id, status)",
+)
+
+# (parent table, embedded table) -> (parent column, child column, one-to-one)
+RELATIONS = {
+    ("users", "user_preferences"): ("user_id", "user_id", True),
+    ("users", "notification_type"): ("user_id", "user_id", True),
+    ("users", "orders"): ("user_id", "user_id", False),
+}
+
+# columns filled in when an insert omits them, like the database defaults
+DEFAULTS = {
+    "users": {"user_id": lambda: str(uuid.uuid4()), "created_at": lambda: datetime.utcnow().isoformat()},
+    "campaigns": {"campaign_id": lambda: str(uuid.uuid4()), "created_at": lambda: datetime.utcnow().isoformat()},
+    "newsletters": {"newsletter_id": lambda: str(uuid.uuid4()), "created_at": lambda: datetime.utcnow().isoformat()},
+    "orders": {"order_id": lambda: str(uuid.uuid4()), "created_at": lambda: datetime.utcnow().isoformat()},
+    "pending_notifications": {"id": lambda: str(uuid.uuid4()), "created_at": lambda: datetime.utcnow().isoformat()},
+    "notification_messages": {"message_id": lambda: str(uuid.uuid4()), "created_at": lambda: datetime.utcnow().isoformat()},
+    "notification_logs": {"log_id": lambda: str(uuid.uuid4()), "sent_at": lambda: datetime.utcnow().isoformat()},
+}
+
+SQL_TYPES = {"text": "TEXT", "int": "INTEGER", "real": "REAL", "bool": "INTEGER", "json": "TEXT"}
+
+
+class LocalAPIError(Exception):
+    pass
+
+
+class LocalResponse:
+    def __init__(self, data, count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+
+def _split_columns(columns: str) -> List[str]:
+    parts, depth, current = [], 0, ""
+    for ch in columns:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+        else:
+            current += ch
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+class LocalQuery:
+    def __init__(self, client: "LocalClient", table: str):
+        if table not in SCHEMA:
+            raise LocalAPIError(f'relation "{table}" does not exist')
+        self.client = client
+        self.table = table
+        self.pk, self.types = SCHEMA[table]
+        self.op = "select"
+        self.columns = "*"
+        self.count_mode: Optional[str] = None
+        self.values: List[dict] = []
+        self.filters: List[tuple] = []
+        self._negate = False
+        self.orders: List[tuple] = []
+        self._limit: Optional[int] = None
+        self._offset: Optional[int] = None
+        self._single = False
+        self._maybe_single = False
+
+    # ---- operations ----
+    def select(self, columns: str = "*", count: Optional[str] = None):
+        self.columns = columns
+        self.count_mode = count
+        return self
+
+    def insert(self, values, **_):
+        self.op = "insert"
+        self.values = values if isinstance(values, list) else [values]
+        return self
+
+    def upsert(self, values, **_):
+        self.op = "upsert"
+        self.values = values if isinstance(values, list) else [values]
+        return self
+
+    def update(self, values: dict, **_):
+        self.op = "update"
+        self.values = [values]
+        return self
+
+    def delete(self, **_):
+        self.op = "delete"
+        return self
+
+    # ---- filters ----
+    def _filter(self, column: str, sql_op: str, value):
+        self.filters.append((column, sql_op, value, self._negate))
+        self._negate = False
+        return self
+
+    @property
+    def not_(self):
+        """Negates the next filter, e.g. `.not_.is_("read_at", "null")`."""
+        self._negate = True
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, "=", value)
+
+    def neq(self, column, value):
+        return self._filter(column, "!=", value)
+
+    def gt(self, column, value):
+        return self._filter(column, ">", value)
+
+    def gte(self, column, value):
+        return self._filter(column, ">=", value)
+
+    def lt(self, column, value):
+        return self._filter(column, "<", value)
+
+    def lte(self, column, value):
+        return self._filter(column, "<=", value)
+
+    def in_(self, column, values):
+        return self._filter(column, "IN", list(values))
+
+    def is_(self, column, value):
+        return self._filter(column, "IS", value)
+
+    def order(self, column: str, desc: bool = False, **_):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, size: int, **_):
+        self._limit = size
+        return self
+
+    def range(self, start: int, end: int, **_):
+        self._offset = start
+        self._limit = end - start + 1
+        return self
+
+    def single(self):
+        self._single = True
+        return self
+
+    def maybe_single(self):
+        self._maybe_single = True
+        return self
+
+    # ---- execution ----
+    def execute(self) -> LocalResponse:
+        with self.client.lock:
+            if self.op == "select":
+                rows = self._select()
+                count = self._count() if self.count_mode else None
+                if self._single or self._maybe_single:
+                    if len(rows) > 1 or (self._single and not rows):
+                        raise LocalAPIError("JSON object requested, multiple (or no) rows returned")
+                    return LocalResponse(rows[0] if rows else None, count)
+                return LocalResponse(rows, count)
+            if self.op in ("insert", "upsert"):
+                return LocalResponse(self._insert(upsert=self.op == "upsert"))
+            if self.op == "update":
+                return LocalResponse(self._update())
+            return LocalResponse(self._delete())
+
+    def _check_column(self, column: str):
+        if column not in self.types:
+            raise LocalAPIError(f'column {self.table}.{column} does not exist')
+
+    def _encode(self, column: str, value):
+        kind = self.types[column]
+        if value is None:
+            return None
+        if kind == "bool":
+            return int(bool(value))
+        if kind == "json":
+            return json.dumps(value)
+        if kind == "text":
+            return str(value)
+        return value
+
+    def _decode_row(self, row: sqlite3.Row) -> dict:
+        out = {}
+        for column in row.keys():
+            value = row[column]
+            kind = self.types.get(column)
+            if value is not None and kind == "bool":
+                value = bool(value)
+            elif value is not None and kind == "json":
+                value = json.loads(value)
+            out[column] = value
+        return out
+
+    def _where(self):
+        clauses, params = [], []
+        for column, op, value, negate in self.filters:
+            self._check_column(column)
+            if op == "IN":
+                if not value:
+                    clause = "0"
+                else:
+                    clause = f'"{column}" IN ({",".join("?" * len(value))})'
+                    params.extend(self._encode(column, v) for v in value)
+            elif op == "IS":
+                clause = f'"{column}" IS NULL' if value in (None, "null") else f'"{column}" IS ?'
+                if value not in (None, "null"):
+                    params.append(self._encode(column, value))
+            else:
+                clause = f'"{column}" {op} ?'
+                params.append(self._encode(column, value))
+            clauses.append(f"NOT ({clause})" if negate else clause)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def _select(self) -> List[dict]:
+        plain, embedded = [], []
+        for part in _split_columns(self.columns):
+            match = re.match(r"^(\w+)\((.*)\)$", part)
+            if match:
+                embedded.append((match.group(1), match.group(2)))
+            elif part == "*":
+                plain.extend(self.types)
+            else:
+                self._check_column(part)
+                plain.append(part)
+
+        select_cols = list(dict.fromkeys(plain))
+        join_cols = [RELATIONS[(self.table, rel)][0] for rel, _ in embedded if (self.table, rel) in RELATIONS]
+        hidden = [c for c in join_cols if c not in select_cols]
+
+        sql = f'SELECT {", ".join(chr(34) + c + chr(34) for c in select_cols + hidden)} FROM "{self.table}"'
+        where, params = self._where()
+        sql += where
+        if self.orders:
+            for column, _ in self.orders:
+                self._check_column(column)
+            sql += " ORDER BY " + ", ".join(f'"{c}" {"DESC" if d else "ASC"}' for c, d in self.orders)
+        if self._limit is not None:
+            sql += f" LIMIT {int(self._limit)}"
+            if self._offset:
+                sql += f" OFFSET {int(self._offset)}"
+
+        rows = [self._decode_row(r) for r in self.client.conn.execute(sql, params)]
+
+        for rel, rel_columns in embedded:
+            if (self.table, rel) not in RELATIONS:
+                raise LocalAPIError(f"Could not find a relationship between '{self.table}' and '{rel}'")
+            parent_col, child_col, one = RELATIONS[(self.table, rel)]
+            keys = list({row[parent_col] for row in rows if row.get(parent_col) is not None})
+            children: Dict[str, list] = {}
+            for start in range(0, len(keys), 500):
+                child = LocalQuery(self.client, rel).select(rel_columns or "*").in_(child_col, keys[start:start + 500])
+                if child_col not in _split_columns(child.columns) and child.columns != "*":
+                    child.columns += f", {child_col}"
+                for item in child._select():
+                    children.setdefault(item[child_col], []).append(item)
+            for row in rows:
+                matched = children.get(row.get(parent_col), [])
+                row[rel] = (matched[0] if matched else None) if one else matched
+
+        for row in rows:
+            for column in hidden:
+                row.pop(column, None)
+        return rows
+
+    def _count(self) -> int:
+        where, params = self._where()
+        return self.client.conn.execute(f'SELECT COUNT(*) FROM "{self.table}"{where}', params).fetchone()[0]
+
+    def _insert(self, upsert: bool) -> List[dict]:
+        if not self.values:
+            return []
+        defaults = DEFAULTS.get(self.table, {})
+        rows = []
+        for values in self.values:
+            row = dict(values)
+            for column, make in defaults.items():
+                if row.get(column) is None:
+                    row[column] = make()
+            rows.append(row)
+
+        # group by column set so every statement is a single executemany
+        by_columns: Dict[tuple, List[dict]] = {}
+        for row in rows:
+            by_columns.setdefault(tuple(row), []).append(row)
+        for columns, group in by_columns.items():
+            for column in columns:
+                self._check_column(column)
+            quoted = ", ".join(f'"{c}"' for c in columns)
+            sql = f'INSERT INTO "{self.table}" ({quoted}) VALUES ({", ".join("?" * len(columns))})'
+            if upsert:
+                updates = ", ".join(f'"{c}" = excluded."{c}"' for c in columns if c != self.pk)
+                sql += f' ON CONFLICT("{self.pk}") DO ' + (f"UPDATE SET {updates}" if updates else "NOTHING")
+            try:
+                self.client.conn.executemany(
+                    sql, [[self._encode(c, row[c]) for c in columns] for row in group]
+                )
+            except sqlite3.IntegrityError as e:
+                raise LocalAPIError(str(e))
+        self.client.conn.commit()
+        return rows
+
+    def _matching_keys(self) -> list:
+        where, params = self._where()
+        return [r[0] for r in self.client.conn.execute(f'SELECT "{self.pk}" FROM "{self.table}"{where}', params)]
+
+    def _fetch_keys(self, keys: list) -> List[dict]:
+        rows = []
+        for start in range(0, len(keys), 500):
+            rows.extend(LocalQuery(self.client, self.table).in_(self.pk, keys[start:start + 500])._select())
+        return rows
+
+    def _update(self) -> List[dict]:
+        values = self.values[0]
+        if not values:
+            return []
+        for column in values:
+            self._check_column(column)
+        keys = self._matching_keys()
+        where, params = self._where()
+        assignments = ", ".join(f'"{c}" = ?' for c in values)
+        self.client.conn.execute(
+            f'UPDATE "{self.table}" SET {assignments}{where}',
+            [self._encode(c, v) for c, v in values.items()] + params,
+        )
+        self.client.conn.commit()
+        return self._fetch_keys(keys)
+
+    def _delete(self) -> List[dict]:
+        keys = self._matching_keys()
+        rows = self._fetch_keys(keys)
+        where, params = self._where()
+        self.client.conn.execute(f'DELETE FROM "{self.table}"{where}', params)
+        self.client.conn.commit()
+        return rows
+
+
+class LocalClient:
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        # one shared connection: queries run from worker threads, serialized by the lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.create_schema()
+
+    def create_schema(self):
+        for table, (pk, types) in SCHEMA.items():
+            columns = ", ".join(
+                f'"{c}" {SQL_TYPES[t]}' + (" PRIMARY KEY" if c == pk else "") for c, t in types.items()
+            )
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({columns})')
+            # databases generated before a column was added get it here
+            existing = {row["name"] for row in self.conn.execute(f'PRAGMA table_info("{table}")')}
+            for c, t in types.items():
+                if c not in existing:
+                    self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{c}" {SQL_TYPES[t]}')
+        for statement in INDEXES:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def table(self, name: str) -> LocalQuery:
+        return LocalQuery(self, name)
+
+    def from_(self, name: str) -> LocalQuery:
+        return self.table(name)
@@ -0,0 +1,185 @@
+"""Retention and daily rollups for `notification_logs`.
+
+Raw log rows are kept for LOG_RETENTION_DAYS. A background compactor rolls
+older rows into `notification_log_rollups` (one row per day, notification
+type, status and campaign/newsletter ref, with total and acked counts) and
+deletes them, page by page. Only whole days are compacted; rows that arrive late for a day that
+was already rolled up are added to its counts on the next run.
+
+Readers combine the rollups with the raw tail, see `totals()` and
+`ref_history()`.
+
+A page is rolled up before its raw rows are deleted, so a crash between
+the two counts that page twice on the next run rather than losing it.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from db_instrumentation import detach_request
+from metrics import registry
+from repositories import repos
+
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "30"))
+LOG_COMPACT_INTERVAL = float(os.getenv("LOG_COMPACT_INTERVAL", "3600"))
+LOG_COMPACT_BATCH_SIZE = int(os.getenv("LOG_COMPACT_BATCH_SIZE", "1000"))
+
+logs_compacted = registry.counter(
+    "notification_logs_compacted_total", "Raw notification_logs rows rolled up and deleted"
+)
+
+RollupKey = Tuple[str, str, str, str]
+
+
+def rollup_id(day: str, notification_type: Optional[str], status: Optional[str], ref: Optional[str]) -> str:
+    return f"{day}:{notification_type or ''}:{status or ''}:{ref or ''}"
+
+
+def retention_cutoff(retention_days: int = LOG_RETENTION_DAYS, now: Optional[datetime] = None) -> str:
+    """Start of the oldest day still kept raw."""
+    day = (now or datetime.utcnow()).date() - timedelta(days=retention_days)
+    return datetime(day.year, day.month, day.day).isoformat()
+
+
+def count_rows(rows: List[dict]) -> Dict[RollupKey, List[int]]:
+    counts: Dict[RollupKey, List[int]] = {}
+    for row in rows:
+        key = ((row.get("sent_at") or "")[:10], row.get("notification_type"), row.get("status"), row.get("ref"))
+        entry = counts.setdefault(key, [0, 0])
+        entry[0] += 1
+        if row.get("acked_at"):
+            entry[1] += 1
+    return counts
+
+
+def tally(out: dict, status: Optional[str], total: int, acked: int):
+    out["total"] += total
+    out["acked"] += acked
+    if status == "SUCCESS":
+        out["success"] += total
+    elif status == "FAILED":
+        out["failed"] += total
+
+
+def totals() -> dict:
+    """Status counts over rollups plus the raw tail."""
+    out = {"total": 0, "success": 0, "failed": 0, "acked": 0}
+    for row in repos.log_rollups.list():
+        tally(out, row["status"], row["total"] or 0, row["acked"] or 0)
+    # the raw tail is counted in the database, never fetched
+    out["total"] += repos.logs.count()
+    out["success"] += repos.logs.count("SUCCESS")
+    out["failed"] += repos.logs.count("FAILED")
+    out["acked"] += repos.logs.count(acked=True)
+    return out
+
+
+def ref_history(ref: str) -> dict:
+    """A campaign/newsletter's raw log rows, with totals and daily counts over its rollups and those rows."""
+    logs = repos.logs.list_by_ref(ref)
+    daily: Dict[RollupKey, List[int]] = {}
+    for row in repos.log_rollups.list(ref):
+        entry = daily.setdefault((row["day"], row["notification_type"], row["status"], ref), [0, 0])
+        entry[0] += row["total"] or 0
+        entry[1] += row["acked"] or 0
+    for key, (total, acked) in count_rows(logs).items():
+        entry = daily.setdefault(key, [0, 0])
+        entry[0] += total
+        entry[1] += acked
+
+    out = {"total": 0, "success": 0, "failed": 0, "acked": 0}
+    days = []
+    # newest day first
+    for key in sorted(daily, key=lambda k: tuple(part or "" for part in k), reverse=True):
+        day, notification_type, status, _ = key
+        total, acked = daily[key]
+        tally(out, status, total, acked)
+        days.append({
+            "day": day,
+            "notification_type": notification_type,
+            "status": status,
+            "total": total,
+            "acked": acked,
+        })
+    return {"ref": ref, **out, "daily": days, "logs": logs}
+
+
+class LogCompactor:
+    def __init__(
+        self,
+        retention_days: int = LOG_RETENTION_DAYS,
+        interval: float = LOG_COMPACT_INTERVAL,
+        batch_size: int = LOG_COMPACT_BATCH_SIZE,
+    ):
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.task: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+
+    def start(self):
+        if self.task or self.interval <= 0:
+            return
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                print("Warning: notification_logs compaction failed")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> dict:
+        """Compact everything older than the retention window; one run at a time."""
+        async with self.lock:
+            return await asyncio.to_thread(self.compact, retention_cutoff(self.retention_days))
+
+    def compact(self, cutoff: str) -> dict:
+        detach_request()
+        compacted = 0
+        after = None
+        while True:
+            rows = repos.logs.page_before(
+                cutoff, after, self.batch_size, "log_id, notification_type, status, sent_at, acked_at, ref"
+            )
+            if not rows:
+                break
+            self._merge(count_rows(rows))
+            repos.logs.delete_many([r["log_id"] for r in rows])
+            compacted += len(rows)
+            logs_compacted.inc(len(rows))
+            if len(rows) < self.batch_size:
+                break
+            after = rows[-1]["log_id"]
+        if compacted:
+            print(f"Compacted {compacted} notification_logs rows older than {cutoff}")
+        return {"cutoff": cutoff, "compacted": compacted}
+
+    def _merge(self, counts: Dict[RollupKey, List[int]]):
+        ids = {rollup_id(*key): key for key in counts}
+        existing = {r["rollup_id"]: r for r in repos.log_rollups.get_many(list(ids))}
+        rows = []
+        for rid, (day, kind, status, ref) in ids.items():
+            total, acked = counts[(day, kind, status, ref)]
+            old = existing.get(rid) or {}
+            rows.append({
+                "rollup_id": rid,
+                "day": day,
+                "notification_type": kind,
+                "status": status,
+                "ref": ref,
+                "total": (old.get("total") or 0) + total,
+                "acked": (old.get("acked") or 0) + acked,
+            })
+        repos.log_rollups.upsert(rows)
+
+
+compactor = LogCompactor()
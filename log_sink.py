@@ -0,0 +1,156 @@
+"""Write-behind sink for `notification_logs`.
+
+Request handlers hand log rows to the sink and return immediately; a
+background task flushes them with bulk inserts once `batch_size` rows are
+buffered or every `flush_interval` seconds. Memory is bounded by
+`max_buffer`: past it, and whenever a flush fails, rows are spilled to a
+JSONL file that is replayed after the next successful flush. Everything
+still buffered is flushed on shutdown.
+"""
+import asyncio
+import json
+import os
+import threading
+from typing import List, Optional
+
+from http_pool import SUPABASE_BULK_TIMEOUT, call_timeout
+from repositories import repos
+
+LOG_SINK_BATCH_SIZE = int(os.getenv("LOG_SINK_BATCH_SIZE", "500"))
+LOG_SINK_FLUSH_INTERVAL = float(os.getenv("LOG_SINK_FLUSH_INTERVAL", "1.0"))
+LOG_SINK_MAX_BUFFER = int(os.getenv("LOG_SINK_MAX_BUFFER", "20000"))
+LOG_SINK_SPILL_PATH = os.getenv("LOG_SINK_SPILL_PATH", "notification_logs.spill.jsonl")
+
+
+class LogSink:
+    def __init__(
+        self,
+        table: str = "notification_logs",
+        batch_size: int = LOG_SINK_BATCH_SIZE,
+        flush_interval: float = LOG_SINK_FLUSH_INTERVAL,
+        max_buffer: int = LOG_SINK_MAX_BUFFER,
+        spill_path: str = LOG_SINK_SPILL_PATH,
+    ):
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.spill_path = spill_path
+        self.buffer: List[dict] = []
+        # handlers declared with `def` run in the threadpool, so guard the buffer
+        self.lock = threading.Lock()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.wake: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def write(self, row: dict):
+        self.write_many([row])
+
+    def write_many(self, rows: List[dict]):
+        """Buffer rows without blocking; safe to call from any thread."""
+        with self.lock:
+            room = max(self.max_buffer - len(self.buffer), 0)
+            self.buffer.extend(rows[:room])
+            overflow = rows[room:]
+            full = len(self.buffer) >= self.batch_size
+            if overflow:
+                self._spill(overflow)
+        if full and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def start(self):
+        if self.task:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    async def flush(self):
+        while True:
+            with self.lock:
+                batch = self.buffer[:self.batch_size]
+                del self.buffer[:self.batch_size]
+            if not batch:
+                break
+            if not await self._insert(batch):
+                await asyncio.to_thread(self._spill_locked, batch)
+                return
+        await self._replay_spill()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            await self.flush()
+
+    async def _insert(self, rows: List[dict]) -> bool:
+        return await asyncio.to_thread(self._insert_sync, rows)
+
+    def _insert_sync(self, rows: List[dict]) -> bool:
+        try:
+            with call_timeout(SUPABASE_BULK_TIMEOUT):
+                repos.logs.insert(rows)
+            return True
+        except Exception:
+            print(f"Warning: failed to flush {len(rows)} rows into {self.table}")
+            return False
+
+    def _spill_locked(self, rows: List[dict]):
+        with self.lock:
+            self._spill(rows)
+
+    def _spill(self, rows: List[dict]):
+        # caller holds self.lock
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+        except OSError:
+            print(f"Warning: dropped {len(rows)} {self.table} rows, spill file not writable")
+
+    async def _replay_spill(self):
+        # file reads and parsing stay off the event loop, like the inserts
+        await asyncio.to_thread(self._replay_spill_sync)
+
+    def _replay_spill_sync(self):
+        with self.lock:
+            if not os.path.exists(self.spill_path):
+                return
+            replay_path = self.spill_path + ".replay"
+            os.replace(self.spill_path, replay_path)
+
+        # stream the file so replaying a large spill stays within one batch of memory
+        with open(replay_path, encoding="utf-8") as f:
+            batch = []
+            for line in f:
+                if line.strip():
+                    batch.append(json.loads(line))
+                if len(batch) < self.batch_size:
+                    continue
+                if not self._insert_sync(batch):
+                    break
+                batch = []
+            else:
+                if not batch or self._insert_sync(batch):
+                    batch = []
+            if batch:
+                # still failing: put the unsent rows back for the next attempt
+                with self.lock:
+                    self._spill(batch)
+                    with open(self.spill_path, "a", encoding="utf-8") as out:
+                        for line in f:
+                            out.write(line)
+        os.remove(replay_path)
+
+
+log_sink = LogSink()
@@ -1,17 +1,33 @@
 from fastapi import FastAPI, HTTPException, File, UploadFile, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel, EmailStr
 from datetime import datetime, timedelta
-from supabase_client import supabase
-from typing import Optional
+from repositories import chunked, inbox_cursor, repos
+from supabase_client import warm_up, close as close_supabase
+from http_pool import SUPABASE_POOL_WARM
+from typing import List, Optional
 from uuid import UUID
 import uuid
+import asyncio
 import csv
 import io
 import secrets
 import bcrypt
 from ws import router as ws_router
 from websocket_manager import manager
+from delivery import pipeline, DeliveryRequest, DeliveryResult
+from channels import dispatcher
+from jobs import jobs
+from log_sink import log_sink
+from acks import acks
+from funnels import funnels
+from log_rollups import compactor, ref_history, totals as log_totals
+from exports import EXPORT_FORMATS, LOG_EXPORT_COLUMNS, USER_EXPORT_COLUMNS, export_rows
+from metrics import registry, MetricsMiddleware
+from db_instrumentation import QueryBudgetMiddleware
+from templates import FIELDS as TEMPLATE_FIELDS, unknown_placeholders
+from profiler import ProfilerMiddleware, list_profiles, profile_path
 import re
 from typing import Optional
 
@@ -19,6 +35,28 @@ app = FastAPI()
 
 app.include_router(ws_router)
 
+@app.on_event("startup")
+async def start_channels():
+    # open pooled connections now rather than on the first request
+    await asyncio.to_thread(warm_up, SUPABASE_POOL_WARM)
+    dispatcher.start()
+    log_sink.start()
+    acks.start(manager.send_to_user)
+    funnels.start()
+    compactor.start()
+    await jobs.resume_interrupted()
+    jobs.start()
+
+@app.on_event("shutdown")
+async def stop_channels():
+    await jobs.stop()
+    await compactor.stop()
+    await dispatcher.stop()
+    await acks.stop()
+    await funnels.stop()
+    await log_sink.stop()
+    close_supabase()
+
 # ---------------- CORS ----------------
 app.add_middleware(
     CORSMiddleware,
@@ -34,6 +72,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(ProfilerMiddleware)
+app.add_middleware(QueryBudgetMiddleware)
+app.add_middleware(MetricsMiddleware)
+
 # Add this helper function near the top of main.py (after imports)
 def is_valid_email(email: str) -> bool:
     """
@@ -179,23 +221,19 @@ def build_default_password(name: str, phone: str) -> str:
 def root():
     return {"status": "ok"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus scrape endpoint."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 # ---------------- AUTH ----------------
 @app.post("/auth/user/login")
 def user_login(payload: LoginRequest):
     email = validate_email(payload.email)
-    res = (
-        supabase
-        .table("users")
-        .select("*")
-        .eq("email", payload.email)
-        .eq("is_active", True)
-        .execute()
-    )
-    if not res.data:
+    user = repos.users.find_by_email(payload.email, active_only=True)
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
-    user = res.data[0]
-
     # Verify password hash
     if not verify_password(payload.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -216,20 +254,13 @@ def user_signup(payload: SignUp):
 
     email = validate_email(payload.email)
 
-    existing = (
-        supabase
-        .table("users")
-        .select("*")
-        .eq("email", payload.email)
-        .execute()
-    )
-    if existing.data:
+    if repos.users.find_by_email(payload.email):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     user_id = str(uuid.uuid4())
     hashed_password = hash_password(payload.password)
 
-    supabase.table("users").insert({
+    repos.users.insert({
         "user_id": user_id,
         "name": payload.name,
         "email": payload.email,
@@ -240,18 +271,18 @@ def user_signup(payload: SignUp):
         "gender": payload.gender,
         "city": payload.city,
         "role_id": 4,
-    }).execute()
+    })
 
-    supabase.table("user_preferences").insert({
+    repos.preferences.insert({
         "user_id": user_id,
         "offers": True,
         "order_updates": True,
         "newsletter": True
-    }).execute()
+    })
 
-    supabase.table("notification_type").insert({
+    repos.channels.insert({
         "user_id": user_id
-    }).execute()
+    })
 
     # Create session for new user
     token = create_session(user_id, 4, payload.email)
@@ -287,28 +318,20 @@ def get_current_user_info(user: dict = Depends(get_current_user)):
 
 @app.get("/admin/employeesmgmt")
 def list_employees(user: dict = Depends(admin_only)):
-    
-    res = (
-        supabase.table("users")
-        .select("user_id, name, email, role_id")
-        .in_("role_id", [1, 2, 3])  
-        .order("email")
-        .execute()
-    )
-    return res.data or []
+    return repos.users.list_employees()
 
 @app.post("/admin/employeesmgmt")
 def create_employee(data: EmployeeCreate, user: dict = Depends(admin_only)):
     email = validate_email(data.email)
     hashed_password = hash_password(data.password)
     
-    supabase.table("users").insert({
+    repos.users.insert({
         "name": data.name,
         "email": data.email,
         "password": hashed_password,
         "role_id": data.role_id,
         "created_at": datetime.utcnow().isoformat(),
-    }).execute()
+    })
     return {"success": True}
 
 @app.delete("/admin/employeesmgmt/{employee_id}")
@@ -316,9 +339,7 @@ def delete_employee(employee_id: int, user: dict = Depends(admin_only)):
     if employee_id == user["user_id"]:
         raise HTTPException(status_code=400, detail="Cannot delete yourself")
 
-    supabase.table("users").delete().eq(
-        "user_id", employee_id
-    ).execute()
+    repos.users.delete(employee_id)
 
     return {"success": True}
 
@@ -326,63 +347,40 @@ def delete_employee(employee_id: int, user: dict = Depends(admin_only)):
 @app.get("/campaigns")
 def list_campaigns(user: dict = Depends(get_current_user)):
     now = datetime.utcnow().isoformat()
-
-    return (
-        supabase
-        .table("campaigns")
-        .select("*")
-        .lte("created_at", now)   # 👈 filter added
-        .order("created_at", desc=True)
-        .execute()
-        .data
-        or []
-    )
+    return repos.campaigns.list(created_before=now)
+
+def check_placeholders(*texts: str):
+    """Reject unknown {{placeholders}}; the supported ones are in templates.FIELDS"""
+    unknown = sorted({name for text in texts for name in unknown_placeholders(text)})
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown placeholders: {', '.join(unknown)} (use {', '.join(TEMPLATE_FIELDS)})",
+        )
 
 @app.post("/campaigns")
 def create_campaign(payload: CampaignCreate, user: dict = Depends(get_current_user)):
-    res = (
-        supabase
-        .table("campaigns")
-        .insert({
-            "campaign_name": payload.campaign_name,
-            "city_filter": payload.city_filter,
-            "content": payload.content,
-            "created_by": str(payload.created_by),
-            "status": "DRAFT",
-            "created_at": datetime.utcnow().isoformat(),
-        })
-        .execute()
-    )
+    check_placeholders(payload.campaign_name, payload.content)
+    campaign = repos.campaigns.create({
+        "campaign_name": payload.campaign_name,
+        "city_filter": payload.city_filter,
+        "content": payload.content,
+        "created_by": str(payload.created_by),
+        "status": "DRAFT",
+        "created_at": datetime.utcnow().isoformat(),
+    })
 
-    if not res.data:
+    if not campaign:
         raise HTTPException(status_code=500, detail="Failed to create campaign")
 
-    return res.data[0]
-
-def get_eligible_users_for_campaign(campaign_id: UUID):
-    campaign = (
-        supabase.table("campaigns")
-        .select("*")
-        .eq("campaign_id", str(campaign_id))
-        .single()
-        .execute()
-        .data
-    )
-
-    if not campaign:
-        return []
+    return campaign
 
-    users = (
-        supabase.table("users")
-        .select("user_id, name, email, city, user_preferences(*)")
-        .eq("is_active", True)
-        .eq("role_id", 4)
-        .execute()
-        .data
-    )
+def get_campaign(campaign_id: UUID):
+    return repos.campaigns.get(str(campaign_id))
 
-    pref_key = "offers"
+def filter_eligible_users(users: list, pref_key: str, city_filter: Optional[str]):
     eligible = []
+    city = city_filter.lower() if city_filter else None
 
     for user in users:
         prefs = user.get("user_preferences")
@@ -392,369 +390,324 @@ def get_eligible_users_for_campaign(campaign_id: UUID):
         if prefs.get(pref_key) is not True:
             continue
 
-        if campaign["city_filter"]:
-            if not user["city"] or user["city"].lower() != campaign["city_filter"].lower():
+        if city:
+            if not user["city"] or user["city"].lower() != city:
                 continue
 
         eligible.append({
             "user_id": user["user_id"],
             "name": user["name"],
             "email": user["email"],
+            "phone": user.get("phone"),
             "city": user["city"],
         })
 
     return eligible
 
-@app.get("/campaigns/{campaign_id}/recipients")
-def get_campaign_recipients(campaign_id: UUID, user: dict = Depends(get_current_user)):
-    recipients = get_eligible_users_for_campaign(campaign_id)
-    return {"recipients": recipients}
+def fetch_active_customers(after: Optional[str] = None, limit: int = 1000):
+    """One keyset page of active customers ordered by user_id."""
+    return repos.users.page_active_customers(
+        after, limit, "user_id, name, email, phone, city, user_preferences(*)"
+    )
 
-@app.post("/campaigns/{campaign_id}/send")
-async def send_campaign(campaign_id: UUID, body: CampaignSendRequest, user: dict = Depends(get_current_user)):
-    recipients = get_eligible_users_for_campaign(campaign_id)
+def eligible_users_page(target: Optional[dict], pref_key: str, after: Optional[str], limit: int):
+    """Eligible recipients from one page of customers, plus the next cursor."""
+    if not target:
+        return [], None
+    users = fetch_active_customers(after, limit)
+    next_cursor = users[-1]["user_id"] if len(users) == limit else None
+    return filter_eligible_users(users, pref_key, target["city_filter"]), next_cursor
 
-    if not recipients:
-        return {"status": "sent", "sent_to": 0}
+def collect_pages(resolve, limit: int = 1000):
+    out, cursor = [], None
+    while True:
+        page, cursor = resolve(cursor, limit)
+        out.extend(page)
+        if cursor is None:
+            return out
 
-    now_dt = datetime.utcnow()
-    delay_minutes = body.schedule_after_minutes or 0
-    send_dt = now_dt + timedelta(minutes=delay_minutes)
+def get_eligible_users_for_campaign(campaign_id: UUID, campaign: Optional[dict] = None):
+    if campaign is None:
+        campaign = get_campaign(campaign_id)
 
-    now = now_dt.isoformat()
-    send_at = send_dt.isoformat()
+    return collect_pages(lambda after, limit: eligible_users_page(campaign, "offers", after, limit))
 
+@app.get("/campaigns/{campaign_id}/recipients")
+def get_campaign_recipients(campaign_id: UUID, user: dict = Depends(get_current_user)):
+    recipients = get_eligible_users_for_campaign(campaign_id)
+    return {"recipients": recipients}
 
-    campaign = (
-        supabase.table("campaigns")
-        .select("*")
-        .eq("campaign_id", str(campaign_id))
-        .single()
-        .execute()
-        .data
+def job_status_response(kind: str, target_id: UUID, job_id: str, stream: bool):
+    job = jobs.get(job_id, kind, str(target_id))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if stream:
+        return StreamingResponse(jobs.stream(job), media_type="application/x-ndjson")
+    return job.snapshot()
+
+async def funnel_baseline(job) -> Optional[dict]:
+    """The target's funnel counts from before this job, saved with it so a resumed job restores them."""
+    if "funnel_base" not in job.params:
+        try:
+            counts = await asyncio.to_thread(funnels.get, job.target_id)
+        except Exception:
+            print(f"Warning: failed to read the delivery funnel for {job.target_id}")
+            return None
+        job.params["funnel_base"] = {stage: counts[stage] for stage in ("targeted", "delivered", "queued", "failed")}
+        await job.checkpoint(job.progress, job.cursor)
+    return job.params["funnel_base"]
+
+async def run_campaign_send(job):
+    """Job runner for campaign sends; resumes from the job's checkpoint."""
+    campaign_id = job.target_id
+    campaign = await asyncio.to_thread(get_campaign, campaign_id)
+    # scheduled sends only start once send_at has passed (see jobs.py)
+    send_at = datetime.fromisoformat(job.params["send_at"]) if job.params.get("send_at") else None
+
+    request = DeliveryRequest(
+        "CAMPAIGN",
+        {
+            "type": "CAMPAIGN",
+            "campaign_id": campaign_id,
+            "title": campaign.get("campaign_name", "New Campaign") if campaign else "New Campaign",
+            "content": campaign.get("content", "") if campaign else "",
+        },
+        lambda after, limit: eligible_users_page(campaign, "offers", after, limit),
+        send_at=send_at,
+        key=job.job_id,
+        ref=campaign_id,
+        funnel_base=await funnel_baseline(job),
+    )
+    result = await pipeline.run(
+        request,
+        on_progress=job.checkpoint,
+        cursor=job.cursor,
+        result=DeliveryResult.from_progress(job.progress),
     )
 
-    title = campaign.get("campaign_name", "New Campaign") if campaign else "New Campaign"
-    content = campaign.get("content", "") if campaign else ""
-
-    logs = []
-    success_count = 0
-    queued_count = 0
-    for recipient in recipients:
-        is_scheduled = delay_minutes > 0
-        print(is_scheduled)
-        success = False
-
-        if not is_scheduled:
-            try:
-                success = await manager.send_to_user(
-                    str(recipient["user_id"]),
-                    {
-                        "type": "CAMPAIGN",
-                        "campaign_id": str(campaign_id),
-                        "title": title,
-                        "content": content,
-                    }
-                )
-            except Exception:
-                success = False
-
-        if is_scheduled or not success:
-            queued_count += 1
-            try:
-                supabase.table("pending_notifications").insert({
-                    "id": str(uuid.uuid4()),
-                    "user_id": recipient["user_id"],
-                    "payload": {
-                        "type": "CAMPAIGN",
-                        "campaign_id": str(campaign_id),
-                        "title": title,
-                        "content": content,
-                        "send_at": send_at
-                    },
-                    "created_at": now,
-                }).execute()
-            except Exception:
-                print("Warning: failed to queue notification for user", recipient["user_id"])
-        else:
-            success_count += 1
-
-        logs.append({
-            "log_id": str(uuid.uuid4()),
-            "user_id": recipient["user_id"],
-            "notification_type": "CAMPAIGN",
-            "status": "PENDING" if is_scheduled else "SUCCESS",
-            "sent_at": send_at,
-        })
+    if result.recipients:
+        try:
+            await asyncio.to_thread(repos.campaigns.set_status, campaign_id, "SENT")
+        except Exception:
+            print("Warning: failed to update campaign status")
 
+    return {
+        "status": "SENT",
+        "send_at": (send_at or datetime.utcnow()).isoformat(),
+        **result.as_dict(),
+    }
 
-    try:
-        supabase.table("notification_logs").insert(logs).execute()
-    except Exception:
-        print("Warning: failed to insert notification logs")
+jobs.register("campaign", run_campaign_send)
 
-    try:
-        supabase.table("campaigns").update({
-        "status": "SCHEDULED" if delay_minutes > 0 else "SENT"
-    }).eq("campaign_id", str(campaign_id)).execute()
+@app.post("/campaigns/{campaign_id}/send", status_code=202)
+async def send_campaign(campaign_id: UUID, body: CampaignSendRequest, user: dict = Depends(get_current_user)):
+    """Enqueue a campaign send; re-triggering returns the running job, resumes a failed one or starts a new send once finished."""
+    delay_minutes = body.schedule_after_minutes or 0
+    params = {}
+    if delay_minutes > 0:
+        params["send_at"] = (datetime.utcnow() + timedelta(minutes=delay_minutes)).isoformat()
 
-    except Exception:
-        print("Warning: failed to update campaign status")
+    if not await asyncio.to_thread(get_campaign, campaign_id):
+        raise HTTPException(status_code=404, detail="Campaign not found")
 
+    job = await jobs.submit("campaign", str(campaign_id), params)
+    if job.status == "SCHEDULED":
+        try:
+            await asyncio.to_thread(repos.campaigns.set_status, str(campaign_id), "SCHEDULED")
+        except Exception:
+            print("Warning: failed to update campaign status")
     return {
-        "status": "SCHEDULED" if delay_minutes > 0 else "SENT",
-        "send_at": send_at,
-        "sent_to": len(recipients),
-        "success_count": success_count,
-        "queued_count": queued_count,
-        "failed_count": len(recipients) - success_count - queued_count
+        "job_id": job.job_id,
+        "status": job.status,
+        "status_url": f"/campaigns/{campaign_id}/send/{job.job_id}",
     }
 
+@app.get("/campaigns/{campaign_id}/funnel")
+def get_campaign_funnel(campaign_id: UUID, user: dict = Depends(get_current_user)):
+    """Targeted, delivered, queued, flushed, acked and failed counts across the campaign's sends"""
+    return funnels.get(str(campaign_id))
+
+@app.get("/campaigns/{campaign_id}/send/{job_id}")
+async def get_campaign_send_status(campaign_id: UUID, job_id: str, stream: bool = True, user: dict = Depends(get_current_user)):
+    """Progress of a campaign send; streams NDJSON snapshots until it finishes unless stream=false."""
+    return job_status_response("campaign", campaign_id, job_id, stream)
+
 
 @app.post("/test/notify/{user_id}")
 async def test_notify(user_id: str, message: Optional[str] = None, auth_user: dict = Depends(get_current_user)):
     """Send a simple test notification to a connected user and log the attempt."""
-    payload = {
-        "type": "TEST",
-        "message": message or "Test notification",
-    }
-    sent = False
-    queued = False
-    try:
-        sent = await manager.send_to_user(user_id, payload)
-    except Exception:
-        sent = False
-
-    if not sent:
-        queued = True
-        try:
-            supabase.table("pending_notifications").insert({
-                "id": str(uuid.uuid4()),
-                "user_id": user_id,
-                "payload": payload,
-                "created_at": datetime.utcnow().isoformat(),
-            }).execute()
-        except Exception:
-            print("Warning: failed to queue test notification for user", user_id)
-
-    # mark log as SUCCESS (delivered now or queued for later)
-    try:
-        supabase.table("notification_logs").insert({
-            "log_id": str(uuid.uuid4()),
-            "user_id": user_id,
-            "notification_type": "TEST",
-            "status": "SUCCESS",
-            "sent_at": datetime.utcnow().isoformat(),
-        }).execute()
-    except Exception:
-        print("Warning: failed to insert test notification log")
+    result = await pipeline.run(DeliveryRequest(
+        "TEST",
+        {
+            "type": "TEST",
+            "message": message or "Test notification",
+        },
+        lambda after, limit: ([{"user_id": user_id}], None),
+        channels=("push",),
+    ))
 
-    return {"sent": sent, "queued": queued}
+    return {"sent": result.delivered > 0, "queued": result.queued > 0}
 
 
 @app.get("/newsletters")
 async def list_newsletters(user: dict = Depends(get_current_user)):
-    return (
-        supabase
-        .table("newsletters")
-        .select("*")
-        .order("created_at", desc=True)
-        .execute()
-        .data
-        or []
-    )
+    return repos.newsletters.list()
 
 @app.post("/newsletters")
 def create_newsletter(payload: NewsletterCreate, user: dict = Depends(get_current_user)):
-    res = (
-        supabase
-        .table("newsletters")
-        .insert({
-            "news_name": payload.news_name,
-            "city_filter": payload.city_filter,
-            "content": payload.content,
-            "created_by": str(payload.created_by),
-            "status": "DRAFT",
-            "created_at": datetime.utcnow().isoformat(),
-        })
-        .execute()
-    )
-
-    if not res.data:
-        raise HTTPException(status_code=500, detail="Failed to create newsletter")
-
-    return res.data[0]
-
-def get_eligible_users_for_newsletter(newsletter_id: UUID):
-    newsletter = (
-        supabase.table("newsletters")
-        .select("*")
-        .eq("newsletter_id", str(newsletter_id))
-        .single()
-        .execute()
-        .data
-    )
+    check_placeholders(payload.news_name, payload.content)
+    newsletter = repos.newsletters.create({
+        "news_name": payload.news_name,
+        "city_filter": payload.city_filter,
+        "content": payload.content,
+        "created_by": str(payload.created_by),
+        "status": "DRAFT",
+        "created_at": datetime.utcnow().isoformat(),
+    })
 
     if not newsletter:
-        return []
-
-    users = (
-        supabase.table("users")
-        .select("user_id, name, email, city, user_preferences(*)")
-        .eq("is_active", True)
-        .eq("role_id", 4)
-        .execute()
-        .data
-    )
-
-    pref_key = "newsletter"
-    eligible = []
-
-    for user in users:
-        prefs = user.get("user_preferences")
-        if not prefs:
-            continue
+        raise HTTPException(status_code=500, detail="Failed to create newsletter")
 
-        if prefs.get(pref_key) is not True:
-            continue
+    return newsletter
 
-        if newsletter["city_filter"]:
-            if not user["city"] or user["city"].lower() != newsletter["city_filter"].lower():
-                continue
+def get_newsletter(newsletter_id: UUID):
+    return repos.newsletters.get(str(newsletter_id))
 
-        eligible.append({
-            "user_id": user["user_id"],
-            "name": user["name"],
-            "email": user["email"],
-            "city": user["city"],
-        })
+def get_eligible_users_for_newsletter(newsletter_id: UUID, newsletter: Optional[dict] = None):
+    if newsletter is None:
+        newsletter = get_newsletter(newsletter_id)
 
-    return eligible
+    return collect_pages(lambda after, limit: eligible_users_page(newsletter, "newsletter", after, limit))
 
 @app.get("/newsletters/{newsletter_id}/recipients")
 def get_newsletter_recipients(newsletter_id: UUID, user: dict = Depends(get_current_user)):
     recipients = get_eligible_users_for_newsletter(newsletter_id)
     return {"recipients": recipients}
 
-@app.post("/newsletters/{newsletter_id}/send")
-async def send_newsletter(newsletter_id: UUID, user: dict = Depends(get_current_user)):
-    recipients = get_eligible_users_for_newsletter(newsletter_id)
+async def run_newsletter_send(job):
+    """Job runner for newsletter sends; resumes from the job's checkpoint."""
+    newsletter_id = job.target_id
+    newsletter = await asyncio.to_thread(get_newsletter, newsletter_id)
+
+    request = DeliveryRequest(
+        "NEWSLETTER",
+        {
+            "type": "NEWSLETTER",
+            "newsletter_id": newsletter_id,
+            "title": newsletter.get("news_name", "Newsletter") if newsletter else "Newsletter",
+            "content": newsletter.get("content", "") if newsletter else "",
+        },
+        lambda after, limit: eligible_users_page(newsletter, "newsletter", after, limit),
+        key=job.job_id,
+        ref=newsletter_id,
+        funnel_base=await funnel_baseline(job),
+    )
+    result = await pipeline.run(
+        request,
+        on_progress=job.checkpoint,
+        cursor=job.cursor,
+        result=DeliveryResult.from_progress(job.progress),
+    )
 
-    if not recipients:
-        return {"status": "SENT", "sent_to": 0, "success_count": 0, "queued_count": 0, "failed_count": 0}
+    if result.recipients:
+        try:
+            await asyncio.to_thread(repos.newsletters.set_status, newsletter_id, "SENT")
+        except Exception:
+            print("Warning: failed to update newsletter status")
 
-    now = datetime.utcnow().isoformat()
+    return {"status": "SENT", **result.as_dict()}
 
-    newsletter = (
-        supabase.table("newsletters")
-        .select("*")
-        .eq("newsletter_id", str(newsletter_id))
-        .single()
-        .execute()
-        .data
-    )
+jobs.register("newsletter", run_newsletter_send)
 
-    title = newsletter.get("news_name", "Newsletter") if newsletter else "Newsletter"
-    content = newsletter.get("content", "") if newsletter else ""
+@app.post("/newsletters/{newsletter_id}/send", status_code=202)
+async def send_newsletter(newsletter_id: UUID, user: dict = Depends(get_current_user)):
+    """Enqueue a newsletter send; re-triggering returns the running job, resumes a failed one or starts a new send once finished."""
+    if not await asyncio.to_thread(get_newsletter, newsletter_id):
+        raise HTTPException(status_code=404, detail="Newsletter not found")
 
-    logs = []
-    success_count = 0
-    queued_count = 0
+    job = await jobs.submit("newsletter", str(newsletter_id))
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        "status_url": f"/newsletters/{newsletter_id}/send/{job.job_id}",
+    }
 
-    for recipient in recipients:
-        success = False
-        try:
-            success = await manager.send_to_user(
-                str(recipient["user_id"]),
-                {
-                    "type": "NEWSLETTER",
-                    "newsletter_id": str(newsletter_id),
-                    "title": title,
-                    "content": content,
-                }
-            )
-        except Exception:
-            success = False
-
-        if not success:
-            queued_count += 1
-            try:
-                supabase.table("pending_notifications").insert({
-                    "id": str(uuid.uuid4()),
-                    "user_id": recipient["user_id"],
-                    "payload": {
-                        "type": "NEWSLETTER",
-                        "newsletter_id": str(newsletter_id),
-                        "title": title,
-                        "content": content,
-                    },
-                    "created_at": now,
-                }).execute()
-            except Exception:
-                print("Warning: failed to queue newsletter for user", user["user_id"])
-        else:
-            success_count += 1
-
-        # record log as SUCCESS for sent or queued
-        logs.append({
-            "log_id": str(newsletter_id),
-            "user_id": recipient["user_id"],
-            "notification_type": "NEWSLETTER",
-            "status": "SUCCESS",
-            "sent_at": now,
-        })
+@app.get("/newsletters/{newsletter_id}/funnel")
+def get_newsletter_funnel(newsletter_id: UUID, user: dict = Depends(get_current_user)):
+    """Delivery funnel counts across the newsletter's sends"""
+    return funnels.get(str(newsletter_id))
 
-    try:
-        supabase.table("notification_logs").insert(logs).execute()
-    except Exception:
-        print("Warning: failed to insert newsletter notification logs")
+@app.get("/newsletters/{newsletter_id}/send/{job_id}")
+async def get_newsletter_send_status(newsletter_id: UUID, job_id: str, stream: bool = True, user: dict = Depends(get_current_user)):
+    """Progress of a newsletter send; streams NDJSON snapshots until it finishes unless stream=false."""
+    return job_status_response("newsletter", newsletter_id, job_id, stream)
 
-    try:
-        supabase.table("newsletters").update({
-            "status": "SENT"
-        }).eq("newsletter_id", str(newsletter_id)).execute()
-    except Exception:
-        print("Warning: failed to update newsletter status")
+# ---------------- INBOX ----------------
+INBOX_MAX_PAGE = 200
 
+def inbox_item(row: dict) -> dict:
+    """Normalize a pending_notifications row to the shape the frontend expects."""
+    payload = row.get("payload") or {}
     return {
-        "status": "SENT",
-        "sent_to": len(recipients),
-        "success_count": success_count,
-        "queued_count": queued_count,
-        "failed_count": len(recipients) - success_count - queued_count
+        "id": row.get("id"),
+        "title": payload.get("title"),
+        "content": payload.get("content") or "",
+        "created_at": row.get("created_at"),
+        "read": row.get("read_at") is not None,
+        "type": payload.get("type") or row.get("notification_type"),
     }
 
 @app.get("/users/{user_id}/notifications")
-def get_user_notifications(user_id: str):
+def get_user_notifications(
+    user_id: str,
+    since: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = 50,
+    unread_only: bool = False,
+):
+    """
+    One page of the user's inbox.
+    Without cursors: newest first; pass `next_before` back as `before` for older pages.
+    With `since`: only items newer than it, oldest first; poll again with the returned `since`.
+    Cursors are opaque (created_at plus id, so rows queued together are never skipped).
+    """
+    limit = max(1, min(limit, INBOX_MAX_PAGE))
     try:
-        res = (
-            supabase
-            .table("pending_notifications")
-            .select("*")
-            .eq("user_id", user_id)
-            .order("created_at", desc=True)
-            .execute()
+        rows = repos.messages.attach(
+            repos.pending.page(user_id, limit, since=since, before=before, unread_only=unread_only)
         )
-        data = res.data or []
     except Exception:
         print("Warning: failed to read pending_notifications for", user_id)
-        data = []
-
-    # normalize payloads to a consistent shape for the frontend
-    out = []
-    for row in data:
-        payload = row.get("payload") or {}
-        title = payload.get("title")
-        content = payload.get("content") or ""
-        out.append({
-            "id": row.get("log_id"),
-            "title": title,
-            "content": content,
-            "created_at": row.get("created_at"),
-            "type": payload.get("type") or row.get("notification_type"),
-        })
-
-    return out
+        rows = []
+
+    items = [inbox_item(row) for row in rows]
+    if since:
+        newest = inbox_cursor(rows[-1]) if rows else since
+        next_before = None
+    else:
+        newest = inbox_cursor(rows[0]) if rows else None
+        next_before = inbox_cursor(rows[-1]) if len(rows) == limit else None
+
+    return {"items": items, "since": newest, "next_before": next_before}
+
+@app.get("/users/{user_id}/notifications/unread-count")
+def get_unread_count(user_id: str, user: dict = Depends(get_current_user)):
+    return {"unread": repos.pending.unread_count(user_id)}
+
+class MarkReadRequest(BaseModel):
+    ids: Optional[List[str]] = None
+    # mark everything up to and including this cursor (`since`/`next_before`, or an item's created_at)
+    up_to: Optional[str] = None
+
+@app.post("/users/{user_id}/notifications/read")
+def mark_notifications_read(user_id: str, body: MarkReadRequest, user: dict = Depends(get_current_user)):
+    """Bulk mark-as-read by ids and/or up to a cursor; with neither, marks the whole inbox."""
+    if body.ids is not None and not body.ids:
+        return {"marked": 0}
+    marked = repos.pending.mark_read(
+        user_id, datetime.utcnow().isoformat(), ids=body.ids, up_to=body.up_to
+    )
+    return {"marked": marked}
 
 # ---------------- USERS ----------------
 def build_default_password(name: str, phone: str) -> str:
@@ -767,7 +720,7 @@ def create_user(payload: CreateUserRequest, user: dict = Depends(admin_only)):
     password = build_default_password(payload.name, payload.phone)
     hashed_password = hash_password(password)
 
-    supabase.table("users").insert({
+    repos.users.insert({
         "user_id": user_id,
         "name": payload.name,
         "email": payload.email,
@@ -778,79 +731,126 @@ def create_user(payload: CreateUserRequest, user: dict = Depends(admin_only)):
         "is_active": True,
         "created_at": datetime.utcnow().isoformat(),
         "role_id": 4,
-    }).execute()
+    })
 
-    supabase.table("user_preferences").insert({
+    repos.preferences.insert({
         "user_id": user_id,
         "offers": True,
         "order_updates": True,
         "newsletter": True,
-    }).execute()
+    })
 
-    supabase.table("notification_type").insert({
+    repos.channels.insert({
         "user_id": user_id,
         "email": True,
         "sms": True,
         "push": True,
-    }).execute()
+    })
 
     return {"user_id": user_id}
 
 @app.get("/admin/users")
 def get_users(user: dict = Depends(admin_only)):
-    res = (
-        supabase
-        .table("users")
-        .select("*")
-        .eq("role_id", 4)
-        .order("created_at", desc=True)
-        .execute()
+    return repos.users.list_customers()
+
+def export_response(fmt: str, rows, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        rows,
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
     )
-    return res.data or []
+
+def check_export_format(fmt: str):
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+
+@app.get("/admin/users/export")
+def export_users(format: str = "csv", role_id: Optional[int] = 4, user: dict = Depends(admin_only)):
+    """Stream users (customers by default) as CSV or NDJSON; passwords are never exported."""
+    check_export_format(format)
+    filters = {"role_id": role_id} if role_id is not None else {}
+    return export_response(format, export_rows(repos.users, USER_EXPORT_COLUMNS, format, **filters), "users")
 
 @app.put("/admin/users/{user_id}")
 def update_user(user_id: str, payload: UpdateUserRequest, user: dict = Depends(admin_only)):
-    res = (
-        supabase
-        .table("users")
-        .update(payload.dict(exclude_none=True))
-        .eq("user_id", user_id)
-        .execute()
-    )
-    return res.data[0]
+    rows = repos.users.update(user_id, payload.dict(exclude_none=True))
+    return rows[0]
 
 @app.patch("/admin/users/{user_id}/toggle-active")
 def toggle_user(user_id: str, user: dict = Depends(admin_only)):
-    target_user = (
-        supabase
-        .table("users")
-        .select("is_active")
-        .eq("user_id", user_id)
-        .single()
-        .execute()
-    )
+    target_user = repos.users.get(user_id, "is_active")
+    if not target_user:
+        raise HTTPException(status_code=404, detail="User not found")
 
-    new_value = not target_user.data["is_active"]
+    new_value = not target_user["is_active"]
 
-    supabase.table("users").update({
-        "is_active": new_value
-    }).eq("user_id", user_id).execute()
+    repos.users.update(user_id, {"is_active": new_value})
 
     return {"is_active": new_value}
 
+BULK_USER_OPERATIONS = ("activate", "deactivate", "update", "delete")
+BULK_USERS_MAX = 10000
+
+class BulkUserFields(BaseModel):
+    city: Optional[str] = None
+    gender: Optional[str] = None
+    role_id: Optional[int] = None
+
+class BulkUserRequest(BaseModel):
+    user_ids: List[str]
+    operation: str
+    fields: Optional[BulkUserFields] = None
+
+@app.post("/admin/users/bulk")
+def bulk_users(payload: BulkUserRequest, user: dict = Depends(admin_only)):
+    """Activate, deactivate, update or delete many users with a few batched statements.
+
+    Returns a status per user id: updated/deleted, not_found, skipped (your
+    own account, for deactivate and delete) or failed.
+    """
+    if payload.operation not in BULK_USER_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"operation must be one of {', '.join(BULK_USER_OPERATIONS)}")
+    user_ids = list(dict.fromkeys(str(u) for u in payload.user_ids))
+    if len(user_ids) > BULK_USERS_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_USERS_MAX} user ids per request")
+
+    if payload.operation == "update":
+        fields = payload.fields.dict(exclude_none=True) if payload.fields else {}
+        if not fields:
+            raise HTTPException(status_code=400, detail="No fields to update")
+    else:
+        fields = {"is_active": payload.operation == "activate"}
+
+    results = {}
+    if payload.operation in ("deactivate", "delete") and str(user["user_id"]) in user_ids:
+        results[str(user["user_id"])] = "skipped"
+        user_ids.remove(str(user["user_id"]))
+
+    done = "deleted" if payload.operation == "delete" else "updated"
+    for batch in chunked(user_ids, repos.users.lookup_batch_size):
+        try:
+            if payload.operation == "delete":
+                rows = repos.users.delete_many(batch)
+            else:
+                rows = repos.users.update_many(batch, fields)
+        except Exception:
+            print(f"Warning: bulk {payload.operation} failed for {len(batch)} users")
+            results.update((user_id, "failed") for user_id in batch)
+            continue
+        matched = {str(r["user_id"]) for r in rows}
+        results.update((user_id, done if user_id in matched else "not_found") for user_id in batch)
+
+    summary = {}
+    for status in results.values():
+        summary[status] = summary.get(status, 0) + 1
+    return {"operation": payload.operation, "summary": summary, "results": results}
+
 @app.get("/users/{user_id}/preferences")
 def get_user_preferences(user_id: str, user: dict = Depends(get_current_user)):
-    res = (
-        supabase
-        .table("user_preferences")
-        .select("*")
-        .eq("user_id", user_id)
-        .single()
-        .execute()
-    )
-    if not res.data:
+    prefs = repos.preferences.get(user_id)
+    if not prefs:
         raise HTTPException(status_code=404, detail="Preferences not found")
-    return res.data
+    return prefs
 
 class UserPreferencesUpdate(BaseModel):
     offers: Optional[bool] = None
@@ -880,14 +880,7 @@ def update_user_preferences(
 
     user_fields = {k: data[k] for k in ("offers", "order_updates", "newsletter") if k in data}
     if user_fields:
-        res = (
-            supabase
-            .table("user_preferences")
-            .update(user_fields)
-            .eq("user_id", str(user_id))
-            .execute()
-        )
-        resp["preferences"] = res.data
+        resp["preferences"] = repos.preferences.update(str(user_id), user_fields)
 
     channel_keys = (
         "campaign_email", "campaign_sms", "campaign_push",
@@ -897,8 +890,7 @@ def update_user_preferences(
     notif_fields = {k: data[k] for k in channel_keys if k in data}
     if notif_fields:
         payload = {"user_id": str(user_id), **notif_fields}
-        res2 = supabase.table("notification_type").upsert(payload).execute()
-        resp["notification_type"] = res2.data
+        resp["notification_type"] = repos.channels.upsert(payload)
 
     return {"success": True, "data": resp}
 
@@ -913,30 +905,17 @@ def update_notification_channels(
     channels: NotificationChannelUpdate,
     user: dict = Depends(get_current_user)
 ):
-    res = (
-        supabase
-        .table("notification_type")
-        .update(channels.model_dump())
-        .eq("user_id", str(user_id))
-        .execute()
-    )
-    return {"success": True, "data": res.data}
+    rows = repos.channels.update(str(user_id), channels.model_dump())
+    return {"success": True, "data": rows}
 
 @app.get("/users/{user_id}/channels")
 def get_notification_channels(user_id: UUID, user: dict = Depends(get_current_user)):
-    res = (
-        supabase
-        .table("notification_type")
-        .select("*")
-        .eq("user_id", str(user_id))
-        .single()
-        .execute()
-    )
+    flags = repos.channels.get(str(user_id))
 
-    if not res.data:
+    if not flags:
         raise HTTPException(status_code=404, detail="Channels not found")
 
-    return res.data
+    return flags
 
 @app.post("/admin/employeesmgmt")
 def create_employee(data: EmployeeCreate, user: dict = Depends(admin_only)):
@@ -945,13 +924,13 @@ def create_employee(data: EmployeeCreate, user: dict = Depends(admin_only)):
     
     hashed_password = hash_password(data.password)
     
-    supabase.table("users").insert({
+    repos.users.insert({
         "name": data.name,
         "email": email,  # Use validated email
         "password": hashed_password,
         "role_id": data.role_id,
         "created_at": datetime.utcnow().isoformat(),
-    }).execute()
+    })
     return {"success": True}
 
 
@@ -965,7 +944,7 @@ def create_user(payload: CreateUserRequest, user: dict = Depends(admin_only)):
     password = build_default_password(payload.name, payload.phone)
     hashed_password = hash_password(password)
 
-    supabase.table("users").insert({
+    repos.users.insert({
         "user_id": user_id,
         "name": payload.name,
         "email": email,  # Use validated email
@@ -976,29 +955,17 @@ def create_user(payload: CreateUserRequest, user: dict = Depends(admin_only)):
         "is_active": True,
         "created_at": datetime.utcnow().isoformat(),
         "role_id": 4,
-    }).execute()
+    })
 
     # ... rest of the code
 
 
-# 5. Update CSV upload endpoint
-@app.post("/admin/users/upload-csv")
-async def upload_users_csv(
-    file: UploadFile = File(...),
-    user: dict = Depends(admin_only)
-):
-    try:
-        contents = await file.read()
-        text = contents.decode("utf-8", errors="replace")
-        stream = io.StringIO(text)
-        reader = csv.DictReader(stream)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid CSV file")
-
+def parse_users_csv(text: str, hash_fn=hash_password):
+    """Validated user rows and per-row errors from an uploaded CSV"""
     users = []
     errors = []
 
-    for row_num, row in enumerate(reader, start=2):
+    for row_num, row in enumerate(csv.DictReader(io.StringIO(text)), start=2):
         if not row.get("name") or not row.get("email") or not row.get("phone"):
             errors.append(f"Row {row_num}: Missing required fields")
             continue
@@ -1012,7 +979,7 @@ async def upload_users_csv(
 
         user_id = str(uuid.uuid4())
         password = build_default_password(row["name"], row["phone"])
-        hashed_password = hash_password(password)
+        hashed_password = hash_fn(password)
 
         users.append({
             "user_id": user_id,
@@ -1027,25 +994,21 @@ async def upload_users_csv(
             "role_id": 4,
         })
 
-        prefs.append({
-            "user_id": user_id,
-            "offers": True,
-            "order_updates": True,
-            "newsletter": True,
-        })
+    return users, errors
 
-        type_data.append({
-            "user_id": user_id,
-            "campaign_email": True,
-            "campaign_sms": True,
-            "campaign_push": True,
-            "newsletter_email": True,
-            "newsletter_sms": True,
-            "newsletter_push": True,
-            "update_email": True,
-            "update_sms": True,
-            "update_push": True,
-        })
+# 5. Update CSV upload endpoint
+@app.post("/admin/users/upload-csv")
+async def upload_users_csv(
+    file: UploadFile = File(...),
+    user: dict = Depends(admin_only)
+):
+    try:
+        contents = await file.read()
+        text = contents.decode("utf-8", errors="replace")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid CSV file")
+
+    users, errors = parse_users_csv(text)
 
     if not users:
         raise HTTPException(status_code=400, detail="No valid users found in CSV")
@@ -1054,13 +1017,7 @@ async def upload_users_csv(
     # Check for existing emails to avoid duplicates
     emails = [u["email"] for u in users]
     try:
-        existing_res = (
-            supabase.table("users")
-            .select("email")
-            .in_("email", emails)
-            .execute()
-        )
-        existing_emails = {r["email"] for r in (existing_res.data or [])}
+        existing_emails = repos.users.existing_emails(emails)
     except Exception as e:
         print("Error checking existing emails:", e)
         existing_emails = set()
@@ -1081,9 +1038,9 @@ async def upload_users_csv(
 
     # Insert into Supabase
     try:
-        supabase.table("users").insert(to_insert_users).execute()
-        supabase.table("user_preferences").insert(prefs_to_insert).execute()
-        supabase.table("notification_type").insert(types_to_insert).execute()
+        repos.users.insert(to_insert_users)
+        repos.preferences.insert(prefs_to_insert)
+        repos.channels.insert(types_to_insert)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to insert users: {str(e)}")
 
@@ -1104,77 +1061,70 @@ class CreateOrderRequest(BaseModel):
 def create_order(user_id: UUID, payload: CreateOrderRequest, user: dict = Depends(get_current_user)):
     order_id = str(uuid.uuid4())
 
-    res = (
-        supabase
-        .table("orders")
-        .insert({
-            "order_id": order_id,
-            "user_id": str(user_id),
-            "order_name": payload.order_name,
-            "status": "PLACED",
-        })
-        .execute()
-    )
+    order = repos.orders.create({
+        "order_id": order_id,
+        "user_id": str(user_id),
+        "order_name": payload.order_name,
+        "status": "PLACED",
+    })
 
-    if not res.data:
+    if not order:
         raise HTTPException(status_code=500, detail="Failed to create order")
 
-    return res.data[0]
+    return order
 
 @app.get("/admin/orders")
 def admin_orders(user: dict = Depends(admin_only)):
-    res = (
-        supabase
-        .table("orders")
-        .select("*")
-        .order("created_at", desc=True)
-        .execute()
-    )
-    return res.data or []
+    return repos.orders.list_all()
 
 @app.get("/users/{user_id}/orders")
 def get_user_orders(user_id: UUID, user: dict = Depends(get_current_user)):
-    res = (
-        supabase
-        .table("orders")
-        .select("*")
-        .eq("user_id", str(user_id))
-        .order("created_at", desc=True)
-        .execute()
-    )
-    return res.data or []
+    return repos.orders.list_for_user(str(user_id))
 
-@app.post("/users/{user_id}/orders/{order_id}/request-update")
-def request_order_update(user_id: UUID, order_id: UUID, user: dict = Depends(get_current_user)):
-    supabase.table("orders").update({
-        "status": "UPDATE_REQUESTED"
-    }).eq("order_id", str(order_id)).eq("user_id", str(user_id)).execute()
+def order_update_recipients(user_id: str) -> List[dict]:
+    """The order's owner, unless they turned off order updates."""
+    prefs = repos.preferences.get(user_id)
+    if not prefs or prefs.get("order_updates") is not True:
+        return []
+    recipient = repos.users.get(user_id, "user_id, email, phone")
+    return [recipient] if recipient else []
+
+async def notify_order_update(user_id: str, order: dict, content: str) -> dict:
+    """Push an ORDER_UPDATE to the owner, queued if offline; channels follow their update_* flags."""
+    result = await pipeline.run(DeliveryRequest(
+        "ORDER_UPDATE",
+        {
+            "type": "ORDER_UPDATE",
+            "order_id": str(order["order_id"]),
+            "order_name": order.get("order_name"),
+            "status": order.get("status"),
+            "title": f"Order {order.get('order_name') or order['order_id']}",
+            "content": content,
+        },
+        lambda after, limit: (order_update_recipients(user_id), None),
+    ))
+    return {"sent": result.delivered > 0, "queued": result.queued > 0}
+
+async def set_order_status(order_id: UUID, status: str, user_id: Optional[UUID] = None) -> dict:
+    owner = str(user_id) if user_id else None
+    rows = await asyncio.to_thread(repos.orders.set_status, str(order_id), status, owner)
+    if not rows:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return rows[0]
 
-    supabase.table("notification_logs").insert({
-        "log_id": str(uuid.uuid4()),
-        "user_id": str(user_id),
-        "notification_type": "ORDER_UPDATE",
-        "status": "PENDING",
-        "sent_at": datetime.utcnow().isoformat(),
-    }).execute()
+@app.post("/users/{user_id}/orders/{order_id}/request-update")
+async def request_order_update(user_id: UUID, order_id: UUID, user: dict = Depends(get_current_user)):
+    order = await set_order_status(order_id, "UPDATE_REQUESTED", user_id)
+    notified = await notify_order_update(str(user_id), order, "We've received your request for an update.")
 
-    return {"message": "Update requested"}
+    return {"message": "Update requested", **notified}
 
 @app.post("/admin/users/{user_id}/orders/{order_id}/send-update")
-def send_order_update(user_id: UUID, order_id: UUID, user: dict = Depends(admin_only)):
-    supabase.table("orders").update({
-        "status": "SENT"
-    }).eq("order_id", str(order_id)).execute()
+async def send_order_update(user_id: UUID, order_id: UUID, user: dict = Depends(admin_only)):
+    order = await set_order_status(order_id, "SENT", user_id)
+    notified = await notify_order_update(str(user_id), order, "Your order has been sent.")
 
-    supabase.table("notification_logs").insert({
-        "log_id": str(uuid.uuid4()),
-        "user_id": str(user_id),
-        "notification_type": "ORDER_UPDATE",
-        "status": "SUCCESS",
-        "sent_at": datetime.utcnow().isoformat(),
-    }).execute()
-
-    return {"message": "Order update sent"}
+    return {"message": "Order update sent", **notified}
 
 # Add this endpoint to your main.py file
 
@@ -1189,67 +1139,70 @@ def get_notification_logs(user: dict = Depends(get_current_user)):
     try:
         # If admin, return all logs
         if user["role_id"] == 1:
-            res = (
-                supabase
-                .table("notification_logs")
-                .select("*")
-                .order("sent_at", desc=True)
-                .execute()
-            )
-        else:
-            # Regular users see only their own logs
-            res = (
-                supabase
-                .table("notification_logs")
-                .select("*")
-                .eq("user_id", user["user_id"])
-                .order("sent_at", desc=True)
-                .execute()
-            )
-        
-        return res.data or []
+            return repos.logs.list()
+        # Regular users see only their own logs
+        return repos.logs.list(user_id=user["user_id"])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch logs: {str(e)}")
 
+@app.get("/admin/notification-logs/export")
+def export_notification_logs(
+    format: str = "csv",
+    user_id: Optional[str] = None,
+    notification_type: Optional[str] = None,
+    status: Optional[str] = None,
+    user: dict = Depends(admin_only),
+):
+    """Stream notification logs as CSV or NDJSON, optionally filtered."""
+    check_export_format(format)
+    filters = {
+        k: v for k, v in (("user_id", user_id), ("notification_type", notification_type), ("status", status))
+        if v is not None
+    }
+    return export_response(format, export_rows(repos.logs, LOG_EXPORT_COLUMNS, format, **filters), "notification_logs")
+
 @app.get("/admin/notification-logs/campaign/{campaign_id}")
 def get_campaign_logs(campaign_id: UUID, user: dict = Depends(get_current_user)):
-    """Get logs for a specific campaign"""
+    """Totals and daily counts for a campaign over its rollups and raw logs, plus the raw logs themselves"""
     try:
-        res = (
-            supabase
-            .table("notification_logs")
-            .select("*")
-            .eq("log_id", str(campaign_id))
-            .order("sent_at", desc=True)
-            .execute()
-        )
-        
-        return res.data or []
+        return ref_history(str(campaign_id))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch campaign logs: {str(e)}")
 
 @app.get("/admin/notification-logs/stats")
 def get_notification_stats(user: dict = Depends(admin_only)):
-    """Get notification statistics"""
+    """Get notification statistics from the daily rollups plus the raw tail"""
     try:
-        res = (
-            supabase
-            .table("notification_logs")
-            .select("*")
-            .execute()
-        )
-        
-        logs = res.data or []
-        
-        total = len(logs)
-        success = len([log for log in logs if log["status"] == "SUCCESS"])
-        failed = len([log for log in logs if log["status"] == "FAILED"])
-        
+        counts = log_totals()
+        total, success = counts["total"], counts["success"]
+
         return {
-            "total": total,
-            "success": success,
-            "failed": failed,
+            **counts,
             "success_rate": round((success / total * 100) if total > 0 else 0, 2)
         }
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to fetch stats: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to fetch stats: {str(e)}")
+
+@app.get("/admin/notification-logs/rollups")
+def get_notification_rollups(ref: Optional[str] = None, user: dict = Depends(admin_only)):
+    """Daily counts per notification type and status for compacted logs, optionally for one campaign"""
+    return repos.log_rollups.list(ref)
+
+@app.post("/admin/notification-logs/compact")
+async def compact_notification_logs(user: dict = Depends(admin_only)):
+    """Roll logs older than the retention window into daily rollups now"""
+    return await compactor.run_once()
+
+# ---------------- PROFILES ----------------
+@app.get("/admin/profiles")
+def get_profiles(user: dict = Depends(admin_only)):
+    """Recent request profiles, newest first (see profiler.py)"""
+    return list_profiles()
+
+@app.get("/admin/profiles/{name}")
+def download_profile(name: str, user: dict = Depends(admin_only)):
+    """One profile in collapsed-stack format, for flamegraph.pl or speedscope"""
+    path = profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="text/plain", filename=name)
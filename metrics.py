@@ -0,0 +1,241 @@
+"""Minimal in-process metrics with Prometheus text exposition.
+
+Recording is a dict lookup and an add under a lock, cheap enough to leave on
+in production. `MetricsMiddleware` times every HTTP request by route
+template; other modules record into the shared `registry`.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: dict) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(_label_key(self.labelnames, labels), 0)
+
+    def render(self) -> list:
+        with self.lock:
+            items = list(self.values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class CallbackGauge(Metric):
+    """Gauge whose value is computed at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def render(self) -> list:
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        return self.header() + [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [bucket counts..., +Inf count], sum
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> list:
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        lines = self.header()
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound) if bound != float("inf") else "+Inf"}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def callback_gauge(self, name: str, documentation: str, callback: Callable[[], float]) -> CallbackGauge:
+        return self.register(CallbackGauge(name, documentation, callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def resident_memory_bytes() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status")
+)
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "HTTP requests currently being served", ("method",)
+)
+websocket_events = registry.counter(
+    "websocket_events_total", "Websocket connects, disconnects and send failures", ("event",)
+)
+delivery_recipients = registry.counter(
+    "delivery_recipients_total", "Fan-out recipients by notification type and outcome", ("type", "outcome")
+)
+delivery_stage_items = registry.counter(
+    "delivery_stage_items_total", "Items processed per delivery pipeline stage", ("stage",)
+)
+delivery_stage_seconds = registry.counter(
+    "delivery_stage_seconds_total", "Time spent per delivery pipeline stage", ("stage",)
+)
+channel_messages = registry.counter(
+    "channel_messages_total", "Messages handled per channel transport", ("channel", "result")
+)
+channel_queue_seconds = registry.histogram(
+    "channel_queue_seconds", "Time a message waited in a channel transport queue", ("channel", "lane")
+)
+push_queue_seconds = registry.histogram(
+    "push_queue_seconds", "Time a push waited for its connection before being written", ("lane",)
+)
+registry.callback_gauge(
+    "process_resident_memory_bytes", "Resident memory size in bytes", resident_memory_bytes
+)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware so streaming responses are not buffered."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc(method=method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec(method=method)
+            http_request_duration.observe(
+                time.perf_counter() - started, method=method, route=self._route(scope), status=status["code"]
+            )
+
+    @staticmethod
+    def _route(scope) -> str:
+        # label by route template, not raw path, to keep cardinality bounded;
+        # the router stores the route it matched in the shared scope
+        route = scope.get("route")
+        if route is None:
+            return "unmatched"
+        return getattr(route, "path", "unknown")
@@ -0,0 +1,67 @@
+-- Schema for the delivery pipeline, send jobs, acks, log retention and
+-- delivery funnels, on top of the original Supabase tables. Safe to re-run.
+-- The local SQLite stand-in builds the same tables from local_backend.SCHEMA.
+
+-- shared bodies of queued notifications (pending rows reference them)
+create table if not exists notification_messages (
+    message_id uuid primary key,
+    payload jsonb,
+    created_at timestamptz default now()
+);
+
+alter table pending_notifications add column if not exists message_id uuid;
+alter table pending_notifications add column if not exists read_at timestamptz;
+create index if not exists pending_user on pending_notifications (user_id, created_at);
+
+alter table notification_logs add column if not exists message_id uuid;
+alter table notification_logs add column if not exists acked_at timestamptz;
+alter table notification_logs add column if not exists ref text;
+alter table notification_logs add column if not exists channels text;
+create index if not exists logs_user on notification_logs (user_id, sent_at);
+create index if not exists logs_sent_at on notification_logs (sent_at);
+create index if not exists logs_message on notification_logs (message_id, user_id);
+create index if not exists logs_ref on notification_logs (ref, sent_at);
+
+-- daily counts of notification_logs rows older than LOG_RETENTION_DAYS
+create table if not exists notification_log_rollups (
+    rollup_id text primary key,
+    day text,
+    notification_type text,
+    status text,
+    ref text,
+    total int,
+    acked int
+);
+
+-- per campaign/newsletter delivery funnel
+create table if not exists delivery_funnels (
+    ref text primary key,
+    kind text,
+    targeted int,
+    delivered int,
+    queued int,
+    flushed int,
+    acked int,
+    failed int,
+    updated_at timestamptz
+);
+
+-- campaign/newsletter send jobs and their checkpoints
+create table if not exists send_jobs (
+    job_id uuid primary key,
+    kind text not null,
+    target_id text not null,
+    status text not null,
+    cursor text,
+    params jsonb,
+    progress jsonb,
+    result jsonb,
+    error text,
+    run_at timestamptz,
+    updated_at timestamptz
+);
+create index if not exists send_jobs_target on send_jobs (kind, target_id, status);
+
+create index if not exists users_customers on users (role_id, is_active, user_id);
+create index if not exists users_email on users (email);
+create index if not exists orders_user on orders (user_id, created_at);
@@ -0,0 +1,185 @@
+"""Opt-in sampling profiler for slow requests.
+
+With PROFILE_ENABLED=true, `ProfilerMiddleware` samples the Python stacks
+of every thread every PROFILE_INTERVAL_MS while a request is in flight.
+The profile is kept when the request took PROFILE_THRESHOLD_MS or longer,
+or when it was picked by PROFILE_SAMPLE_RATE (a fraction of all requests).
+Profiles are written to PROFILE_DIR in collapsed-stack format, one
+`frame;frame;frame count` line per distinct stack, which flamegraph.pl and
+speedscope read directly. Only the newest PROFILE_KEEP files are kept.
+
+Stacks are sampled process-wide: the event loop, threadpool handlers and
+`to_thread` work all show up, so overlapping requests share samples. Idle
+threads (blocked in selectors, queues or locks) are skipped.
+"""
+import asyncio
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_THRESHOLD_MS = float(os.getenv("PROFILE_THRESHOLD_MS", "1000"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+
+PROFILE_SUFFIX = ".collapsed"
+# innermost frames in these files mean the thread is waiting, not working
+IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """One background thread sampling all stacks while any request is profiled."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active: Dict[int, Counter] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.next_id = 0
+
+    def begin(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            self.active[self.next_id] = Counter()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self.thread.start()
+            return self.next_id
+
+    def end(self, token: int) -> Counter:
+        with self.lock:
+            return self.active.pop(token, Counter())
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+            stacks = self.sample(skip=me)
+            with self.lock:
+                for counts in self.active.values():
+                    counts.update(stacks)
+            time.sleep(self.interval)
+
+    @staticmethod
+    def sample(skip: Optional[int] = None) -> List[str]:
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == skip or os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            stacks.append(";".join(reversed(labels)))
+        return stacks
+
+
+sampler = Sampler()
+
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", text).strip("_")[:60] or "root"
+
+
+def write_profile(counts: Counter, method: str, path: str, elapsed_ms: float, directory: str = PROFILE_DIR) -> str:
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    name = f"{stamp}-{method}-{_slug(path)}-{int(elapsed_ms)}ms{PROFILE_SUFFIX}"
+    with open(os.path.join(directory, name), "w") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+    _prune(directory)
+    return name
+
+
+def _prune(directory: str, keep: int = PROFILE_KEEP):
+    names = sorted(n for n in os.listdir(directory) if n.endswith(PROFILE_SUFFIX))
+    for name in names[:-keep] if keep > 0 else []:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+
+def list_profiles(directory: str = PROFILE_DIR) -> List[dict]:
+    """Newest first, with the request details parsed back out of the file name."""
+    if not os.path.isdir(directory):
+        return []
+    out = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith(PROFILE_SUFFIX):
+            continue
+        stamp, method, rest = name[:-len(PROFILE_SUFFIX)].split("-", 2)
+        path, _, elapsed = rest.rpartition("-")
+        out.append({
+            "name": name,
+            "created_at": datetime.strptime(stamp, "%Y%m%dT%H%M%S%f").isoformat(),
+            "method": method,
+            "path": path,
+            "elapsed_ms": int(elapsed.rstrip("ms") or 0),
+            "bytes": os.path.getsize(os.path.join(directory, name)),
+        })
+    return out
+
+
+def profile_path(name: str, directory: str = PROFILE_DIR) -> Optional[str]:
+    """Path of a listed profile; anything else (including ../ tricks) is None."""
+    if os.path.basename(name) != name or not name.endswith(PROFILE_SUFFIX):
+        return None
+    path = os.path.join(directory, name)
+    return path if os.path.isfile(path) else None
+
+
+class ProfilerMiddleware:
+    """Pure ASGI middleware; a no-op unless PROFILE_ENABLED is set."""
+
+    def __init__(
+        self,
+        app,
+        enabled: bool = PROFILE_ENABLED,
+        threshold_ms: float = PROFILE_THRESHOLD_MS,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+    ):
+        self.app = app
+        self.enabled = enabled
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled and self.threshold_ms <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        token = sampler.begin()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            counts = sampler.end(token)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if counts and (sampled or (self.threshold_ms > 0 and elapsed_ms >= self.threshold_ms)):
+                try:
+                    await asyncio.to_thread(write_profile, counts, scope["method"], scope["path"], elapsed_ms)
+                except Exception:
+                    print("Warning: failed to write request profile")
@@ -0,0 +1,468 @@
+"""Repository layer over the data backend.
+
+Handlers and background workers go through these repositories instead of
+building queries themselves. Every repository speaks the supabase-py query
+builder protocol, which both backends implement:
+
+* Supabase (PostgREST) - the default, DATA_BACKEND=supabase
+* local SQLite, file or in-memory - DATA_BACKEND=local (see local_backend.py)
+
+so swapping the backend in supabase_client.py swaps it for the whole app.
+
+Single-row reads are `memoized` per request (see db_instrumentation.py);
+every write through a repository drops the memoized reads of its table.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+from db_instrumentation import forget, memoized
+from supabase_client import supabase
+
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "1024"))
+
+
+def chunked(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def inbox_cursor(row: dict) -> str:
+    """Position of an inbox row; rows queued together share created_at, so the id breaks ties."""
+    return f"{row['created_at']}|{row['id']}"
+
+
+def split_cursor(cursor: str) -> tuple:
+    """(created_at, id) of an `inbox_cursor`; a bare created_at has no id."""
+    created_at, _, row_id = cursor.partition("|")
+    return created_at, row_id or None
+
+
+class Repository:
+    table = ""
+    # primary key, for keyset paging with `scan`
+    key = ""
+    # `in` filters are split so URLs stay under PostgREST limits
+    lookup_batch_size = 500
+
+    def __init__(self, client):
+        self.client = client
+
+    def query(self):
+        return self.client.table(self.table)
+
+    def write(self, query):
+        forget(self.table)
+        return query.execute().data
+
+    def insert(self, rows):
+        return self.write(self.query().insert(rows))
+
+    def upsert(self, rows):
+        return self.write(self.query().upsert(rows))
+
+    def scan(self, columns: str, after: Optional[str], limit: int, **filters) -> List[dict]:
+        """One keyset page ordered by `key`, starting after `after`; filters are equality matches."""
+        query = self.query().select(columns)
+        for column, value in filters.items():
+            query = query.eq(column, value)
+        if after is not None:
+            query = query.gt(self.key, after)
+        return query.order(self.key).limit(limit).execute().data or []
+
+
+class UserRepository(Repository):
+    table = "users"
+    key = "user_id"
+
+    @memoized
+    def get(self, user_id: str, columns: str = "*") -> Optional[dict]:
+        rows = self.query().select(columns).eq("user_id", user_id).limit(1).execute().data
+        return rows[0] if rows else None
+
+    def find_by_email(self, email: str, active_only: bool = False) -> Optional[dict]:
+        query = self.query().select("*").eq("email", email)
+        if active_only:
+            query = query.eq("is_active", True)
+        rows = query.limit(1).execute().data
+        return rows[0] if rows else None
+
+    def existing_emails(self, emails: List[str]) -> set:
+        found = set()
+        for batch in chunked(emails, self.lookup_batch_size):
+            rows = self.query().select("email").in_("email", batch).execute().data or []
+            found.update(r["email"] for r in rows)
+        return found
+
+    def list_customers(self) -> List[dict]:
+        return self.query().select("*").eq("role_id", 4).order("created_at", desc=True).execute().data or []
+
+    def list_employees(self) -> List[dict]:
+        return (
+            self.query()
+            .select("user_id, name, email, role_id")
+            .in_("role_id", [1, 2, 3])
+            .order("email")
+            .execute()
+            .data
+        ) or []
+
+    def page_active_customers(self, after: Optional[str], limit: int, columns: str) -> List[dict]:
+        """One keyset page of active customers ordered by user_id."""
+        query = self.query().select(columns).eq("is_active", True).eq("role_id", 4)
+        if after:
+            query = query.gt("user_id", after)
+        return query.order("user_id").limit(limit).execute().data or []
+
+    def update(self, user_id: str, fields: dict) -> List[dict]:
+        return self.write(self.query().update(fields).eq("user_id", user_id))
+
+    def delete(self, user_id: str) -> List[dict]:
+        return self.write(self.query().delete().eq("user_id", user_id))
+
+    def update_many(self, user_ids: List[str], fields: dict) -> List[dict]:
+        """One set-based UPDATE per batch; returns the rows that matched."""
+        rows = []
+        for batch in chunked(user_ids, self.lookup_batch_size):
+            rows.extend(self.write(self.query().update(fields).in_("user_id", batch)) or [])
+        return rows
+
+    def delete_many(self, user_ids: List[str]) -> List[dict]:
+        rows = []
+        for batch in chunked(user_ids, self.lookup_batch_size):
+            rows.extend(self.write(self.query().delete().in_("user_id", batch)) or [])
+        return rows
+
+
+class PreferenceRepository(Repository):
+    table = "user_preferences"
+
+    @memoized
+    def get(self, user_id: str) -> Optional[dict]:
+        rows = self.query().select("*").eq("user_id", user_id).limit(1).execute().data
+        return rows[0] if rows else None
+
+    def update(self, user_id: str, fields: dict) -> List[dict]:
+        return self.write(self.query().update(fields).eq("user_id", user_id))
+
+
+class ChannelRepository(Repository):
+    """Per-user channel flags in `notification_type`."""
+
+    table = "notification_type"
+
+    @memoized
+    def get(self, user_id: str) -> Optional[dict]:
+        rows = self.query().select("*").eq("user_id", user_id).limit(1).execute().data
+        return rows[0] if rows else None
+
+    def get_many(self, user_ids: List[str]) -> List[dict]:
+        rows = []
+        for batch in chunked(user_ids, self.lookup_batch_size):
+            rows.extend(self.query().select("*").in_("user_id", batch).execute().data or [])
+        return rows
+
+    def update(self, user_id: str, fields: dict) -> List[dict]:
+        return self.write(self.query().update(fields).eq("user_id", user_id))
+
+
+class CampaignRepository(Repository):
+    table = "campaigns"
+    key = "campaign_id"
+
+    @memoized
+    def get(self, target_id: str) -> Optional[dict]:
+        rows = self.query().select("*").eq(self.key, str(target_id)).limit(1).execute().data
+        return rows[0] if rows else None
+
+    def list(self, created_before: Optional[str] = None) -> List[dict]:
+        query = self.query().select("*")
+        if created_before:
+            query = query.lte("created_at", created_before)
+        return query.order("created_at", desc=True).execute().data or []
+
+    def create(self, row: dict) -> Optional[dict]:
+        rows = self.insert(row)
+        return rows[0] if rows else None
+
+    def set_status(self, target_id: str, status: str):
+        self.write(self.query().update({"status": status}).eq(self.key, str(target_id)))
+
+
+class NewsletterRepository(CampaignRepository):
+    table = "newsletters"
+    key = "newsletter_id"
+
+
+class OrderRepository(Repository):
+    table = "orders"
+
+    def create(self, row: dict) -> Optional[dict]:
+        rows = self.insert(row)
+        return rows[0] if rows else None
+
+    def list_all(self) -> List[dict]:
+        return self.query().select("*").order("created_at", desc=True).execute().data or []
+
+    def list_for_user(self, user_id: str) -> List[dict]:
+        return (
+            self.query().select("*").eq("user_id", user_id).order("created_at", desc=True).execute().data
+        ) or []
+
+    def set_status(self, order_id: str, status: str, user_id: Optional[str] = None) -> List[dict]:
+        query = self.query().update({"status": status}).eq("order_id", order_id)
+        if user_id:
+            query = query.eq("user_id", user_id)
+        return self.write(query)
+
+
+class PendingNotificationRepository(Repository):
+    table = "pending_notifications"
+
+    def list_for_user(self, user_id: str, newest_first: bool = False) -> List[dict]:
+        return (
+            self.query().select("*").eq("user_id", user_id).order("created_at", desc=newest_first).execute().data
+        ) or []
+
+    def page(
+        self,
+        user_id: str,
+        limit: int,
+        since: Optional[str] = None,
+        before: Optional[str] = None,
+        unread_only: bool = False,
+    ) -> List[dict]:
+        """Keyset page of a user's inbox by (created_at, id); cursors come from `inbox_cursor`.
+
+        With `since`, rows newer than it, oldest first (incremental polling);
+        otherwise newest first, older than `before` when given.
+        """
+        def query():
+            q = self.query().select("id, payload, message_id, created_at, read_at").eq("user_id", user_id)
+            return q.is_("read_at", "null") if unread_only else q
+
+        def past(q, column: str, value: str):
+            return q.lt(column, value) if desc else q.gt(column, value)
+
+        desc = not since
+        cursor = since or before
+        rows = []
+        if cursor:
+            # rows sharing the cursor's created_at past its id, then the strictly older/newer ones
+            created_at, row_id = split_cursor(cursor)
+            if row_id:
+                q = past(query().eq("created_at", created_at), "id", row_id)
+                rows = q.order("id", desc=desc).limit(limit).execute().data or []
+            if len(rows) == limit:
+                return rows
+            q = past(query(), "created_at", created_at)
+        else:
+            q = query()
+        q = q.order("created_at", desc=desc).order("id", desc=desc).limit(limit - len(rows))
+        return rows + (q.execute().data or [])
+
+    def unread_count(self, user_id: str) -> int:
+        res = (
+            self.query()
+            .select("id", count="exact")
+            .eq("user_id", user_id)
+            .is_("read_at", "null")
+            .limit(1)
+            .execute()
+        )
+        return res.count or 0
+
+    def mark_read(self, user_id: str, read_at: str, ids: Optional[List[str]] = None, up_to: Optional[str] = None) -> int:
+        """Mark the given ids, or everything up to and including the `up_to` cursor, as read."""
+        created_at, row_id = split_cursor(up_to) if up_to else (None, None)
+        marked = 0
+        for batch in (chunked(ids, self.lookup_batch_size) if ids else [None]):
+            def unread():
+                query = self.query().update({"read_at": read_at}).eq("user_id", user_id).is_("read_at", "null")
+                return query.in_("id", batch) if batch is not None else query
+
+            if row_id:
+                # older rows, plus the ones sharing the cursor's created_at up to its id
+                marked += len(self.write(unread().lt("created_at", created_at)) or [])
+                marked += len(self.write(unread().eq("created_at", created_at).lte("id", row_id)) or [])
+            elif created_at:
+                marked += len(self.write(unread().lte("created_at", created_at)) or [])
+            else:
+                marked += len(self.write(unread()) or [])
+        return marked
+
+    def delete(self, notification_id: str):
+        self.write(self.query().delete().eq("id", notification_id))
+
+    def delete_many(self, notification_ids: List[str]):
+        for batch in chunked(notification_ids, self.lookup_batch_size):
+            self.write(self.query().delete().in_("id", batch))
+
+
+class MessageRepository(Repository):
+    """Bodies shared by many queued notifications.
+
+    A campaign queued for 100k offline users is stored once here; each
+    pending_notifications row only carries its `message_id`. Messages never
+    change after they are written, so resolved bodies are kept in a
+    process-wide LRU cache.
+    """
+
+    table = "notification_messages"
+
+    def __init__(self, client, cache_size: int = MESSAGE_CACHE_SIZE):
+        super().__init__(client)
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[str, dict]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, message_ids: Iterable[str]) -> Dict[str, dict]:
+        """Payloads by message_id, from the cache where possible."""
+        found, missing = {}, []
+        with self.lock:
+            for message_id in set(message_ids):
+                if message_id in self.cache:
+                    self.cache.move_to_end(message_id)
+                    found[message_id] = self.cache[message_id]
+                else:
+                    missing.append(message_id)
+        for batch in chunked(missing, self.lookup_batch_size):
+            rows = self.query().select("message_id, payload").in_("message_id", batch).execute().data or []
+            with self.lock:
+                for row in rows:
+                    found[row["message_id"]] = row["payload"]
+                    self.cache[row["message_id"]] = row["payload"]
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return found
+
+    def attach(self, rows: List[dict]) -> List[dict]:
+        """Fill in `payload` on pending rows that only reference a shared message."""
+        ids = [r["message_id"] for r in rows if r.get("message_id") and not r.get("payload")]
+        if ids:
+            payloads = self.get_many(ids)
+            for row in rows:
+                if row.get("message_id") and not row.get("payload"):
+                    row["payload"] = payloads.get(row["message_id"])
+        return rows
+
+
+class NotificationLogRepository(Repository):
+    table = "notification_logs"
+    key = "log_id"
+
+    def list(self, user_id: Optional[str] = None) -> List[dict]:
+        query = self.query().select("*")
+        if user_id:
+            query = query.eq("user_id", user_id)
+        return query.order("sent_at", desc=True).execute().data or []
+
+    def list_by_ref(self, ref: str) -> List[dict]:
+        """Rows of one campaign or newsletter send."""
+        return self.query().select("*").eq("ref", ref).order("sent_at", desc=True).execute().data or []
+
+    def count(self, status: Optional[str] = None, acked: bool = False) -> int:
+        """Exact row count, optionally of one status or of acked rows only."""
+        query = self.query().select("log_id", count="exact")
+        if status:
+            query = query.eq("status", status)
+        if acked:
+            query = query.not_.is_("acked_at", "null")
+        return query.limit(1).execute().count or 0
+
+    def page_before(self, cutoff: str, after: Optional[str], limit: int, columns: str) -> List[dict]:
+        """Keyset page (by log_id) of rows sent before `cutoff`."""
+        query = self.query().select(columns).lt("sent_at", cutoff)
+        if after is not None:
+            query = query.gt("log_id", after)
+        return query.order("log_id").limit(limit).execute().data or []
+
+    def delete_many(self, log_ids: List[str]):
+        for batch in chunked(log_ids, self.lookup_batch_size):
+            self.write(self.query().delete().in_("log_id", batch))
+
+    def mark_acked(self, message_id: str, user_ids: List[str], acked_at: str):
+        """Record client acks for one message; a replayed PENDING row becomes SUCCESS."""
+        self.write(
+            self.query()
+            .update({"status": "SUCCESS", "acked_at": acked_at})
+            .eq("message_id", message_id)
+            .in_("user_id", user_ids)
+        )
+
+
+class LogRollupRepository(Repository):
+    """Per-day, per-type, per-status counts of compacted notification_logs rows."""
+
+    table = "notification_log_rollups"
+    key = "rollup_id"
+
+    def get_many(self, rollup_ids: List[str]) -> List[dict]:
+        rows = []
+        for batch in chunked(rollup_ids, self.lookup_batch_size):
+            rows.extend(self.query().select("*").in_("rollup_id", batch).execute().data or [])
+        return rows
+
+    def list(self, ref: Optional[str] = None) -> List[dict]:
+        query = self.query().select("*")
+        if ref:
+            query = query.eq("ref", ref)
+        return query.order("day", desc=True).execute().data or []
+
+
+class FunnelRepository(Repository):
+    """Running delivery counts per campaign/newsletter, see funnels.py."""
+
+    table = "delivery_funnels"
+    key = "ref"
+
+    def get(self, ref: str) -> Optional[dict]:
+        rows = self.query().select("*").eq("ref", ref).limit(1).execute().data
+        return rows[0] if rows else None
+
+    def get_many(self, refs: List[str]) -> List[dict]:
+        rows = []
+        for batch in chunked(refs, self.lookup_batch_size):
+            rows.extend(self.query().select("*").in_("ref", batch).execute().data or [])
+        return rows
+
+
+class SendJobRepository(Repository):
+    table = "send_jobs"
+
+    def find(self, kind: str, target_id: str, statuses: Iterable[str]) -> Optional[dict]:
+        rows = (
+            self.query()
+            .select("*")
+            .eq("kind", kind)
+            .eq("target_id", target_id)
+            .in_("status", list(statuses))
+            .order("updated_at", desc=True)
+            .limit(1)
+            .execute()
+            .data
+        )
+        return rows[0] if rows else None
+
+    def with_status(self, status: str) -> List[dict]:
+        return self.query().select("*").eq("status", status).execute().data or []
+
+
+class Repositories:
+    def __init__(self, client):
+        self.users = UserRepository(client)
+        self.preferences = PreferenceRepository(client)
+        self.channels = ChannelRepository(client)
+        self.campaigns = CampaignRepository(client)
+        self.newsletters = NewsletterRepository(client)
+        self.orders = OrderRepository(client)
+        self.pending = PendingNotificationRepository(client)
+        self.messages = MessageRepository(client)
+        self.logs = NotificationLogRepository(client)
+        self.log_rollups = LogRollupRepository(client)
+        self.funnels = FunnelRepository(client)
+        self.send_jobs = SendJobRepository(client)
+
+
+repos = Repositories(supabase)
@@ -1,21 +1,52 @@
-"""Simple script to POST to your campaign send endpoint.
+"""Simple script to POST to your campaign send endpoint and follow the send job.
 Requires: pip install requests
-Usage: python send_trigger.py --campaign <campaign-id> --host http://127.0.0.1:8000
+Usage: python send_trigger.py --campaign <campaign-id> --host http://127.0.0.1:8000 --token <session-token>
 """
 import argparse
+import json
 import requests
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser()
-    p.add_argument('--campaign', required=True, help='Campaign id to trigger')
+    p.add_argument('--campaign', help='Campaign id to trigger')
+    p.add_argument('--newsletter', help='Newsletter id to trigger')
     p.add_argument('--host', default='http://127.0.0.1:9100', help='API base URL')
+    p.add_argument('--token', help='Session token from /auth/user/login')
+    p.add_argument('--no-follow', action='store_true', help='Return after the job is enqueued')
     args = p.parse_args()
 
-    url = args.host.rstrip('/') + f'/campaigns/{args.campaign}/send'
+    if bool(args.campaign) == bool(args.newsletter):
+        p.error('pass exactly one of --campaign or --newsletter')
+
+    base = args.host.rstrip('/')
+    if args.campaign:
+        url = base + f'/campaigns/{args.campaign}/send'
+        body = {}
+    else:
+        url = base + f'/newsletters/{args.newsletter}/send'
+        body = None
+    headers = {'Authorization': f'Bearer {args.token}'} if args.token else {}
+
     try:
-        r = requests.post(url)
+        r = requests.post(url, json=body, headers=headers)
         print('Status:', r.status_code)
         print('Response:', r.text)
+        if r.status_code != 202 or args.no_follow:
+            raise SystemExit(0)
+
+        # follow the job until it finishes
+        status_url = base + r.json()['status_url']
+        with requests.get(status_url, headers=headers, stream=True) as s:
+            for line in s.iter_lines():
+                if not line:
+                    continue
+                snap = json.loads(line)
+                print(
+                    f"[{snap['status']}] {snap.get('processed', 0)}/{snap.get('recipients', 0)} processed, "
+                    f"delivered={snap.get('delivered', 0)} queued={snap.get('queued', 0)} "
+                    f"failed={snap.get('failed', 0)} elapsed={snap['elapsed_seconds']}s"
+                )
+                if snap['status'] == 'FAILED':
+                    print('Error:', snap['error'])
     except Exception as e:
         print('Request failed:', e)
-
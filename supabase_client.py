@@ -1,14 +1,52 @@
 import os
-from supabase import create_client, Client
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from db_instrumentation import InstrumentedClient
 
 load_dotenv()
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+# DATA_BACKEND=local runs against a SQLite stand-in (see local_backend.py)
+DATA_BACKEND = os.getenv("DATA_BACKEND", "supabase")
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Supabase environment variables not set")
+if DATA_BACKEND == "local":
+    from local_backend import LocalClient
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    client = LocalClient(os.getenv("LOCAL_DB_PATH", ":memory:"))
+    http_client = None
+else:
+    from supabase import create_client
+    from supabase.lib.client_options import SyncClientOptions
+    from http_pool import build_http_client
 
+    SUPABASE_URL = os.getenv("SUPABASE_URL")
+    SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ValueError("Supabase environment variables not set")
+
+    # one keep-alive pool shared by every query (see http_pool.py)
+    http_client = build_http_client()
+    client = create_client(SUPABASE_URL, SUPABASE_KEY, options=SyncClientOptions(httpx_client=http_client))
+
+# every query is timed and attributed to the current request
+supabase = InstrumentedClient(client)
+
+
+def warm_up(connections: int = 0):
+    """Open `connections` pooled connections with cheap concurrent reads."""
+    if http_client is None or connections <= 0:
+        return
+
+    def ping(_):
+        try:
+            client.table("users").select("user_id").limit(1).execute()
+        except Exception:
+            print("Warning: Supabase warm-up query failed")
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        list(executor.map(ping, range(connections)))
+
+
+def close():
+    if http_client is not None:
+        http_client.close()
@@ -0,0 +1,147 @@
+"""Personalized campaign/newsletter content.
+
+Content may use placeholders filled in per recipient, with an optional
+fallback for recipients missing the field:
+
+    Hi {{first_name|there}}, new offers in {{city|your city}}!
+
+Supported fields are in FIELDS; anything else is left in the text as-is
+(`unknown_placeholders` lets the create endpoints reject typos).
+
+A template is parsed once per distinct source text and cached
+(`compile_template`). During a fan-out, recipients are grouped by the
+field values their templates actually use, each group is rendered once, and
+all its members get the same message dict, so the wire frame cache encodes
+it once per format. A campaign that only uses {{city}} renders a handful of
+variants no matter how many recipients it has.
+"""
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "256"))
+# rendered variants kept per send, shared across its pages
+TEMPLATE_RENDER_CACHE = int(os.getenv("TEMPLATE_RENDER_CACHE", "4096"))
+TEMPLATED_KEYS = ("title", "content")
+
+PLACEHOLDER = re.compile(r"\{\{\s*([A-Za-z_]+)\s*(?:\|([^}]*))?\}\}")
+
+
+def _first_name(recipient: dict) -> Optional[str]:
+    name = (recipient.get("name") or "").strip()
+    return name.split()[0] if name else None
+
+
+FIELDS = {
+    "name": lambda r: r.get("name"),
+    "first_name": _first_name,
+    "city": lambda r: r.get("city"),
+    "email": lambda r: r.get("email"),
+}
+
+
+class Template:
+    """Literal text and placeholders, parsed once."""
+
+    __slots__ = ("source", "parts", "fields")
+
+    def __init__(self, source: str):
+        self.source = source
+        # str for literal text, (field, default) for placeholders
+        self.parts: List[object] = []
+        self.fields: List[str] = []
+        pos = 0
+        for match in PLACEHOLDER.finditer(source):
+            field = match.group(1).lower()
+            if field not in FIELDS:
+                continue
+            if match.start() > pos:
+                self.parts.append(source[pos:match.start()])
+            self.parts.append((field, (match.group(2) or "").strip()))
+            if field not in self.fields:
+                self.fields.append(field)
+            pos = match.end()
+        if pos < len(source):
+            self.parts.append(source[pos:])
+
+    @property
+    def is_static(self) -> bool:
+        return not self.fields
+
+    def values(self, recipient: dict) -> tuple:
+        return tuple(FIELDS[field](recipient) for field in self.fields)
+
+    def render(self, values: tuple) -> str:
+        by_field = dict(zip(self.fields, values))
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+            else:
+                field, default = part
+                out.append(str(by_field.get(field) or default))
+        return "".join(out)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(source: str) -> Template:
+    return Template(source)
+
+
+def unknown_placeholders(source: Optional[str]) -> List[str]:
+    return sorted({m.group(1) for m in PLACEHOLDER.finditer(source or "") if m.group(1).lower() not in FIELDS})
+
+
+class Personalization:
+    """Renders a payload's templated keys for pages of recipients."""
+
+    def __init__(self, payload: dict, keys: Tuple[str, ...] = TEMPLATED_KEYS, cache_size: int = TEMPLATE_RENDER_CACHE):
+        self.payload = payload
+        self.templates: Dict[str, Template] = {}
+        for key in keys:
+            if isinstance(payload.get(key), str):
+                template = compile_template(payload[key])
+                if not template.is_static:
+                    self.templates[key] = template
+        self.cache_size = cache_size
+        # field values -> (rendered payload, variant key)
+        self.rendered: "OrderedDict[tuple, Tuple[dict, str]]" = OrderedDict()
+
+    @property
+    def is_static(self) -> bool:
+        return not self.templates
+
+    def groups(self, recipients: List[dict]) -> List[Tuple[dict, List[dict], Optional[str]]]:
+        """(payload, recipients, variant key) per distinct rendering; the key is None when static."""
+        if self.is_static:
+            return [(self.payload, recipients, None)]
+        members: Dict[tuple, List[dict]] = {}
+        templates = list(self.templates.items())
+        for recipient in recipients:
+            values = tuple(t.values(recipient) for _, t in templates)
+            members.setdefault(values, []).append(recipient)
+        # different values can still render the same (a missing field vs its fallback)
+        variants: Dict[str, Tuple[dict, List[dict]]] = {}
+        for values, group in members.items():
+            payload, variant = self._render(values)
+            if variant in variants:
+                variants[variant][1].extend(group)
+            else:
+                variants[variant] = (payload, group)
+        return [(payload, group, variant) for variant, (payload, group) in variants.items()]
+
+    def _render(self, values: tuple) -> Tuple[dict, str]:
+        cached = self.rendered.get(values)
+        if cached is not None:
+            self.rendered.move_to_end(values)
+            return cached
+        fields = {key: t.render(v) for (key, t), v in zip(self.templates.items(), values)}
+        variant = hashlib.sha1("\x00".join(fields[k] for k in sorted(fields)).encode("utf-8")).hexdigest()
+        cached = ({**self.payload, **fields}, variant)
+        self.rendered[values] = cached
+        while len(self.rendered) > self.cache_size:
+            self.rendered.popitem(last=False)
+        return cached
@@ -1,37 +1,138 @@
 """Simple Python WebSocket client for testing notifications.
-Requires: pip install websockets
+Requires: pip install websockets (and msgpack for --format msgpack)
 Usage: python test_client.py --user user-123 --server ws://127.0.0.1:8000/ws/notifications/
+       python test_client.py --user user-123 --format msgpack --compress deflate --ack
 """
 import argparse
 import asyncio
 import json
+import zlib
+from urllib.parse import urlencode
 import websockets
 
-async def run(uri):
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# first byte of binary frames, see wire.py
+FLAG_MSGPACK = 0x01
+FLAG_DEFLATE = 0x02
+
+
+def decode(msg):
+    if isinstance(msg, bytes):
+        flags, body = msg[0], msg[1:]
+        if flags & FLAG_DEFLATE:
+            body = zlib.decompress(body)
+        if flags & FLAG_MSGPACK:
+            return msgpack.unpackb(body, raw=False)
+        return json.loads(body)
+    try:
+        return json.loads(msg)
+    except Exception:
+        return msg
+
+
+class ByteStats:
+    """Wire bytes received versus the same messages as plain JSON text."""
+
+    def __init__(self):
+        self.messages = 0
+        self.wire_bytes = 0
+        self.json_bytes = 0
+
+    def add(self, raw, decoded) -> tuple:
+        wire = len(raw) if isinstance(raw, bytes) else len(raw.encode("utf-8"))
+        plain = len(json.dumps(decoded, default=str).encode("utf-8"))
+        self.messages += 1
+        self.wire_bytes += wire
+        self.json_bytes += plain
+        return wire, plain
+
+    def summary(self) -> str:
+        saved = self.json_bytes - self.wire_bytes
+        pct = saved / self.json_bytes * 100 if self.json_bytes else 0
+        return (f"{self.messages} messages, {self.wire_bytes} bytes on the wire vs "
+                f"{self.json_bytes} as JSON ({saved} saved, {pct:.1f}%)")
+
+
+def with_params(uri, fmt=None, compress=None, ack=False):
+    params = {k: v for k, v in (("format", fmt), ("compress", compress), ("ack", "1" if ack else None)) if v}
+    return f"{uri}?{urlencode(params)}" if params else uri
+
+
+async def send_acks(ws, ids, interval):
+    """Acknowledge received msg_ids in batches every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        if ids:
+            batch = list(ids)
+            ids.clear()
+            await ws.send(json.dumps({"type": "ACK", "ids": batch}))
+
+
+async def listen(uri, on_message, on_connect=None, retry_delay=2, quiet=False, stats=None, ack=False, ack_interval=0.2):
+    """Connect to `uri` and call `on_message(decoded)` for every frame, reconnecting on errors.
+
+    With `ack`, msg_ids are acknowledged in batches (connect with ?ack=1, see with_params).
+    """
     while True:
+        acker = None
         try:
-            async with websockets.connect(uri) as ws:
-                print(f"Connected to {uri}")
+            async with websockets.connect(uri, max_size=None) as ws:
+                if on_connect:
+                    on_connect(ws)
+                if not quiet:
+                    print(f"Connected to {uri}")
+                unacked = []
+                if ack:
+                    acker = asyncio.create_task(send_acks(ws, unacked, ack_interval))
                 async for msg in ws:
-                    try:
-                        print("RECV:", json.loads(msg))
-                    except Exception:
-                        print("RECV:", msg)
+                    decoded = decode(msg)
+                    if stats is not None:
+                        stats.add(msg, decoded)
+                    if ack and isinstance(decoded, dict) and decoded.get("msg_id"):
+                        unacked.append(decoded["msg_id"])
+                    on_message(decoded)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print("Connection error:", e)
-            print("Retrying in 2s...")
-            await asyncio.sleep(2)
+            if not quiet:
+                print("Connection error:", e)
+                print(f"Retrying in {retry_delay}s...")
+            await asyncio.sleep(retry_delay)
+        finally:
+            if acker:
+                acker.cancel()
+
+
+async def run(uri, stats=None, ack=False):
+    def show(msg):
+        line = f"RECV: {msg}"
+        if stats is not None and stats.messages:
+            line += f"  [{stats.summary()}]"
+        print(line)
+
+    await listen(uri, show, stats=stats, ack=ack)
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser()
     p.add_argument('--user', required=True, help='User id to connect as')
     p.add_argument('--server', default='ws://127.0.0.1:9100/ws/notifications/', help='WebSocket server base URL')
+    p.add_argument('--format', choices=['json', 'msgpack'], help='Negotiate a wire format')
+    p.add_argument('--compress', choices=['deflate'], help='Negotiate compression of large frames')
+    p.add_argument('--ack', action='store_true', help='Acknowledge messages by msg_id')
     args = p.parse_args()
+    if args.format == 'msgpack' and msgpack is None:
+        p.error('--format msgpack needs: pip install msgpack')
     server = args.server
     if not server.endswith('/'):
         server = server + '/'
-    uri = server + args.user
+    uri = with_params(server + args.user, args.format, args.compress, args.ack)
+    stats = ByteStats()
     try:
-        asyncio.run(run(uri))
+        asyncio.run(run(uri, stats, args.ack))
     except KeyboardInterrupt:
         print('\nClient stopped')
+        print(stats.summary())
@@ -1,36 +1,159 @@
-from typing import Dict
-from fastapi import WebSocket
-from supabase_client import supabase
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+from acks import acks
+from funnels import funnels
+from repositories import repos
+from metrics import push_queue_seconds, registry, websocket_events
+
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "1000"))
+
+# priority lanes, highest first: order updates and tests never wait behind bulk sends
+LANES = ("transactional", "campaign", "newsletter")
+LANE_BY_TYPE = {"CAMPAIGN": 1, "NEWSLETTER": 2}
+
+
+def lane_of(message) -> int:
+    """Index into LANES; anything that isn't a campaign or newsletter is transactional."""
+    if isinstance(message, dict):
+        return LANE_BY_TYPE.get(message.get("type"), 0)
+    return 0
+
+
+class Outbox:
+    """Per-connection outbound scheduler.
+
+    Messages wait in one queue per lane and a single writer task drains them
+    highest lane first, so an order update queued behind a newsletter
+    fan-out to the same user is written next instead of last. The writer
+    only runs while something is queued.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lanes = [deque() for _ in LANES]
+        self.writer: Optional[asyncio.Task] = None
+
+    def put(self, message: dict) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.lanes[lane_of(message)].append((message, future, time.perf_counter()))
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self._drain())
+        return future
+
+    def _next(self):
+        for lane, queue in enumerate(self.lanes):
+            if queue:
+                return lane, queue.popleft()
+        return None, None
+
+    async def _drain(self):
+        while True:
+            lane, item = self._next()
+            if item is None:
+                return
+            message, future, queued = item
+            push_queue_seconds.observe(time.perf_counter() - queued, lane=LANES[lane])
+            try:
+                await self.connection.send_json(message)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(None)
+
+
+class SSEConnection:
+    """Server-Sent Events stream registered alongside websockets.
+
+    `send_json` only enqueues; the /sse endpoint drains the queue into the
+    response. A full queue raises, so a stalled client is dropped like a
+    dead websocket and later messages are queued in pending_notifications.
+    """
+
+    def __init__(self, max_queued: int = SSE_QUEUE_SIZE):
+        self.queue: asyncio.Queue = asyncio.Queue(max_queued)
+        self.sent = 0
+
+    async def send_json(self, message: dict):
+        self.queue.put_nowait(message)
+
+    async def next_event(self, timeout: float) -> Optional[str]:
+        """The next message as an SSE frame, or None after `timeout` seconds."""
+        try:
+            message = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.sent += 1
+        return f"id: {self.sent}\nevent: notification\ndata: {json.dumps(message, default=str)}\n\n"
+
+    def drain(self) -> list:
+        """Messages accepted but never written to the stream."""
+        messages = []
+        while not self.queue.empty():
+            messages.append(self.queue.get_nowait())
+        return messages
+
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+        # WireConnections and SSEConnections; both expose `send_json`
+        self.active_connections: Dict[str, object] = {}
+        self.outboxes: Dict[str, Outbox] = {}
 
-    async def connect(self, user_id: str, websocket: WebSocket):
+    async def connect(self, user_id: str, websocket):
+        """Accept a websocket (or wire.WireConnection) and make it the user's connection."""
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        self.register(user_id, websocket)
 
-    def disconnect(self, user_id: str):
-        self.active_connections.pop(user_id, None)
+    def register(self, user_id: str, connection):
+        self.active_connections[user_id] = connection
+        self.outboxes[user_id] = Outbox(connection)
+        websocket_events.inc(event="connect")
+
+    def disconnect(self, user_id: str, connection=None):
+        """Drop the user's connection; with `connection`, only if it is still the current one."""
+        if connection is not None and self.active_connections.get(user_id) is not connection:
+            return
+        self.outboxes.pop(user_id, None)
+        if self.active_connections.pop(user_id, None) is not None:
+            websocket_events.inc(event="disconnect")
+            acks.disconnected(user_id)
+
+    async def _send(self, user_id: str, ws, message: dict):
+        """Write through the user's outbox so higher lanes go first."""
+        outbox = self.outboxes.get(user_id)
+        if outbox is None or outbox.connection is not ws:
+            await ws.send_json(message)
+            return
+        await outbox.put(message)
 
     async def send_to_user(self, user_id: str, message: dict) -> bool:
         ws = self.active_connections.get(user_id)
         if not ws:
             return False
         try:
-            await ws.send_json(message)
-            return True
+            await self._send(user_id, ws, message)
         except Exception:
+            websocket_events.inc(event="send_failure")
             # remove dead connection to avoid repeated errors
             self.disconnect(user_id)
             return False
+        if getattr(ws, "acks", False):
+            acks.track(user_id, message)
+        return True
 
     async def broadcast(self, message: dict):
         # iterate over a copy so we can remove dead connections safely during iteration
         for user_id, ws in list(self.active_connections.items()):
             try:
-                await ws.send_json(message)
+                await self._send(user_id, ws, message)
             except Exception:
+                websocket_events.inc(event="send_failure")
                 # remove dead connection to avoid repeated errors
                 self.disconnect(user_id)
 
@@ -40,23 +163,43 @@ class ConnectionManager:
         if not ws:
             return
         try:
-            res = supabase.table("pending_notifications").select("*").eq("user_id", user_id).execute()
-            pending = res.data or []
+            pending = repos.messages.attach(repos.pending.list_for_user(user_id))
         except Exception:
             print(f"Warning: failed to read pending_notifications for {user_id}")
             return
 
+        tracked = getattr(ws, "acks", False)
         for item in pending:
             payload = item.get("payload") if isinstance(item, dict) else item
+            if payload is None:
+                print("Warning: shared message missing for pending notification", item.get("id"))
+                continue
+            if tracked and not payload.get("msg_id"):
+                payload = {**payload, "msg_id": item.get("id")}
             try:
-                await ws.send_json(payload)
-                # delete pending notification after successful send
-                try:
-                    supabase.table("pending_notifications").delete().eq("id", item.get("id")).execute()
-                except Exception:
-                    print("Warning: failed to delete pending notification", item.get("id"))
+                await self._send(user_id, ws, payload)
             except Exception:
                 print(f"Warning: failed to send queued notification to {user_id}")
                 # keep pending if send failed
+                continue
+            funnels.add_message(payload, flushed=1)
+            if tracked:
+                # deleted in a batch once the client acks
+                acks.track(user_id, payload, pending_id=item.get("id"))
+                continue
+            # delete pending notification after successful send
+            try:
+                repos.pending.delete(item.get("id"))
+            except Exception:
+                print("Warning: failed to delete pending notification", item.get("id"))
 
 manager = ConnectionManager()
+
+registry.callback_gauge(
+    "websocket_active_connections", "Open notification websockets", lambda: len(manager.active_connections)
+)
+registry.callback_gauge(
+    "sse_active_connections",
+    "Open notification SSE streams",
+    lambda: sum(isinstance(c, SSEConnection) for c in list(manager.active_connections.values())),
+)
@@ -0,0 +1,166 @@
+"""Negotiated wire format for notification websockets.
+
+Clients pick an encoding with query parameters on the websocket URL:
+
+    /ws/notifications/{user_id}?format=msgpack&compress=deflate
+
+* format   - `json` (default) or `msgpack` (needs the msgpack package)
+* compress - `deflate` to zlib-compress frames larger than
+             WIRE_COMPRESS_THRESHOLD bytes
+* ack      - `1` to acknowledge messages by msg_id (see acks.py)
+
+Plain JSON without compression keeps going out as text frames, so existing
+clients see no change. Anything else is sent as a binary frame whose first
+byte holds the flags below, followed by the body. A client that asked for
+something gets a WELCOME message (in the negotiated format) stating what
+the server actually applied.
+
+Pushes fan the same message dict out to many connections, so encodings are
+cached per message: each format/compression pair is encoded once no matter
+how many clients receive it.
+"""
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Optional, Tuple, Union
+
+from metrics import registry
+
+try:
+    import msgpack
+except ImportError:  # optional: clients fall back to JSON
+    msgpack = None
+
+WIRE_COMPRESS_THRESHOLD = int(os.getenv("WIRE_COMPRESS_THRESHOLD", "1024"))
+WIRE_COMPRESS_LEVEL = int(os.getenv("WIRE_COMPRESS_LEVEL", "6"))
+# messages whose encodings are kept; a fan-out reuses one message dict per page
+WIRE_CACHE_SIZE = int(os.getenv("WIRE_CACHE_SIZE", "64"))
+
+FLAG_MSGPACK = 0x01
+FLAG_DEFLATE = 0x02
+
+websocket_frame_bytes = registry.counter(
+    "websocket_frame_bytes_total", "Bytes written to notification websockets", ("format", "compressed")
+)
+websocket_encodings = registry.counter(
+    "websocket_encodings_total", "Message encodings computed (cache misses)", ("format",)
+)
+
+
+def negotiate(fmt: Optional[str], compress: Optional[str]) -> Tuple[str, bool]:
+    fmt = (fmt or "json").lower()
+    if fmt not in ("json", "msgpack") or (fmt == "msgpack" and msgpack is None):
+        fmt = "json"
+    return fmt, (compress or "").lower() == "deflate"
+
+
+def encode(message: dict, fmt: str, compress: bool, threshold: int = WIRE_COMPRESS_THRESHOLD) -> Union[str, bytes]:
+    """A text frame for plain JSON, otherwise a flagged binary frame."""
+    websocket_encodings.inc(format=fmt)
+    if fmt == "msgpack":
+        body = msgpack.packb(message, default=str, use_bin_type=True)
+        flags = FLAG_MSGPACK
+    else:
+        text = json.dumps(message, default=str, separators=(",", ":"))
+        if not compress:
+            return text
+        body = text.encode("utf-8")
+        flags = 0
+    if compress and len(body) > threshold:
+        body = zlib.compress(body, WIRE_COMPRESS_LEVEL)
+        flags |= FLAG_DEFLATE
+    return bytes([flags]) + body
+
+
+def decode(frame: Union[str, bytes]):
+    """Inverse of `encode`, for clients and tests."""
+    if isinstance(frame, str):
+        return json.loads(frame)
+    flags, body = frame[0], frame[1:]
+    if flags & FLAG_DEFLATE:
+        body = zlib.decompress(body)
+    if flags & FLAG_MSGPACK:
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+def frame_size(frame: Union[str, bytes]) -> int:
+    """Bytes on the wire; text frames go out UTF-8 encoded."""
+    if isinstance(frame, bytes) or frame.isascii():
+        return len(frame)
+    return len(frame.encode("utf-8"))
+
+
+class FrameCache:
+    """Encodings per message object, so a fan-out encodes each format once."""
+
+    def __init__(self, size: int = WIRE_CACHE_SIZE):
+        self.size = size
+        # id(message) -> (message, {(fmt, compress): (frame, size)}); holding the message keeps its id unique
+        self.entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, message: dict, fmt: str, compress: bool) -> Tuple[Union[str, bytes], int]:
+        """The encoded frame and its size in bytes."""
+        key = (fmt, compress)
+        with self.lock:
+            entry = self.entries.get(id(message))
+            if entry is not None and entry[0] is message:
+                self.entries.move_to_end(id(message))
+                encoded = entry[1].get(key)
+                if encoded is not None:
+                    return encoded
+        frame = encode(message, fmt, compress)
+        encoded = (frame, frame_size(frame))
+        with self.lock:
+            entry = self.entries.get(id(message))
+            if entry is None or entry[0] is not message:
+                entry = (message, {})
+                self.entries[id(message)] = entry
+            entry[1][key] = encoded
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return encoded
+
+
+frames = FrameCache()
+
+
+class WireConnection:
+    """A websocket that sends in its negotiated format; what ConnectionManager registers."""
+
+    def __init__(self, websocket, fmt: Optional[str] = None, compress: Optional[str] = None, acks: bool = False):
+        self.websocket = websocket
+        self.requested = fmt is not None or compress is not None or acks
+        self.format, self.compress = negotiate(fmt, compress)
+        # client confirms receipt of every msg_id (see acks.py)
+        self.acks = acks
+
+    @classmethod
+    def from_query(cls, websocket):
+        params = websocket.query_params
+        acks = params.get("ack", "").lower() in ("1", "true", "yes")
+        return cls(websocket, params.get("format"), params.get("compress"), acks)
+
+    async def accept(self):
+        await self.websocket.accept()
+        if self.requested:
+            await self.send_json({
+                "type": "WELCOME",
+                "format": self.format,
+                "compress": "deflate" if self.compress else None,
+                "compress_threshold": WIRE_COMPRESS_THRESHOLD,
+                "ack": self.acks,
+            })
+
+    async def send_json(self, message: dict):
+        frame, size = frames.get(message, self.format, self.compress)
+        if isinstance(frame, str):
+            websocket_frame_bytes.inc(size, format=self.format, compressed="false")
+            await self.websocket.send_text(frame)
+        else:
+            compressed = "true" if frame[0] & FLAG_DEFLATE else "false"
+            websocket_frame_bytes.inc(size, format=self.format, compressed=compressed)
+            await self.websocket.send_bytes(frame)
@@ -1,11 +1,22 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from websocket_manager import manager
+import asyncio
+import os
+from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from acks import acks, requeue_pending
+from websocket_manager import manager, SSEConnection
+from wire import WireConnection, decode
+
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+# how long EventSource waits before reconnecting
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", "3000"))
 
 router = APIRouter()
 
 @router.websocket("/ws/notifications/{user_id}")
 async def notifications_ws(websocket: WebSocket, user_id: str):
-    await manager.connect(user_id, websocket)
+    """Live pushes; `?format=msgpack&compress=deflate` negotiates the wire format (see wire.py)."""
+    connection = WireConnection.from_query(websocket)
+    await manager.connect(user_id, connection)
     # flush queued notifications (best-effort)
     try:
         await manager.flush_pending(user_id)
@@ -14,9 +25,68 @@ async def notifications_ws(websocket: WebSocket, user_id: str):
 
     try:
         while True:
-            await websocket.receive_text()  # keep alive
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            if connection.acks:
+                handle_client_frame(user_id, frame.get("text") or frame.get("bytes"))
     except WebSocketDisconnect:
         pass
     finally:
-        manager.disconnect(user_id)
+        manager.disconnect(user_id, connection)
+
+
+def handle_client_frame(user_id: str, data):
+    """Client -> server messages; currently only `{"type": "ACK", "ids": [...]}`."""
+    if not data:
+        return
+    try:
+        message = decode(data)
+    except Exception:
+        return
+    if isinstance(message, dict) and message.get("type") == "ACK":
+        acks.ack(user_id, message.get("ids") or [])
+
+
+def report_requeue(user_id: str, future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Warning: failed to re-queue notifications for {user_id}: {future.exception()}")
+
+
+@router.get("/sse/notifications/{user_id}")
+async def notifications_sse(request: Request, user_id: str):
+    """SSE fallback for clients whose proxies break websockets; same pushes as the websocket."""
+    connection = SSEConnection()
+    manager.register(user_id, connection)
+    # flush queued notifications (best-effort)
+    try:
+        await manager.flush_pending(user_id)
+    except Exception:
+        print(f"Warning: failed to flush pending notifications for {user_id}")
+
+    async def events():
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            # stop once replaced by a newer connection or dropped after a failed send
+            while manager.active_connections.get(user_id) is connection:
+                frame = await connection.next_event(SSE_HEARTBEAT_SECONDS)
+                if frame is None:
+                    if await request.is_disconnected():
+                        break
+                    frame = ": keep-alive\n\n"
+                yield frame
+        finally:
+            manager.disconnect(user_id, connection)
+            # anything pushed after the client left goes back to the queue for its next connect
+            # (not awaited: the stream may be closing under a cancelled scope)
+            undelivered = [(user_id, m) for m in connection.drain()]
+            if undelivered:
+                future = asyncio.get_running_loop().run_in_executor(None, requeue_pending, undelivered)
+                future.add_done_callback(lambda f: report_requeue(user_id, f))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 